@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from abc import abstractmethod
+from typing import Optional
+import random
+
+
+class Endpoint:
+    """一个服务端地址的负载与健康状态(被动健康检查), 由HTcpBalancedClient在持有锁时维护
+
+    连续失败达到阈值后被标记为不可用, 等待一段按指数增长(含随机抖动)的退避时间后,
+    允许一个探测请求通过: 成功则恢复, 失败则加倍退避时间.
+    """
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.outstanding = 0  # 在途请求数
+        self.failures = 0  # 连续失败次数
+        self.down = False
+        self.down_until = 0.0  # 不可用时允许探测请求的时刻(time.monotonic)
+        self.backoff = 0.0  # 当前退避时间(秒)
+        self.probing = False  # 是否有探测请求在途
+        self.idle: list = []  # 空闲的连接
+
+    def __repr__(self):
+        return "Endpoint({!r}, outstanding={}, down={})".format(self.addr, self.outstanding, self.down)
+
+    def available(self, now: float) -> bool:
+        """是否可以接收请求"""
+        return not self.down or (now >= self.down_until and not self.probing)
+
+    def onSuccess(self):
+        self.failures = 0
+        self.down = False
+        self.probing = False
+        self.backoff = 0.0
+
+    def onFailure(self, now: float, max_failures: int, backoff: float, max_backoff: float) -> Optional[float]:
+        """记录一次失败
+
+        Returns:
+            Optional[float]: 因此被标记为不可用(或探测失败)时返回距下次探测的时间, 否则返回None
+        """
+        self.failures += 1
+        if self.down and not self.probing:  # 标记为不可用前发出的请求
+            return None
+        if not self.down and self.failures < max_failures:
+            return None
+        self.backoff = min(self.backoff * 2, max_backoff) if self.down else backoff
+        self.down = True
+        self.probing = False
+        delay = self.backoff * random.uniform(0.5, 1.0)  # 抖动, 避免多个客户端同时探测
+        self.down_until = now + delay
+        return delay
+
+
+class Balancer:
+    """负载均衡策略, choose在持有客户端的锁时调用, 无需自行加锁"""
+
+    @abstractmethod
+    def choose(self, endpoints: list[Endpoint]) -> Endpoint:
+        """从可用的服务端中选择一个, endpoints非空"""
+        ...
+
+
+class RoundRobinBalancer(Balancer):
+    """轮询"""
+
+    def __init__(self):
+        self.__next = 0
+
+    def choose(self, endpoints: list[Endpoint]) -> Endpoint:
+        self.__next += 1
+        return endpoints[self.__next % len(endpoints)]
+
+
+class LeastOutstandingBalancer(Balancer):
+    """选择在途请求最少的服务端, 相同时轮询"""
+
+    def __init__(self):
+        self.__next = 0
+
+    def choose(self, endpoints: list[Endpoint]) -> Endpoint:
+        self.__next += 1
+        start = self.__next % len(endpoints)
+        return min(endpoints[start:] + endpoints[:start], key=lambda endpoint: endpoint.outstanding)
+
+
+class PowerOfTwoBalancer(Balancer):
+    """随机选择两个服务端, 取在途请求较少者, 服务端较多时开销低于LeastOutstandingBalancer且避免羊群效应"""
+
+    def __init__(self, seed: Optional[int] = None):
+        self.__random = random.Random(seed)
+
+    def choose(self, endpoints: list[Endpoint]) -> Endpoint:
+        if len(endpoints) == 1:
+            return endpoints[0]
+        a, b = self.__random.sample(endpoints, 2)
+        return a if a.outstanding <= b.outstanding else b
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+from typing import Optional, Callable
+from collections import deque
+from enum import IntEnum
+import asyncio
+import logging
+import os
+import threading
+from .log import event
+
+
+class CallbackMode(IntEnum):
+    INLINE = 0  # 在提交的线程(接收线程)中直接执行
+    THREAD = 1  # 在工作线程中执行, 同一键(操作码)的回调按提交顺序执行
+    ASYNCIO = 2  # 在asyncio事件循环线程中按提交顺序执行
+
+
+class BacklogPolicy(IntEnum):
+    BLOCK = 0  # 阻塞提交方(接收线程)直至队列有空位, tcp上背压传递给对端
+    DROP_NEWEST = 1  # 丢弃新提交的回调
+    DROP_OLDEST = 2  # 丢弃队列中最早的回调
+
+
+class _Lane:
+    """一个按顺序执行的有界队列"""
+
+    def __init__(self):
+        self.items: deque[tuple[Callable, tuple]] = deque()
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.scheduled = False  # ASYNCIO模式下是否已在事件循环中安排执行
+
+
+class CallbackExecutor:
+    """在接收线程之外执行报文回调的执行器, 使接收线程只负责读取与解析报文
+
+    THREAD模式下回调按键(操作码)分配到固定的工作线程, 同一操作码的回调按收到的顺序执行,
+    不同操作码的回调可并行. 每个工作线程的队列最多容纳max_pending个回调, 超出时按BacklogPolicy处理.
+    ASYNCIO模式下所有回调在事件循环线程中按顺序执行, 回调可在其中创建任务.
+    回调抛出的异常会被记录日志, 不会影响后续回调.
+    可由多个客户端共享, 客户端关闭时不会关闭执行器.
+    """
+    DRAIN_BATCH = 64  # ASYNCIO模式下每次连续执行的最大回调数, 之后让出事件循环
+
+    def __init__(self, mode: CallbackMode = CallbackMode.THREAD, workers: Optional[int] = None,
+                 max_pending: int = 1024, policy: BacklogPolicy = BacklogPolicy.BLOCK,
+                 loop: Optional[asyncio.AbstractEventLoop] = None):
+        """CallbackExecutor
+
+        Args:
+            mode (CallbackMode): 执行方式
+            workers (Optional[int]): THREAD模式的工作线程数, None时为min(4, cpu数)
+            max_pending (int): 每个工作线程(ASYNCIO模式下为事件循环)排队的最大回调数
+            policy (BacklogPolicy): 队列已满时的处理策略
+            loop (Optional[asyncio.AbstractEventLoop]): ASYNCIO模式使用的事件循环(需在其他线程中运行),
+                None时创建一个在专用线程中运行的事件循环
+
+        Raises:
+            ValueError: max_pending或workers小于1时抛出
+        """
+        if max_pending < 1:
+            raise ValueError("max_pending must be positive")
+        if workers is None:
+            workers = min(4, os.cpu_count() or 1)
+        if workers < 1:
+            raise ValueError("workers must be positive")
+        self.__mode = mode
+        self.__max_pending = max_pending
+        self.__policy = policy
+        self.__closed = False
+        self.__loop = loop
+        self.__threads: list[threading.Thread] = []
+        self.__lanes: list[_Lane] = []
+        match mode:
+            case CallbackMode.THREAD:
+                self.__lanes = [_Lane() for _ in range(workers)]
+                for lane in self.__lanes:
+                    th = threading.Thread(target=self.__work, args=(lane,), daemon=True)
+                    th.start()
+                    self.__threads.append(th)
+            case CallbackMode.ASYNCIO:
+                self.__lanes = [_Lane()]
+                if loop is None:
+                    self.__loop = asyncio.new_event_loop()
+                    th = threading.Thread(target=self.__loop.run_forever, daemon=True)
+                    th.start()
+                    self.__threads.append(th)
+
+    def mode(self) -> CallbackMode:
+        return self.__mode
+
+    def loop(self) -> Optional[asyncio.AbstractEventLoop]:
+        """ASYNCIO模式使用的事件循环"""
+        return self.__loop
+
+    def pending(self) -> int:
+        """排队等待执行的回调数"""
+        return sum(len(lane.items) for lane in self.__lanes)
+
+    def dropped(self) -> int:
+        """因队列已满被丢弃的回调数"""
+        return sum(lane.dropped for lane in self.__lanes)
+
+    def submit(self, key: int, callback: Callable, *args) -> bool:
+        """提交一个回调
+
+        BLOCK策略下不应在本执行器的回调中提交同一键的回调, 否则队列满时会互相等待.
+
+        Args:
+            key (int): 决定执行顺序的键(操作码), 同一键的回调按提交顺序执行
+            callback (Callable): 回调方法
+            *args: 回调参数
+
+        Returns:
+            bool: 是否已执行或放入队列, 被丢弃或执行器已关闭时返回False
+        """
+        if self.__mode == CallbackMode.INLINE:
+            callback(*args)
+            return True
+        lane = self.__lanes[key % len(self.__lanes)]
+        with lane.cond:
+            if self.__closed:
+                return False
+            if len(lane.items) >= self.__max_pending:
+                match self.__policy:
+                    case BacklogPolicy.BLOCK:
+                        lane.cond.wait_for(lambda: len(lane.items) < self.__max_pending or self.__closed)
+                        if self.__closed:
+                            return False
+                    case BacklogPolicy.DROP_NEWEST:
+                        lane.dropped += 1
+                        return False
+                    case BacklogPolicy.DROP_OLDEST:
+                        lane.items.popleft()
+                        lane.dropped += 1
+            lane.items.append((callback, args))
+            if self.__mode == CallbackMode.THREAD:
+                lane.cond.notify_all()
+            elif not lane.scheduled:
+                lane.scheduled = True
+                self.__loop.call_soon_threadsafe(self.__drain, lane)
+        return True
+
+    def close(self, wait: bool = True):
+        """关闭执行器, 之后提交的回调会被丢弃
+
+        Args:
+            wait (bool): 是否等待已排队的回调执行完毕, 为False时丢弃它们
+        """
+        for lane in self.__lanes:
+            with lane.cond:
+                self.__closed = True
+                if not wait:
+                    lane.items.clear()
+                lane.cond.notify_all()
+        if self.__mode == CallbackMode.ASYNCIO:
+            lane = self.__lanes[0]
+            if wait and not self.__inLoop():
+                with lane.cond:
+                    lane.cond.wait_for(lambda: not lane.items)
+            if self.__threads:  # 自行创建的事件循环
+                self.__loop.call_soon_threadsafe(self.__loop.stop)
+        for th in self.__threads:
+            if th is not threading.current_thread():
+                th.join()
+        if self.__mode == CallbackMode.ASYNCIO and self.__threads and not self.__inLoop():
+            self.__loop.close()
+        self.__threads = []
+
+    def __inLoop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.__loop
+        except RuntimeError:
+            return False
+
+    def __work(self, lane: _Lane):
+        while True:
+            with lane.cond:
+                lane.cond.wait_for(lambda: lane.items or self.__closed)
+                if not lane.items:
+                    return
+                callback, args = lane.items.popleft()
+                lane.cond.notify_all()
+            self.__run(callback, args)
+
+    def __drain(self, lane: _Lane):
+        # 在事件循环中执行, 每批执行若干回调后让出事件循环
+        for _ in range(self.DRAIN_BATCH):
+            with lane.cond:
+                if not lane.items:
+                    lane.scheduled = False
+                    return
+                callback, args = lane.items.popleft()
+                lane.cond.notify_all()
+            self.__run(callback, args)
+        self.__loop.call_soon(self.__drain, lane)
+
+    @staticmethod
+    def __run(callback: Callable, args: tuple):
+        try:
+            callback(*args)
+        except Exception as e:
+            event(logging.ERROR, "callback_error", "callback error: %s", e, exc_info=e)
@@ -1,10 +1,25 @@
 # -*- coding: utf-8 -*-
 from abc import abstractmethod
 from typing import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
 import threading
+import logging
+import itertools
+import heapq
+import time
+import os
+import select
 from .hsocket import *
 from .message import *
-from .hserver import BuiltInOpCode
+from .hserver import BuiltInOpCode, _packPublishMsg, _unpackPublishMsg, _packIdMsg, _unpackIdMsg
+from .router import Router, Middleware
+from .reliable import ReliableUdp
+from .shm import HShmSocket
+from .metrics import Metrics
+from .profiler import Profiler
+from .executor import CallbackExecutor
+from .balancer import Endpoint, Balancer, RoundRobinBalancer
+from .log import event
 
 
 class _HTcpClient:
@@ -16,6 +31,8 @@ class _HTcpClient:
         self._tcp_socket.setblocking(True)
         self._ft_server_ip = ""
         self._ft_server_port = 0
+        self._ft_server_path: Optional[str] = None  # 服务端为unix域套接字时文件传输的监听路径
+        self._metrics: Optional[Metrics] = None
 
         self.__onConnectedCallback: Optional[self.OnConnectedCallback] = None
         self.__onDisconnectedCallback: Optional[self.OnDisconnectedCallback] = None
@@ -27,10 +44,30 @@ class _HTcpClient:
         self._tcp_socket.settimeout(timeout)
 
     def connect(self, addr):
-        self._tcp_socket.connect(addr)
-        self._ft_server_ip = addr[0]
+        """连接服务端, addr为(host, port)或unix域套接字的路径"""
+        self._connect(addr)
+        if self._tcp_socket.family != getattr(socket, "AF_UNIX", None):
+            self._ft_server_ip = addr[0]
         self._onConnected()
 
+    def _connect(self, addr):
+        family = addressFamily(addr)
+        if family != self._tcp_socket.family:  # 按地址族重新创建套接字
+            self._replaceSocket(HTcpSocket(family))
+        self._tcp_socket.connect(addr)
+
+    def _replaceSocket(self, sock):
+        # 替换尚未连接的套接字, 保留超时与统计设置
+        sock.settimeout(self._tcp_socket.gettimeout())
+        sock.setMetrics(self._metrics)
+        self._tcp_socket.close()
+        self._tcp_socket = sock
+
+    def set_metrics(self, metrics: Optional[Metrics]):
+        """设置统计使用的Metrics, None表示关闭统计"""
+        self._metrics = metrics
+        self._tcp_socket.setMetrics(metrics)
+
     def close(self):
         self._tcp_socket.close()
 
@@ -49,15 +86,16 @@ class _HTcpClient:
         if not self._get_ft_transfer_port():
             return
         # send
-        with HTcpSocket() as ft_socket:
+        start = time.monotonic()
+        with HTcpSocket(self._tcp_socket.family) as ft_socket:
             try:
-                ft_socket.connect((self._ft_server_ip, self._ft_server_port))
-            except ConnectionError:
+                ft_socket.connect(self._ft_address())
+            except OSError:
                 return
             try:
                 fin = open(path, 'rb')
             except OSError as e:  # file error
-                print(e)
+                event(logging.WARNING, "file_error", "file error: %s", e, path=path)
                 return
             try:
                 ft_socket.sendFile(fin, filename)
@@ -65,47 +103,59 @@ class _HTcpClient:
                 return
             finally:
                 fin.close()
+        self._onFileTransferred("send", [path], start)
 
     def recvfile(self) -> str:
         if not self._get_ft_transfer_port():
             return ""
         # recv
-        with HTcpSocket() as ft_socket:
+        start = time.monotonic()
+        with HTcpSocket(self._tcp_socket.family) as ft_socket:
             try:
-                ft_socket.connect((self._ft_server_ip, self._ft_server_port))
+                ft_socket.connect(self._ft_address())
                 down_path = ft_socket.recvFile()
             except OSError:
                 return ""
+        self._onFileTransferred("recv", [down_path], start)
         return down_path
 
     def sendfiles(self, paths: list[str], filenames: list[str]) -> list[str]:
         if not self._get_ft_transfer_port():
             return []
         # send
+        start = time.monotonic()
         succeed_path_list = []
-        with HTcpSocket() as ft_socket:
+        with HTcpSocket(self._tcp_socket.family) as ft_socket:
             try:
-                ft_socket.connect((self._ft_server_ip, self._ft_server_port))
+                ft_socket.connect(self._ft_address())
                 ft_socket.sendFiles(paths, filenames, succeed_path_list)
             except ValueError:
                 raise
             except OSError:
                 pass
+        self._onFileTransferred("send", succeed_path_list, start)
         return succeed_path_list
 
     def recvfiles(self) -> list[str]:
         if not self._get_ft_transfer_port():
             return []
         # recv
+        start = time.monotonic()
         download_path_list = []
-        with HTcpSocket() as ft_socket:
+        with HTcpSocket(self._tcp_socket.family) as ft_socket:
             try:
-                ft_socket.connect((self._ft_server_ip, self._ft_server_port))
+                ft_socket.connect(self._ft_address())
                 ft_socket.recvFiles(download_path_list)
             except OSError:
                 pass
+        self._onFileTransferred("recv", download_path_list, start)
         return download_path_list
 
+    def _ft_address(self):
+        if self._ft_server_path is not None:
+            return self._ft_server_path
+        return self._ft_server_ip, self._ft_server_port
+
     def setOnConnectedCallback(self, callback: OnConnectedCallback):
         self.__onConnectedCallback = callback
 
@@ -120,88 +170,255 @@ class _HTcpClient:
         if self.__onDisconnectedCallback:
             self.__onDisconnectedCallback()
 
+    def _onError(self, e: BaseException):
+        if self._metrics is not None:
+            self._metrics.error(e)
+
+    def _onFileTransferred(self, direction: str, paths: list[str], start: float):
+        if self._metrics is None or not paths:
+            return
+        size = 0
+        for path in paths:
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        self._metrics.fileTransferred(direction, size, time.monotonic() - start)
+
 
 class HTcpChannelClient(_HTcpClient):
+    """长连接客户端, 线程安全
+
+    报文由专用写线程写出: `sendmsg`只将报文放入发送队列, 多个线程可同时发送,
+    写线程每次将队列中积攒的报文以一次分散写写出.
+    """
     OnMessageReceivedCallback = Callable[[Message], None]
     OnMsgRecvByOpCodeCallback = Callable[[Message], bool]  # 返回False时会继续进行OnMessageReceivedCallback
 
     def __init__(self):
         super().__init__()
         self.__th_message = threading.Thread(target=self.__message_handle, daemon=True)
+        self.__send_queue_limits: tuple[Optional[int], Optional[int], OverflowPolicy] = \
+            (None, None, OverflowPolicy.BLOCK)
         self.__con_ft_port = threading.Condition()
+        self.__ft_port_ready = False  # 已收到尚未使用的FT_TRANSFER_PORT, 报文可能先于等待到达
         self.__ft_timeout = 15
+        self.__subscriptions: dict[str, HTcpChannelClient.OnMessageReceivedCallback] = {}
 
-        self.__onMessageReceivedCallback: Optional[self.OnMessageReceivedCallback] = None
-        self.__onMsgRecvByOpCodeCallbackDict: dict[int, self.OnMsgRecvByOpCodeCallback] = {}
+        self._router = Router()
+        self._router.setHandler(BuiltInOpCode.PUBLISH, self.__onPublish)
+        self._profiler: Optional[Profiler] = None
+        self._executor: Optional[CallbackExecutor] = None
 
     def connect(self, addr):
         super().connect(addr)
+        if isinstance(self._tcp_socket, HTcpSocket):  # 共享内存传输自带发送锁, 不需要写线程
+            high, low, policy = self.__send_queue_limits
+            queue = SendQueue(self._tcp_socket, high, low, policy)
+            queue.onOverflow = self.__shutdown
+            self._tcp_socket.setSendQueue(queue)
+            threading.Thread(target=self.__write_handle, args=(queue,), daemon=True).start()
         self.__th_message.start()
 
+    def setSendQueueLimits(self, high_watermark: int, low_watermark: Optional[int] = None,
+                           policy: OverflowPolicy = OverflowPolicy.BLOCK):
+        """设置发送队列限制, 在connect之前调用
+
+        Args:
+            high_watermark (int): 高水位(字节), 待发送数据超过该值时按policy处理, BLOCK时`sendmsg`阻塞
+            low_watermark (Optional[int]): 低水位(字节), 阻塞的发送方在回落至该值时继续
+            policy (OverflowPolicy): 溢出策略
+        """
+        self.__send_queue_limits = (high_watermark, low_watermark, policy)
+
+    def close(self):
+        self.flush(SocketConfig.sendQueueFlushTimeout)
+        super().close()
+
+    def __disconnect(self):
+        super().close()  # 连接已断开, 队列中的报文无法写出, 不等待flush
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """阻塞直至已发送的报文全部写出
+
+        Returns:
+            bool: 是否已全部写出, 超时或连接已断开时返回False
+        """
+        if self.isclosed():
+            return False
+        return self._tcp_socket.flush(timeout)
+
     def sendmsg(self, msg: Message) -> bool:
+        """发送报文, 放入发送队列后即返回
+
+        正文中可变的缓冲区(bytearray、numpy数组等)会被复制, 返回后即可修改.
+
+        Returns:
+            bool: 是否已放入发送队列, 连接已断开时返回False
+        """
+        return self.__send(msg)
+
+    def send_async(self, msg: Message) -> Future:
+        """发送报文, 返回报文写出后完成的Future
+
+        Returns:
+            Future: 结果为报文是否已写出, 连接断开或报文被丢弃时为False
+        """
+        future: Future = Future()
+        if not self.__send(msg, future.set_result) and not future.done():
+            future.set_result(False)
+        return future
+
+    def __send(self, msg: Message, on_written: Optional[Callable[[bool], None]] = None) -> bool:
         try:
-            self._tcp_socket.sendMsg(msg)
+            self._tcp_socket.sendMsg(msg, on_written, copy=True)  # 写线程写出前调用方可能修改正文
         except OSError:
+            if self.isclosed():  # 已主动关闭, 接收线程可能仍阻塞在已关闭的套接字上
+                return False
             self.__th_message.join()  # make sure that '_onDisconnected' only runs once
             if not self.isclosed():
-                print("connection error")
+                event(logging.INFO, "connection_error", "connection error")
                 self._onDisconnected()
-                self.close()
+                self.__disconnect()
             return False
         return True
 
     def set_ft_timeout(self, sec):
         self.__ft_timeout = sec
 
+    def set_metrics(self, metrics: Optional[Metrics]):
+        if self._metrics is not None:
+            self._router.removeMiddleware(self._metrics.middleware)
+        super().set_metrics(metrics)
+        if metrics is not None:
+            self._router.use(metrics.middleware)
+
+    def set_profiler(self, profiler: Optional[Profiler]):
+        """设置分析回调耗时的Profiler, None表示关闭"""
+        if self._profiler is not None:
+            self._router.removeMiddleware(self._profiler.middleware)
+        self._profiler = profiler
+        if profiler is not None:
+            self._router.use(profiler.middleware)
+
+    def subscribe(self, topic: str, callback: OnMessageReceivedCallback) -> bool:
+        """订阅主题, 收到该主题发布的报文时调用callback
+
+        Args:
+            topic (str): 主题
+            callback (OnMessageReceivedCallback): 回调方法
+
+        Returns:
+            bool: 订阅请求是否发送成功
+        """
+        self.__subscriptions[topic] = callback
+        return self.sendmsg(Message.JsonMsg(BuiltInOpCode.SUBSCRIBE, topic=topic))
+
+    def unsubscribe(self, topic: str) -> bool:
+        """取消订阅主题
+
+        Returns:
+            bool: 取消订阅请求是否发送成功
+        """
+        self.__subscriptions.pop(topic, None)
+        return self.sendmsg(Message.JsonMsg(BuiltInOpCode.UNSUBSCRIBE, topic=topic))
+
+    def publish(self, topic: str, msg: Message) -> bool:
+        """通过服务端向订阅了某主题的所有客户端发布报文
+
+        Raises:
+            ValueError: 主题中包含'\\0'时抛出
+
+        Returns:
+            bool: 是否发送成功
+        """
+        return self.sendmsg(_packPublishMsg(topic, msg))
+
+    def __onPublish(self, msg: Message) -> bool:
+        try:
+            topic, inner = _unpackPublishMsg(msg)
+        except (MessageError, UnicodeDecodeError):
+            event(logging.WARNING, "message_error", "message error")
+            return True
+        callback = self.__subscriptions.get(topic)
+        if callback is not None:
+            callback(inner)
+        return True
+
     def _get_ft_transfer_port(self) -> bool:
         self.__con_ft_port.acquire()
-        success = self.__con_ft_port.wait(self.__ft_timeout)  # wait for an FT_TRANSFER_PORT reply
+        success = self.__con_ft_port.wait_for(lambda: self.__ft_port_ready, self.__ft_timeout)  # wait for an FT_TRANSFER_PORT reply
+        self.__ft_port_ready = False
         self.__con_ft_port.release()
         return success
 
+    def __write_handle(self, queue: SendQueue):
+        queue.run()
+        self.__shutdown()  # 写出失败时使接收线程退出并断开连接
+
+    def __shutdown(self):
+        try:
+            self._tcp_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:  # 已关闭
+            pass
+
     def __message_handle(self):
         while not self.isclosed():
             try:
                 msg = self._tcp_socket.recvMsg()
             except TimeoutError:
                 continue
-            except OSError:
-                print("connection error")
+            except OSError as e:
+                self._onError(e)
+                event(logging.INFO, "connection_error", "connection error", error=e)
                 self._onDisconnected()
-                self.close()
+                self.__disconnect()
                 break
-            except MessageError:
-                print("message error")
+            except MessageError as e:
+                self._onError(e)
+                event(logging.WARNING, "message_error", "message error", error=e)
                 self._onDisconnected()
-                self.close()
+                self.__disconnect()
                 break
             else:
                 if msg.opcode() == BuiltInOpCode.FT_TRANSFER_PORT:
-                    self._ft_server_port = msg.get("port")
                     self.__con_ft_port.acquire()
+                    self._ft_server_port = msg.get("port")
+                    self._ft_server_path = msg.get("path")
+                    self.__ft_port_ready = True
                     self.__con_ft_port.notify()
                     self.__con_ft_port.release()
                     continue
                 self._onMessageReceived(msg)
 
     def setOnMsgRecvByOpCodeCallback(self, opcode: int, callback: OnMessageReceivedCallback):
-        self.__onMsgRecvByOpCodeCallbackDict[opcode] = callback
+        self._router.setHandler(opcode, callback)
 
     def popOnMsgRecvByOpCodeCallback(self, opcode: int):
-        self.__onMsgRecvByOpCodeCallbackDict.pop(opcode)
+        self._router.popHandler(opcode)
 
     def setOnMessageReceivedCallback(self, callback: OnMessageReceivedCallback):
-        self.__onMessageReceivedCallback = callback
+        self._router.setDefaultHandler(callback)
+
+    def route(self, opcode: int) -> Callable[[OnMsgRecvByOpCodeCallback], OnMsgRecvByOpCodeCallback]:
+        return self._router.route(opcode)
+
+    def use(self, middleware: Middleware):
+        self._router.use(middleware)
+
+    def set_executor(self, executor: Optional[CallbackExecutor]):
+        """设置执行回调的CallbackExecutor, None表示在接收线程中直接执行
+
+        STREAM报文的正文只能在接收下一个报文前读取, 总是在接收线程中直接执行.
+        """
+        self._executor = executor
 
     def _onMessageReceived(self, msg: Message):
-        opcode = msg.opcode()
-        callback = self.__onMsgRecvByOpCodeCallbackDict.get(opcode)
-        if callback is not None:
-            finished = callback(msg)
-            if finished:
-                return
-        if self.__onMessageReceivedCallback:
-            self.__onMessageReceivedCallback(msg)
+        handler = self._router.handler(msg.opcode())
+        if self._executor is None or msg.contenttype() == ContentType.STREAM:
+            handler(msg)
+        else:
+            self._executor.submit(msg.opcode(), handler, msg)
 
 
 class HTcpReqResClient(_HTcpClient):
@@ -213,7 +430,7 @@ class HTcpReqResClient(_HTcpClient):
             self._tcp_socket.sendMsg(msg)
         except OSError:
             if not self.isclosed():
-                print("connection error")
+                event(logging.INFO, "connection_error", "connection error")
                 self._onDisconnected()
                 self.close()
             return False
@@ -224,14 +441,17 @@ class HTcpReqResClient(_HTcpClient):
             flag_error = False
             try:
                 response = self._tcp_socket.recvMsg()
-            except TimeoutError:
-                print("time out")
+            except TimeoutError as e:
+                self._onError(e)
+                event(logging.INFO, "timeout", "time out")
                 flag_error = True  # 如果不断开，可能会在下次request时收到这次的response
-            except OSError:
-                print("connection error")
+            except OSError as e:
+                self._onError(e)
+                event(logging.INFO, "connection_error", "connection error", error=e)
                 flag_error = True
-            except MessageError:
-                print("message error")
+            except MessageError as e:
+                self._onError(e)
+                event(logging.WARNING, "message_error", "message error", error=e)
                 flag_error = True  # 收到空报文时断开
             if flag_error:
                 self._onDisconnected()
@@ -246,6 +466,7 @@ class HTcpReqResClient(_HTcpClient):
             msg = self._tcp_socket.recvMsg()
             if msg.opcode() == BuiltInOpCode.FT_TRANSFER_PORT:
                 self._ft_server_port = msg.get("port")
+                self._ft_server_path = msg.get("path")
                 return True
             else:
                 return False
@@ -255,11 +476,241 @@ class HTcpReqResClient(_HTcpClient):
             return False
 
 
+class HShmChannelClient(HTcpChannelClient):
+    """通过共享内存与HShmServer通信的HTcpChannelClient, connect的地址为服务端的unix域套接字路径"""
+
+    def _connect(self, addr):
+        self._replaceSocket(HShmSocket.connect(addr, self._tcp_socket.gettimeout()))
+
+
+class HShmReqResClient(HTcpReqResClient):
+    """通过共享内存与HShmServer通信的HTcpReqResClient, connect的地址为服务端的unix域套接字路径"""
+
+    def _connect(self, addr):
+        self._replaceSocket(HShmSocket.connect(addr, self._tcp_socket.gettimeout()))
+
+
+class HTcpBalancedClient:
+    """在多个服务端之间进行负载均衡的请求-响应客户端, 线程安全
+
+    每个服务端维护一个HTcpReqResClient连接池, 每个请求从选中的服务端借出一个连接, 完成后归还,
+    因此多个线程可同时发出请求. 请求失败(连接失败、超时或连接断开)计入服务端的连续失败次数,
+    达到阈值后该服务端暂停使用并按指数退避重新探测, 失败的请求会转发给其他服务端重试,
+    因此请求应当是幂等的. 响应为STREAM报文时正文从借出的连接读取, 该连接不放回连接池, 在正文关闭时关闭.
+    """
+
+    def __init__(self, addrs: list, balancer: Optional[Balancer] = None):
+        """HTcpBalancedClient
+
+        Args:
+            addrs (list): 服务端地址, (host, port)或unix域套接字的路径
+            balancer (Optional[Balancer]): 负载均衡策略, None时为RoundRobinBalancer
+        """
+        self.__lock = threading.Lock()
+        self.__endpoints: list[Endpoint] = [Endpoint(addr) for addr in addrs]
+        self.__balancer = balancer if balancer is not None else RoundRobinBalancer()
+        self.__timeout: Optional[float] = 5.0  # 不设超时时一个无响应的服务端会永远占用请求线程
+        self.__retries = 1
+        self.__max_idle = 8
+        self.__max_failures = 3
+        self.__backoff = 0.1
+        self.__max_backoff = 10.0
+        self.__metrics: Optional[Metrics] = None
+        self.__closed = False
+
+    def settimeout(self, timeout: Optional[float]):
+        """设置连接与等待响应的超时时间(默认5秒), None表示一直等待, 对之后建立的连接生效"""
+        self.__timeout = timeout
+
+    def set_retries(self, retries: int):
+        """设置请求失败后转发给其他服务端重试的次数"""
+        self.__retries = retries
+
+    def set_max_idle(self, max_idle: int):
+        """设置每个服务端保留的最大空闲连接数"""
+        self.__max_idle = max_idle
+
+    def set_health(self, max_failures: int = 3, backoff: float = 0.1, max_backoff: float = 10.0):
+        """设置被动健康检查
+
+        Args:
+            max_failures (int): 连续失败多少次后暂停使用服务端
+            backoff (float): 暂停后首次探测前的退避时间(秒), 探测失败后加倍
+            max_backoff (float): 退避时间上限(秒)
+        """
+        self.__max_failures = max_failures
+        self.__backoff = backoff
+        self.__max_backoff = max_backoff
+
+    def set_metrics(self, metrics: Optional[Metrics]):
+        """设置统计使用的Metrics, None表示关闭统计"""
+        with self.__lock:
+            if self.__metrics is not None:
+                for endpoint in self.__endpoints:
+                    self.__setCollectors(self.__metrics, endpoint, False)
+            self.__metrics = metrics
+            for endpoint in self.__endpoints:
+                if metrics is not None:
+                    self.__setCollectors(metrics, endpoint, True)
+                for client in endpoint.idle:
+                    client.set_metrics(metrics)
+
+    def endpoints(self) -> list[Endpoint]:
+        """服务端及其状态"""
+        with self.__lock:
+            return list(self.__endpoints)
+
+    def add_endpoint(self, addr):
+        """添加一个服务端"""
+        endpoint = Endpoint(addr)
+        with self.__lock:
+            self.__endpoints.append(endpoint)
+            if self.__metrics is not None:
+                self.__setCollectors(self.__metrics, endpoint, True)
+
+    def remove_endpoint(self, addr) -> bool:
+        """移除一个服务端, 在途的请求照常完成
+
+        Returns:
+            bool: 是否存在该服务端
+        """
+        with self.__lock:
+            endpoint = next((endpoint for endpoint in self.__endpoints if endpoint.addr == addr), None)
+            if endpoint is None:
+                return False
+            self.__endpoints.remove(endpoint)
+            if self.__metrics is not None:
+                self.__setCollectors(self.__metrics, endpoint, False)
+            idle, endpoint.idle = endpoint.idle, []
+        for client in idle:
+            client.close()
+        return True
+
+    def close(self):
+        """关闭所有空闲连接, 在途请求的连接在完成后关闭"""
+        with self.__lock:
+            self.__closed = True
+            idle = [client for endpoint in self.__endpoints for client in endpoint.idle]
+            for endpoint in self.__endpoints:
+                endpoint.idle = []
+        for client in idle:
+            client.close()
+
+    def request(self, msg: Message) -> Optional[Message]:
+        """选择一个服务端发送请求并等待响应, 失败时转发给其他服务端
+
+        Returns:
+            Optional[Message]: 响应报文, 所有尝试均失败或没有可用的服务端时返回None.
+                STREAM响应的正文读完后应调用close(或使用with), 以便立即关闭其连接
+        """
+        tried: list[Endpoint] = []
+        for _ in range(self.__retries + 1):
+            endpoint = self.__acquire(tried)
+            if endpoint is None:
+                break
+            tried.append(endpoint)
+            client = self.__borrow(endpoint)
+            response = client.request(msg) if client is not None else None
+            streaming = response is not None and response.contenttype() == ContentType.STREAM
+            self.__release(endpoint, None if streaming else client, response is not None)
+            if streaming:  # 正文仍需从该连接读取, 不能借给其他请求
+                response.content().onClose = client.close
+            if response is not None:
+                return response
+        if not tried:
+            event(logging.WARNING, "no_endpoint", "no available endpoint")
+        return None
+
+    def __acquire(self, tried: list[Endpoint]) -> Optional[Endpoint]:
+        # 选择一个未尝试过的可用服务端并计入在途请求
+        now = time.monotonic()
+        with self.__lock:
+            if self.__closed:
+                return None
+            candidates = [endpoint for endpoint in self.__endpoints
+                          if endpoint not in tried and endpoint.available(now)]
+            if not candidates:
+                return None
+            endpoint = self.__balancer.choose(candidates)
+            if endpoint.down:  # 退避结束, 作为探测请求
+                endpoint.probing = True
+            endpoint.outstanding += 1
+        return endpoint
+
+    def __borrow(self, endpoint: Endpoint) -> Optional[HTcpReqResClient]:
+        stale = []
+        with self.__lock:
+            while endpoint.idle:
+                client = endpoint.idle.pop()
+                if not self.__peerClosed(client):
+                    break
+                stale.append(client)
+            else:
+                client = None
+        for conn in stale:  # 对端已关闭的空闲连接, 借出后必然失败并计入服务端的失败次数
+            conn.close()
+        if client is not None:
+            return client
+        client = HTcpReqResClient()
+        client.settimeout(self.__timeout)
+        client.set_metrics(self.__metrics)
+        try:
+            client.connect(endpoint.addr)
+        except OSError as e:
+            if self.__metrics is not None:
+                self.__metrics.error(e)
+            event(logging.INFO, "connection_error", "connection error: %s", endpoint.addr,
+                  addr=endpoint.addr, error=e)
+            client.close()
+            return None
+        return client
+
+    def __release(self, endpoint: Endpoint, client: Optional[HTcpReqResClient], ok: bool):
+        closing = [] if client is None else [client]
+        with self.__lock:
+            endpoint.outstanding -= 1
+            if ok:
+                endpoint.onSuccess()
+                if (client is not None and not self.__closed and endpoint in self.__endpoints
+                        and len(endpoint.idle) < self.__max_idle and not client.isclosed()):
+                    endpoint.idle.append(client)
+                    closing = []
+            else:
+                delay = endpoint.onFailure(time.monotonic(), self.__max_failures, self.__backoff, self.__max_backoff)
+                if delay is not None:  # 空闲连接很可能也已失效
+                    closing += endpoint.idle
+                    endpoint.idle = []
+                    event(logging.WARNING, "endpoint_down", "endpoint down: %s, retry in %.2fs",
+                          endpoint.addr, delay, addr=endpoint.addr, failures=endpoint.failures)
+        for client in closing:
+            client.close()
+
+    @staticmethod
+    def __peerClosed(client: HTcpReqResClient) -> bool:
+        # 空闲连接上不应有数据可读, 可读时为对端已关闭或重置连接.
+        # 套接字设置了超时, recv(MSG_PEEK | MSG_DONTWAIT)仍会等待, 因此用select检查
+        try:
+            readable, _, _ = select.select([client.socket()], [], [], 0)
+        except (OSError, ValueError):  # 已关闭
+            return True
+        return bool(readable)
+
+    @staticmethod
+    def __setCollectors(metrics: Metrics, endpoint: Endpoint, enabled: bool):
+        label = str(endpoint.addr)
+        metrics.setCollector("hsocket_endpoint_up", (lambda: float(not endpoint.down)) if enabled else None,
+                             endpoint=label)
+        metrics.setCollector("hsocket_endpoint_outstanding", (lambda: endpoint.outstanding) if enabled else None,
+                             endpoint=label)
+
+
 class _HUdpClient:
     def __init__(self, addr):
         self._udp_socket: HUdpSocket = HUdpSocket()
         self._udp_socket.setblocking(True)
         self._peer_addr = addr
+        self._reliable: Optional[ReliableUdp] = None
+        self._metrics: Optional[Metrics] = None
 
     def socket(self) -> HUdpSocket:
         return self._udp_socket
@@ -267,15 +718,50 @@ class _HUdpClient:
     def settimeout(self, timeout):
         self._udp_socket.settimeout(timeout)
 
+    def set_reliable(self, enabled: bool = True):
+        """启用或关闭可靠udp模式, 服务端也需启用可靠udp模式"""
+        if self._reliable is not None:
+            self._reliable.close()
+        self._reliable = ReliableUdp(self._udp_socket) if enabled else None
+
+    def reliable(self) -> Optional[ReliableUdp]:
+        """获取可靠udp层, 未启用时返回None"""
+        return self._reliable
+
+    def set_metrics(self, metrics: Optional[Metrics]):
+        """设置统计使用的Metrics, None表示关闭统计"""
+        self._metrics = metrics
+        self._udp_socket.setMetrics(metrics)
+
     def close(self):
+        if self._reliable is not None:
+            self._reliable.close()
         self._udp_socket.close()
 
     def isclosed(self) -> bool:
         return not self._udp_socket.isValid()
 
     def sendmsg(self, msg: Message) -> bool:
+        if self._reliable is not None:
+            return self._reliable.send(msg, self._peer_addr)
         return self._udp_socket.sendMsg(msg, self._peer_addr)
 
+    def _recvmsg(self) -> Message:
+        """接收一个交付给应用的报文, 可靠udp模式下会处理确认报文并丢弃重复报文
+
+        Raises:
+            TimeoutError: 阻塞模式下等待超时时抛出
+            MessageError: 报文异常时抛出
+            UnicodeDecodeError: 报文内容编码异常时抛出
+        """
+        while True:
+            msg, addr = self._udp_socket.recvMsg()
+            if self._reliable is None:
+                return msg
+            msg = self._reliable.receive(msg, addr)
+            if msg is not None:
+                return msg
+
 
 class HUdpChannelClient(_HUdpClient):
     OnMessageReceivedCallback = Callable[[Message], None]
@@ -286,13 +772,29 @@ class HUdpChannelClient(_HUdpClient):
         self.__running = False
         self.__th_message = threading.Thread(target=self.__message_handle, daemon=True)
 
-        self.__onMessageReceivedCallback: Optional[self.OnMessageReceivedCallback] = None
-        self.__onMsgRecvByOpCodeCallbackDict: dict[int, self.OnMsgRecvByOpCodeCallback] = {}
+        self._router = Router()
+        self._profiler: Optional[Profiler] = None
+        self._executor: Optional[CallbackExecutor] = None
 
     def close(self):
         self.__running = False
         super().close()
 
+    def set_metrics(self, metrics: Optional[Metrics]):
+        if self._metrics is not None:
+            self._router.removeMiddleware(self._metrics.middleware)
+        super().set_metrics(metrics)
+        if metrics is not None:
+            self._router.use(metrics.middleware)
+
+    def set_profiler(self, profiler: Optional[Profiler]):
+        """设置分析回调耗时的Profiler, None表示关闭"""
+        if self._profiler is not None:
+            self._router.removeMiddleware(self._profiler.middleware)
+        self._profiler = profiler
+        if profiler is not None:
+            self._router.use(profiler.middleware)
+
     def sendmsg(self, msg: Message) -> bool:
         ret = super().sendmsg(msg)
         # recvMsg before sendMsg will cause WinError10022.
@@ -305,7 +807,7 @@ class HUdpChannelClient(_HUdpClient):
     def __message_handle(self):
         while not self.isclosed():
             try:
-                msg, addr = self._udp_socket.recvMsg()
+                msg = self._recvmsg()
             except TimeoutError:
                 continue
             except MessageError:
@@ -314,36 +816,216 @@ class HUdpChannelClient(_HUdpClient):
                 self._onMessageReceived(msg)
 
     def setOnMsgRecvByOpCodeCallback(self, opcode: int, callback: OnMessageReceivedCallback):
-        self.__onMsgRecvByOpCodeCallbackDict[opcode] = callback
+        self._router.setHandler(opcode, callback)
 
     def popOnMsgRecvByOpCodeCallback(self, opcode: int):
-        self.__onMsgRecvByOpCodeCallbackDict.pop(opcode)
+        self._router.popHandler(opcode)
 
     def setOnMessageReceivedCallback(self, callback: OnMessageReceivedCallback):
-        self.__onMessageReceivedCallback = callback
+        self._router.setDefaultHandler(callback)
+
+    def route(self, opcode: int) -> Callable[[OnMsgRecvByOpCodeCallback], OnMsgRecvByOpCodeCallback]:
+        return self._router.route(opcode)
+
+    def use(self, middleware: Middleware):
+        self._router.use(middleware)
+
+    def set_executor(self, executor: Optional[CallbackExecutor]):
+        """设置执行回调的CallbackExecutor, None表示在接收线程中直接执行"""
+        self._executor = executor
 
     def _onMessageReceived(self, msg: Message):
-        opcode = msg.opcode()
-        callback = self.__onMsgRecvByOpCodeCallbackDict.get(opcode)
-        if callback is not None:
-            finished = callback(msg)
-            if finished:
-                return
-        if self.__onMessageReceivedCallback:
-            self.__onMessageReceivedCallback(msg)
+        handler = self._router.handler(msg.opcode())
+        if self._executor is None:
+            handler(msg)
+        else:
+            self._executor.submit(msg.opcode(), handler, msg)
 
 
 class HUdpReqResClient(_HUdpClient):
+    """请求/响应模式的udp客户端, 线程安全
+
+    默认每次只进行一个请求, 发送后等待下一个到达的报文作为响应, 兼容任意udp服务端.
+    通过`set_request_ids`启用请求id后, 请求被封装为UDP_REQUEST报文, 服务端的响应封装为带相同id的UDP_RESPONSE报文,
+    允许同时进行大量请求, 超时未响应的请求会被重发, 过期或未知id的响应会被丢弃. 此时服务端需为HUdpServer.
+    """
+
+    class __Pending:
+        def __init__(self, data: Message, timeout: Optional[float], retries: int):
+            self.data = data
+            self.timeout = timeout
+            self.retries = retries
+            self.future: Future = Future()
+
     def __init__(self, addr):
         super().__init__(addr)
+        self.__request_ids = False
+        self.__socket_timeout: Optional[float] = None
+        self.__request_timeout: Optional[float] = None
+        self.__retries = 0
+        self.__ids = itertools.count()
+        self.__pending: dict[int, HUdpReqResClient.__Pending] = {}
+        self.__deadlines: list[tuple[float, int]] = []  # (截止时间, 请求id)的最小堆
+        self.__cond = threading.Condition()
+        self.__running = False
+        self.__th_message = threading.Thread(target=self.__message_handle, daemon=True)
+        self.__th_timer = threading.Thread(target=self.__timer_handle, daemon=True)
+        self.__lock = threading.Lock()  # 未启用请求id时串行化请求
+        self.__serial: Optional[ThreadPoolExecutor] = None  # 未启用请求id时执行request_async
 
-    def request(self, msg: Message) -> Optional[Message]:
-        try:
-            self._udp_socket.sendMsg(msg, self._peer_addr)
-            response, addr = self._udp_socket.recvMsg()
-        except TimeoutError:
-            return None
-        except MessageError:
-            return None
-        else:
-            return response
+    def settimeout(self, timeout: Optional[float]):
+        """设置套接字的超时时间, 未通过`set_request_timeout`设置时也作为请求等待响应的超时时间"""
+        with self.__cond:
+            self.__socket_timeout = timeout
+            if not self.__running:  # 接收线程运行后套接字固定使用1秒超时, 以定期检查是否已关闭
+                super().settimeout(timeout)
+
+    def set_request_timeout(self, timeout: Optional[float]):
+        """设置每次请求等待响应的默认超时时间, None表示使用套接字的超时时间"""
+        self.__request_timeout = timeout
+
+    def set_retries(self, retries: int):
+        """设置请求超时后的默认重发次数"""
+        self.__retries = retries
+
+    def set_request_ids(self, enabled: bool = True):
+        """启用或关闭请求id, 需在第一次请求前设置, 服务端需为HUdpServer"""
+        self.__request_ids = enabled
+
+    def close(self):
+        with self.__cond:
+            self.__running = False
+            pending, self.__pending = self.__pending, {}
+            self.__cond.notify_all()
+        for p in pending.values():
+            p.future.set_result(None)
+        super().close()
+        if self.__serial is not None:
+            self.__serial.shutdown(wait=False, cancel_futures=True)
+
+    def request(self, msg: Message, timeout: Optional[float] = None,
+                retries: Optional[int] = None) -> Optional[Message]:
+        """发送请求并等待响应
+
+        Args:
+            msg (Message): 请求报文
+            timeout (Optional[float]): 每次发送后等待响应的时间, None时使用`set_request_timeout`或`settimeout`设置的值
+            retries (Optional[int]): 超时后的重发次数, None时使用`set_retries`设置的值
+
+        Returns:
+            Optional[Message]: 响应报文, 超时或失败时返回None
+        """
+        if not self.__request_ids:
+            return self.__request(msg, timeout, retries)
+        return self.request_async(msg, timeout, retries).result()
+
+    def request_async(self, msg: Message, timeout: Optional[float] = None,
+                      retries: Optional[int] = None) -> Future:
+        """发送请求, 不等待响应. 未启用请求id时请求依次在后台线程中进行
+
+        Returns:
+            Future: 结果为响应报文, 超时或失败时为None
+        """
+        if not self.__request_ids:
+            with self.__cond:
+                if self.__serial is None:
+                    self.__serial = ThreadPoolExecutor(1)
+            return self.__serial.submit(self.__request, msg, timeout, retries)
+        request_id = next(self.__ids) & 0xFFFFFFFF
+        pending = self.__Pending(_packIdMsg(BuiltInOpCode.UDP_REQUEST, request_id, msg),
+                                 self.__timeout(timeout), self.__retries if retries is None else retries)
+        with self.__cond:
+            self.__pending[request_id] = pending
+        if not self.sendmsg(pending.data):
+            self.__finish(request_id, None)
+            return pending.future
+        with self.__cond:
+            if pending.timeout is not None and request_id in self.__pending:  # 发送成功后才开始计时
+                heapq.heappush(self.__deadlines, (time.monotonic() + pending.timeout, request_id))
+                self.__cond.notify()
+            # recvMsg before sendMsg will cause WinError10022.
+            # So start the message thread after the first call of send.
+            if not self.__running and not self.isclosed():
+                self.__running = True
+                super().settimeout(1.0)
+                self.__th_message.start()
+                self.__th_timer.start()
+        return pending.future
+
+    def __timeout(self, timeout: Optional[float]) -> Optional[float]:
+        if timeout is not None:
+            return timeout
+        return self.__request_timeout if self.__request_timeout is not None else self.__socket_timeout
+
+    def __request(self, msg: Message, timeout: Optional[float], retries: Optional[int]) -> Optional[Message]:
+        timeout = self.__timeout(timeout)
+        with self.__lock:
+            if timeout != self.__socket_timeout:
+                super().settimeout(timeout)
+            try:
+                for _ in range((self.__retries if retries is None else retries) + 1):
+                    if not self.sendmsg(msg):
+                        return None
+                    try:
+                        return self._recvmsg()
+                    except TimeoutError:
+                        continue
+                    except (MessageError, UnicodeDecodeError):
+                        return None
+                return None
+            except OSError:
+                return None
+            finally:
+                if timeout != self.__socket_timeout and not self.isclosed():
+                    super().settimeout(self.__socket_timeout)
+
+    def __finish(self, request_id: int, response: Optional[Message]):
+        with self.__cond:
+            pending = self.__pending.pop(request_id, None)
+        if pending is not None:
+            pending.future.set_result(response)
+
+    def __message_handle(self):
+        while not self.isclosed():
+            try:
+                msg = self._recvmsg()
+            except TimeoutError:
+                continue
+            except MessageError:
+                continue
+            except OSError:
+                break
+            if msg.opcode() != BuiltInOpCode.UDP_RESPONSE:
+                continue
+            try:
+                request_id, response = _unpackIdMsg(msg)
+            except (MessageError, UnicodeDecodeError):
+                continue
+            self.__finish(request_id, response)
+
+    def __timer_handle(self):
+        while True:
+            resend: list[Message] = []
+            expired: list[int] = []
+            with self.__cond:
+                if not self.__running:
+                    return
+                now = time.monotonic()
+                while self.__deadlines and self.__deadlines[0][0] <= now:
+                    deadline, request_id = heapq.heappop(self.__deadlines)
+                    pending = self.__pending.get(request_id)
+                    if pending is None:  # 已完成
+                        continue
+                    if pending.retries > 0:
+                        pending.retries -= 1
+                        heapq.heappush(self.__deadlines, (now + pending.timeout, request_id))
+                        resend.append(pending.data)
+                    else:
+                        expired.append(request_id)
+                if not resend and not expired:
+                    self.__cond.wait(self.__deadlines[0][0] - now if self.__deadlines else None)
+                    continue
+            for data in resend:
+                self.sendmsg(data)
+            for request_id in expired:
+                self.__finish(request_id, None)
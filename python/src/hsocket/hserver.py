@@ -1,14 +1,100 @@
 # -*- coding: utf-8 -*-
 import selectors
+import threading
+import logging
 from socketserver import ThreadingTCPServer, BaseRequestHandler
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
+import queue
+import time
+import os
+import stat
+import itertools
 from abc import abstractmethod
-from typing import Callable
+from typing import Callable, Iterable
 from .hsocket import *
 from .message import *
-
-
-class BuiltInOpCode(IntEnum):
-    FT_TRANSFER_PORT = 60020  # 文件传输端口 {"port": port}
+from .router import Router, Middleware
+from .reliable import ReliableUdp
+from .shm import HShmSocket
+from .metrics import Metrics
+from .profiler import Profiler
+from .log import event
+
+
+def _packPublishMsg(topic: str, msg: Message) -> Message:
+    """将报文封装为PUBLISH报文
+
+    Raises:
+        ValueError: 主题中包含'\\0'时抛出
+    """
+    if "\0" in topic:
+        raise ValueError("topic must not contain '\\0'")
+    return Message.BinaryMsg(BuiltInOpCode.PUBLISH, topic.encode("UTF-8") + b"\0" + msg.toBytes())
+
+
+def _packIdMsg(opcode: int, id_: int, msg: Message) -> Message:
+    """将报文封装为带4字节id的BINARY报文(UDP_REQUEST/UDP_RESPONSE)"""
+    return Message.BinaryMsg(opcode, (id_ & 0xFFFFFFFF).to_bytes(4, 'little', signed=False) + msg.toBytes())
+
+
+def _unpackIdMsg(msg: Message) -> tuple[int, Message]:
+    """从带4字节id的BINARY报文中取出id与报文
+
+    Raises:
+        MessageError: 报文格式异常时抛出
+        UnicodeDecodeError: 报文内容编码异常时抛出
+    """
+    content = msg.content()
+    if msg.contenttype() != ContentType.BINARY or len(content) < 4:
+        raise MessageTypeError("need a BINARY message")
+    return int.from_bytes(content[:4], 'little', signed=False), Message.fromBytes(content[4:])
+
+
+def _findByte(content, sep: bytes) -> int:
+    """在bytes或memoryview中查找, 接收缓冲区的视图直接在其底层对象中查找而不复制"""
+    if isinstance(content, (bytes, bytearray)):
+        return content.find(sep)
+    view = memoryview(content)
+    if isinstance(view.obj, (bytes, bytearray)) and view.nbytes == len(view.obj):
+        return view.obj.find(sep)
+    return view.tobytes().find(sep)
+
+
+def _unpackPublishMsg(msg: Message) -> tuple[str, Message]:
+    """从PUBLISH报文中取出主题与报文
+
+    Raises:
+        MessageError: 报文格式异常时抛出
+        UnicodeDecodeError: 报文内容编码异常时抛出
+    """
+    content = msg.content()
+    if msg.contenttype() != ContentType.BINARY:
+        raise MessageTypeError("need a BINARY message")
+    sep = _findByte(content, b"\0")
+    if sep < 0:
+        raise MessageHeaderError("missing topic")
+    return str(content[:sep], "UTF-8"), Message.fromBytes(content[sep + 1:])
+
+
+def _unlinkUnixSocket(addr):
+    """删除unix域套接字的文件(抽象命名空间的地址没有文件), 文件不是套接字时不删除"""
+    if not isinstance(addr, (str, bytes, os.PathLike)):
+        return
+    path = os.fspath(addr)
+    if not path or path[:1] in ("\0", b"\0"):
+        return
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except OSError:
+        pass
+
+
+class ExecutionPolicy(IntEnum):
+    INLINE = 0  # 在事件循环中直接执行
+    THREAD = 1  # 在线程池中执行
+    PROCESS = 2  # 在进程池中执行(回调及报文需可被pickle)
 
 
 class __HTcpServer:
@@ -16,15 +102,36 @@ class __HTcpServer:
     OnMessageReceivedCallback = Callable[[HTcpSocket, Message], None]
     OnConnectedCallback = Callable[[HTcpSocket, tuple], None]
     OnDisconnectedCallback = Callable[[HTcpSocket, tuple], None]
+    OnDrainCallback = Callable[[HTcpSocket], None]
+    ConnectionFilter = Callable[[HTcpSocket], bool]
 
     def __init__(self, addr):
-        self._address: str = addr
+        """addr为(host, port)或unix域套接字的路径(str, bytes, PathLike, 以'\\0'开头时为Linux抽象命名空间)"""
+        self._address = addr
+        self._family = addressFamily(addr)
         self.__ft_timeout = 15
-
-        self.__onMsgRecvByOpCodeCallbackDict: dict[int, self.OnMsgRecvByOpCodeCallback] = {}
-        self.__onMessageReceivedCallback: Optional[self.OnMessageReceivedCallback] = None
+        self.__ft_ids = itertools.count()
+        self.__send_queue_limits: tuple[Optional[int], Optional[int], OverflowPolicy] = \
+            (None, None, OverflowPolicy.BLOCK)
+        self._recv_limits = RecvLimits()  # 所有连接共享
+
+        self.__conn_lock = threading.Lock()
+        self.__conns: dict[HTcpSocket, set[str]] = {}  # 连接 -> 所在的组
+        self.__groups: dict[str, set[HTcpSocket]] = {}  # 组 -> 连接
+        # 客户端订阅的主题与服务端分配的组分开索引, 客户端无法借订阅加入或退出组
+        self.__subscriptions: dict[HTcpSocket, set[str]] = {}  # 连接 -> 订阅的主题
+        self.__topics: dict[str, set[HTcpSocket]] = {}  # 主题 -> 订阅者
+
+        self._router = Router()
+        self._metrics: Optional[Metrics] = None
+        self._profiler: Optional[Profiler] = None
         self.__onConnectedCallback: Optional[self.OnConnectedCallback] = None
         self.__onDisconnectedCallback: Optional[self.OnDisconnectedCallback] = None
+        self.__onDrainCallback: Optional[self.OnDrainCallback] = None
+
+        self._router.setHandler(BuiltInOpCode.SUBSCRIBE, self.__onSubscribe)
+        self._router.setHandler(BuiltInOpCode.UNSUBSCRIBE, self.__onUnsubscribe)
+        self._router.setHandler(BuiltInOpCode.PUBLISH, self.__onPublish)
 
     @abstractmethod
     def startserver(self):
@@ -44,18 +151,226 @@ class __HTcpServer:
         """设置文件传输超时时间"""
         self.__ft_timeout = sec
 
+    def setSendQueueLimits(self, high_watermark: int, low_watermark: Optional[int] = None,
+                           policy: OverflowPolicy = OverflowPolicy.BLOCK):
+        """设置之后建立的连接的发送队列限制
+
+        Args:
+            high_watermark (int): 高水位(字节), 待发送数据超过该值时按policy处理
+            low_watermark (Optional[int]): 低水位(字节), 超过高水位后回落至该值时触发OnDrainCallback
+            policy (OverflowPolicy): 溢出策略
+        """
+        self.__send_queue_limits = (high_watermark, low_watermark, policy)
+
+    def setMaxMessageSize(self, size: Optional[int], opcode: Optional[int] = None):
+        """设置允许接收的最大正文(字节), 超过时只凭报头即拒绝并断开连接, 流式正文按累计长度计算
+
+        Args:
+            size (Optional[int]): 正文上限, None时恢复默认值(SocketConfig.maxMessageSize)
+            opcode (Optional[int]): 只对该操作码生效, None时设置服务端的默认上限
+        """
+        self._recv_limits.setMaxSize(size, opcode)
+
+    def setRecvBudget(self, capacity: Optional[int]):
+        """设置所有连接共享的接收内存预算(字节), None表示不限制, 需在启动server前调用
+
+        正在接收及处理中的报文的正文总和超过预算时暂停读取新的报文, 由tcp流量控制使对端减速.
+        报文在回调返回后归还预算, 回调中需保留正文时应复制.
+        """
+        self._recv_limits.budget = RecvBudget(capacity) if capacity is not None else None
+        if self._metrics is not None:
+            self.set_metrics(self._metrics)
+
+    def set_metrics(self, metrics: Optional[Metrics]):
+        """设置统计使用的Metrics, None表示关闭统计
+
+        需在启动server前调用, 收发报文数只统计之后建立的连接.
+        """
+        if self._metrics is not None:
+            self._router.removeMiddleware(self._metrics.middleware)
+            self._metrics.setCollector("hsocket_connections", None)
+            self._metrics.setCollector("hsocket_send_queue_bytes", None)
+            self._metrics.setCollector("hsocket_recv_budget_bytes", None)
+        self._metrics = metrics
+        if metrics is not None:
+            self._router.use(metrics.middleware)
+            metrics.setCollector("hsocket_connections", lambda: len(self.__conns))
+            metrics.setCollector("hsocket_send_queue_bytes", self.__queuedBytes)
+            budget = self._recv_limits.budget
+            if budget is not None:
+                metrics.setCollector("hsocket_recv_budget_bytes", budget.used)
+
+    def set_profiler(self, profiler: Optional[Profiler]):
+        """设置分析回调耗时的Profiler, None表示关闭. `setOffloadCallback`设置的回调只统计在事件循环中分发的耗时"""
+        if self._profiler is not None:
+            self._router.removeMiddleware(self._profiler.middleware)
+        self._profiler = profiler
+        if profiler is not None:
+            self._router.use(profiler.middleware)
+
+    def __queuedBytes(self) -> int:
+        return sum(queue.size() for queue in (conn.sendQueue() for conn in self.connections()) if queue is not None)
+
+    def connections(self) -> list[HTcpSocket]:
+        """获取当前所有连接"""
+        with self.__conn_lock:
+            return list(self.__conns)
+
+    def joinGroup(self, conn: HTcpSocket, group: str):
+        """将一个连接加入组, 连接断开时自动退出所有组
+
+        Args:
+            conn (HTcpSocket): 与客户端连接的套接字
+            group (str): 组名
+        """
+        with self.__conn_lock:
+            groups = self.__conns.get(conn)
+            if groups is None:  # 已断开
+                return
+            groups.add(group)
+            self.__groups.setdefault(group, set()).add(conn)
+
+    def subscribers(self, topic: str) -> list[HTcpSocket]:
+        """获取订阅了某主题的所有连接"""
+        with self.__conn_lock:
+            return list(self.__topics.get(topic, ()))
+
+    def leaveGroup(self, conn: HTcpSocket, group: str):
+        """将一个连接移出组
+
+        Args:
+            conn (HTcpSocket): 与客户端连接的套接字
+            group (str): 组名
+        """
+        with self.__conn_lock:
+            groups = self.__conns.get(conn)
+            if groups is not None:
+                groups.discard(group)
+            self.__discardMember(self.__groups, group, conn)
+
+    def groupMembers(self, group: str) -> list[HTcpSocket]:
+        """获取组内的所有连接"""
+        with self.__conn_lock:
+            return list(self.__groups.get(group, ()))
+
+    def broadcast(self, msg: Message, filter: Optional[ConnectionFilter] = None, group: Optional[str] = None) -> int:
+        """向多个连接发送同一报文
+
+        报文只转换一次二进制流, 由各连接的发送队列共享, 不会阻塞调用方.
+        发送队列溢出策略为BLOCK且已满的连接会被跳过.
+
+        Args:
+            msg (Message): 发送的报文
+            filter (Optional[ConnectionFilter]): 返回True的连接才会收到报文
+            group (Optional[str]): 只发送给该组内的连接, None时发送给所有连接
+
+        Returns:
+            int: 成功放入发送队列的连接数
+        """
+        with self.__conn_lock:
+            targets = list(self.__conns if group is None else self.__groups.get(group, ()))
+        return self.__broadcastBytes(msg.toBytes(), filter, targets)
+
+    def publish(self, topic: str, msg: Message) -> int:
+        """向订阅了某主题的客户端发布报文(客户端通过`HTcpChannelClient.subscribe`订阅, 主题与组互不影响)
+
+        Args:
+            topic (str): 主题
+            msg (Message): 发布的报文
+
+        Raises:
+            ValueError: 主题中包含'\\0'时抛出
+
+        Returns:
+            int: 成功放入发送队列的订阅者数
+        """
+        return self.__broadcastBytes(_packPublishMsg(topic, msg).toBytes(), None, self.subscribers(topic))
+
+    def __broadcastBytes(self, data: bytes, filter: Optional[ConnectionFilter], targets: list[HTcpSocket]) -> int:
+        count = 0
+        for conn in targets:
+            if filter is not None and not filter(conn):
+                continue
+            try:
+                if conn.sendBytes(data, block=False):
+                    count += 1
+            except OSError:
+                pass
+        return count
+
+    def __onSubscribe(self, conn: HTcpSocket, msg: Message) -> bool:
+        topic = msg.get("topic")
+        if isinstance(topic, str):
+            with self.__conn_lock:
+                topics = self.__subscriptions.get(conn)
+                if topics is not None:  # 未断开
+                    topics.add(topic)
+                    self.__topics.setdefault(topic, set()).add(conn)
+        return True
+
+    def __onUnsubscribe(self, conn: HTcpSocket, msg: Message) -> bool:
+        topic = msg.get("topic")
+        if isinstance(topic, str):
+            with self.__conn_lock:
+                topics = self.__subscriptions.get(conn)
+                if topics is not None:
+                    topics.discard(topic)
+                self.__discardMember(self.__topics, topic, conn)
+        return True
+
+    def __onPublish(self, conn: HTcpSocket, msg: Message) -> bool:
+        # 转发客户端发布的报文, 无需解包
+        content = msg.content()
+        sep = _findByte(content, b"\0") if msg.contenttype() == ContentType.BINARY else -1
+        if sep > 0:
+            try:
+                topic = str(content[:sep], "UTF-8")
+            except UnicodeDecodeError:
+                return True
+            self.__broadcastBytes(msg.toBytes(), None, self.subscribers(topic))
+        return True
+
+    @staticmethod
+    def __discardMember(index: dict[str, set[HTcpSocket]], key: str, conn: HTcpSocket):
+        members = index.get(key)
+        if members is not None:
+            members.discard(conn)
+            if not members:
+                del index[key]
+
+    def _createSendQueue(self, conn: HTcpSocket) -> SendQueue:
+        high, low, policy = self.__send_queue_limits
+        queue = SendQueue(conn, high, low, policy)
+        queue.onDrain = lambda: self._onDrain(conn)
+        queue.onOverflow = lambda: self.closeconn(conn)
+        conn.setSendQueue(queue)
+        conn.setMetrics(self._metrics)
+        conn.setRecvLimits(self._recv_limits)
+        return queue
+
     def _get_ft_transfer_conn(self, conn: HTcpSocket) -> Optional[HTcpSocket]:
-        with HTcpSocket() as ft_socket:
+        with HTcpSocket(self._family) as ft_socket:
+            path = None
             try:
-                ft_socket.bind((self._address[0], 0))
-                port = ft_socket.getsockname()[1]
-                conn.sendMsg(Message.JsonMsg(BuiltInOpCode.FT_TRANSFER_PORT, port=port))
+                if self._family == getattr(socket, "AF_UNIX", None):
+                    # 在服务端套接字旁监听, 对端需能访问服务端套接字所在的目录
+                    path = "{}.ft{}".format(os.fsdecode(self._address), next(self.__ft_ids))
+                    ft_socket.bind(path)
+                    info = {"path": path}
+                else:
+                    ft_socket.bind((self._address[0], 0))
+                    info = {"port": ft_socket.getsockname()[1]}
                 ft_socket.settimeout(self.__ft_timeout)
-                ft_socket.listen(1)
+                ft_socket.listen(1)  # 需在告知端口前监听, 否则客户端可能先于listen连接
+                conn.sendMsg(Message.JsonMsg(BuiltInOpCode.FT_TRANSFER_PORT, **info))
+                conn.flush(self.__ft_timeout)
                 c_socket, c_addr = ft_socket.accept()
                 return c_socket
             except OSError:
                 return None
+            finally:
+                if path is not None:
+                    _unlinkUnixSocket(path)
 
     def sendfile(self, conn: HTcpSocket, path: str, filename: str):
         """发送一个文件
@@ -69,16 +384,18 @@ class __HTcpServer:
         if c_socket is None:
             return
         # send
+        start = time.monotonic()
         with c_socket:
             try:
                 fin = open(path, 'rb')
             except OSError as e:  # file error
-                print(e)
+                event(logging.WARNING, "file_error", "file error: %s", e, path=path)
                 return
             try:
                 c_socket.sendFile(fin, filename)
             finally:
                 fin.close()
+        self._onFileTransferred("send", [path], start)
 
     def recvfile(self, conn: HTcpSocket) -> str:
         """接收一个文件
@@ -93,11 +410,13 @@ class __HTcpServer:
         if c_socket is None:
             return ""
         # recv
+        start = time.monotonic()
         with c_socket:
             try:
                 down_path = c_socket.recvFile()
             except OSError:
                 return ""
+        self._onFileTransferred("recv", [down_path], start)
         return down_path
 
     def sendfiles(self, conn: HTcpSocket, paths: list[str], filenames: list[str]) -> list[str]:
@@ -118,6 +437,7 @@ class __HTcpServer:
         if c_socket is None:
             return []
         # send
+        start = time.monotonic()
         succeed_path_list = []
         with c_socket:
             try:
@@ -126,6 +446,7 @@ class __HTcpServer:
                 raise
             except OSError:
                 pass
+        self._onFileTransferred("send", succeed_path_list, start)
         return succeed_path_list
 
     def recvfiles(self, conn: HTcpSocket) -> list[str]:
@@ -141,12 +462,14 @@ class __HTcpServer:
         if c_socket is None:
             return []
         # recv
+        start = time.monotonic()
         download_path_list = []
         with c_socket:
             try:
                 c_socket.recvFiles(download_path_list)
             except OSError:
                 pass
+        self._onFileTransferred("recv", download_path_list, start)
         return download_path_list
 
     def setOnMsgRecvByOpCodeCallback(self, opcode: int, callback: OnMessageReceivedCallback):
@@ -156,7 +479,7 @@ class __HTcpServer:
             opcode (int): 操作码
             callback (OnMessageReceivedCallback): 回调方法
         """
-        self.__onMsgRecvByOpCodeCallbackDict[opcode] = callback
+        self._router.setHandler(opcode, callback)
 
     def popOnMsgRecvByOpCodeCallback(self, opcode: int):
         """取消收到指定操作码报文时的回调
@@ -164,7 +487,7 @@ class __HTcpServer:
         Args:
             opcode (int): 操作码
         """
-        self.__onMsgRecvByOpCodeCallbackDict.pop(opcode)
+        self._router.popHandler(opcode)
 
     def setOnMessageReceivedCallback(self, callback: OnMessageReceivedCallback):
         """设置收到报文时的回调(调用晚于`setOnMsgRecvByOpCodeCallback`设置的回调)
@@ -172,7 +495,23 @@ class __HTcpServer:
         Args:
             callback (OnMessageReceivedCallback): 回调方法
         """
-        self.__onMessageReceivedCallback = callback
+        self._router.setDefaultHandler(callback)
+
+    def route(self, opcode: int) -> Callable[[OnMsgRecvByOpCodeCallback], OnMsgRecvByOpCodeCallback]:
+        """以装饰器形式设置收到指定操作码报文时的回调, 等同于`setOnMsgRecvByOpCodeCallback`
+
+        Args:
+            opcode (int): 操作码
+        """
+        return self._router.route(opcode)
+
+    def use(self, middleware: Middleware):
+        """添加一个报文分发中间件, 按添加顺序由外向内执行
+
+        Args:
+            middleware (Middleware): 中间件工厂方法 `middleware(opcode, next_handler) -> handler`
+        """
+        self._router.use(middleware)
 
     def setOnConnectedCallback(self, callback: OnConnectedCallback):
         """设置某个客户端连接时的回调
@@ -190,53 +529,139 @@ class __HTcpServer:
         """
         self.__onDisconnectedCallback = callback
 
+    def setOnDrainCallback(self, callback: OnDrainCallback):
+        """设置某个连接的发送队列超过高水位后回落至低水位时的回调
+
+        Args:
+            callback (OnDrainCallback): 回调方法
+        """
+        self.__onDrainCallback = callback
+
     def _onMessageReceived(self, conn: HTcpSocket, msg: Message):
-        opcode = msg.opcode()
-        callback = self.__onMsgRecvByOpCodeCallbackDict.get(opcode)
-        if callback is not None:
-            finished = callback(conn, msg)
-            if finished:
-                return
-        if self.__onMessageReceivedCallback:
-            self.__onMessageReceivedCallback(conn, msg)
+        self._router.handler(msg.opcode())(conn, msg)
 
     def _onConnected(self, conn: HTcpSocket, addr):
+        with self.__conn_lock:
+            self.__conns[conn] = set()
+            self.__subscriptions[conn] = set()
+        if self._metrics is not None:
+            self._metrics.inc("hsocket_accepted_total")
         if self.__onConnectedCallback:
             self.__onConnectedCallback(conn, addr)
 
     def _onDisconnected(self, conn: HTcpSocket, addr):
+        with self.__conn_lock:
+            for group in self.__conns.pop(conn, ()):
+                self.__discardMember(self.__groups, group, conn)
+            for topic in self.__subscriptions.pop(conn, ()):
+                self.__discardMember(self.__topics, topic, conn)
         if self.__onDisconnectedCallback:
             self.__onDisconnectedCallback(conn, addr)
 
+    def _onDrain(self, conn: HTcpSocket):
+        if self.__onDrainCallback:
+            self.__onDrainCallback(conn)
+
+    def _onError(self, e: BaseException):
+        if self._metrics is not None:
+            self._metrics.error(e)
+
+    def _onFileTransferred(self, direction: str, paths: list[str], start: float):
+        if self._metrics is None or not paths:
+            return
+        size = 0
+        for path in paths:
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        self._metrics.fileTransferred(direction, size, time.monotonic() - start)
+
 
 class HTcpSelectorServer(__HTcpServer):
     """以selector实现并发的HTcpServer"""
+    OffloadCallback = Callable[[Message], Optional[Message]]  # 返回的报文会发送回原连接
 
     class __HServerSelector:
         def __init__(self, hserver: "HTcpSelectorServer"):
             self.hserver: "HTcpSelectorServer" = hserver
-            self.server_socket = HTcpSocket()
+            self.server_socket = HTcpSocket(hserver._family)
             self.msgs: dict[HTcpSocket, Message] = {}
+            self.addrs: dict[HTcpSocket, tuple] = {}  # 对端重置连接后无法再getpeername
             self.running = False
+            self.loop_ident: Optional[int] = None
+            self.results: deque[tuple[HTcpSocket, Future]] = deque()  # 已完成的卸载任务
+            self.pending_writes: list[HTcpSocket] = []  # 其他线程放入发送队列的连接
+            self.pending_lock = threading.Lock()
+            self.parked: set[HTcpSocket] = set()  # 因接收预算不足暂停读取的连接(已从selector注销)
+            self.closing: dict[HTcpSocket, float] = {}  # 等待发送队列写完后关闭的连接 -> 截止时间
+            # 正在独立线程中处理STREAM报文的连接(已从selector注销) -> 处理期间是否在事件循环中被请求关闭
+            self.streaming: dict[HTcpSocket, bool] = {}
+            self.draining: set[HTcpSocket] = set()  # 处理STREAM报文期间为写出发送队列而注册的连接
+            self.streamed: deque[tuple[HTcpSocket, Optional[Exception]]] = deque()  # 处理完毕的STREAM报文
+            self.budget_released = False
+            self.wakeup_r, self.wakeup_w = socket.socketpair()
 
         def start(self, addr, backlog=10):
+            _unlinkUnixSocket(addr)  # 上次运行遗留的套接字文件
             self.server_socket.bind(addr)
             self.server_socket.setblocking(False)
             self.server_socket.listen(backlog)
+            self.wakeup_r.setblocking(False)
+            self.wakeup_w.setblocking(False)
 
             self.selector = selectors.DefaultSelector()
             self.selector.register(self.server_socket, selectors.EVENT_READ, self.callback_accept)
+            self.selector.register(self.wakeup_r, selectors.EVENT_READ, self.callback_wakeup)
 
-            print("server start at {}".format(addr))
+            budget = self.hserver._recv_limits.budget
+            if budget is not None:
+                budget.addListener(self.on_budget_released)
+            event(logging.INFO, "server_started", "server start at %s", addr, addr=addr)
             self.running = True
+            self.loop_ident = threading.get_ident()
             self.run()
 
         def run(self):
             while self.running:
-                events = self.selector.select()
+                timeout = None
+                if self.closing:
+                    timeout = max(0.0, min(self.closing.values()) - time.monotonic())
+                events = self.selector.select(timeout)
                 for key, mask in events:
                     callback = key.data
                     callback(key.fileobj)
+                if self.parked and self.budget_released:
+                    self.resume_parked()
+                if self.closing:
+                    now = time.monotonic()
+                    for conn in [conn for conn, deadline in self.closing.items() if deadline <= now]:
+                        self.finish_close(conn)
+
+        def close_conn(self, conn: HTcpSocket):
+            """在事件循环中关闭连接, 发送队列未写完时继续写出, 写完或超时后再关闭, 不阻塞事件循环"""
+            if conn in self.closing:
+                return
+            if conn in self.streaming:  # 处理线程仍在读取该连接, 处理完毕后再关闭
+                self.streaming[conn] = True
+                return
+            if conn in self.msgs and conn.isValid() and conn.sendQueue().size():
+                self.closing[conn] = time.monotonic() + SocketConfig.sendQueueFlushTimeout
+                if conn in self.parked:
+                    self.parked.discard(conn)
+                    self.selector.register(conn, selectors.EVENT_WRITE, self.callback_write)
+                else:
+                    self.selector.modify(conn, selectors.EVENT_WRITE, self.callback_write)
+                return
+            self.finish_close(conn)
+
+        def finish_close(self, conn: HTcpSocket):
+            self.closing.pop(conn, None)
+            addr = self.peername(conn)
+            if conn in self.msgs:
+                self.remove(conn)
+            conn.close()
+            self.hserver._onDisconnected(conn, addr)
 
         def stop(self):
             self.running = False
@@ -246,76 +671,370 @@ class HTcpSelectorServer(__HTcpServer):
             for fobj in fobj_list:
                 self.selector.unregister(fobj)
                 fobj.close()
+            for conn in self.parked:
+                conn.close()
+            self.parked.clear()
+            for conn in self.streaming:
+                conn.close()
+            self.streaming.clear()
+            self.draining.clear()
+            self.closing.clear()
+            budget = self.hserver._recv_limits.budget
+            if budget is not None:
+                budget.removeListener(self.on_budget_released)
             self.selector.close()
+            self.wakeup_w.close()
+
+        def wakeup(self):
+            """从其他线程唤醒事件循环"""
+            try:
+                self.wakeup_w.send(b"\0")
+            except (BlockingIOError, OSError):  # 缓冲区已满时事件循环必然会被唤醒
+                pass
+
+        def on_budget_released(self):
+            self.budget_released = True
+            if self.parked and threading.get_ident() != self.loop_ident:
+                self.wakeup()
+
+        def park(self, conn: HTcpSocket):
+            """接收预算不足, 暂停读取该连接"""
+            self.selector.unregister(conn)
+            self.parked.add(conn)
+            self.budget_released = False
+
+        def resume_parked(self):
+            self.budget_released = False
+            parked, self.parked = self.parked, set()
+            for conn in parked:
+                if conn not in self.msgs:
+                    continue
+                if not conn.isValid():  # 暂停期间被主动关闭
+                    del self.msgs[conn]
+                    self.addrs.pop(conn, None)
+                    continue
+                if conn.sendQueue().size():
+                    self.selector.register(conn, selectors.EVENT_WRITE, self.callback_write)
+                else:
+                    self.selector.register(conn, selectors.EVENT_READ, self.callback_read)
+
+        def submit(self, conn: HTcpSocket, msg: Message, callback: "HTcpSelectorServer.OffloadCallback",
+                   executor: Executor):
+            future = executor.submit(callback, msg)
+            future.add_done_callback(lambda f: self.on_done(conn, f))
+
+        def on_done(self, conn: HTcpSocket, future: Future):
+            self.results.append((conn, future))
+            self.wakeup()
+
+        def callback_wakeup(self, wakeup_r: socket.socket):
+            try:
+                while wakeup_r.recv(1024):
+                    pass
+            except BlockingIOError:
+                pass
+            with self.pending_lock:
+                pending_writes, self.pending_writes = self.pending_writes, []
+            for conn in pending_writes:
+                self.want_write(conn)
+            while self.streamed:
+                conn, error = self.streamed.popleft()
+                self.finish_stream(conn, error)
+            while self.results:
+                conn, future = self.results.popleft()
+                if conn not in self.msgs or not conn.isValid():  # 连接已关闭
+                    continue
+                try:
+                    reply = future.result()
+                except Exception as e:
+                    self.hserver._onError(e)
+                    event(logging.ERROR, "offload_error", "offload error: %s", e, exc_info=e)
+                    continue
+                if reply is not None:
+                    self.send_reply(conn, reply)
+
+        def send_reply(self, conn: HTcpSocket, reply: Message):
+            try:
+                conn.sendMsg(reply)
+            except OSError:
+                event(logging.INFO, "connection_error", "connection error: %s", conn)
+
+        def request_write(self, conn: HTcpSocket):
+            """发送队列由空变为非空时调用, 使事件循环关注该连接的可写事件"""
+            if threading.get_ident() == self.loop_ident:
+                self.want_write(conn)
+            else:
+                with self.pending_lock:
+                    self.pending_writes.append(conn)
+                    need_wakeup = len(self.pending_writes) == 1  # 广播时只需唤醒一次
+                if need_wakeup:
+                    self.wakeup()
+
+        def want_write(self, conn: HTcpSocket):
+            if (conn not in self.msgs or not conn.isValid() or conn in self.parked  # 暂停的连接恢复时再写出
+                    or conn in self.closing):
+                return
+            if conn in self.streaming:
+                if conn not in self.draining:
+                    self.draining.add(conn)
+                    self.selector.register(conn, selectors.EVENT_WRITE, self.callback_drain)
+                return
+            if self.selector.get_key(conn).data == self.callback_read:
+                self.selector.modify(conn, selectors.EVENT_WRITE, self.callback_write)
 
         def callback_accept(self, server_socket: HTcpSocket):
             conn, addr = server_socket.accept()
-            print("connected: {}".format(addr))
+            event(logging.INFO, "connected", "connected: %s", addr, addr=addr)
             conn.setblocking(False)
+            queue = self.hserver._createSendQueue(conn)
+            queue.owner = self.loop_ident
+            queue.onPut = lambda: self.request_write(conn)
             self.msgs[conn] = None
+            self.addrs[conn] = addr
             self.selector.register(conn, selectors.EVENT_READ, self.callback_read)
             self.hserver._onConnected(conn, addr)
 
         def callback_read(self, conn: HTcpSocket):
             if not conn.isValid():
                 # 主动关闭连接后会进入以下代码段
-                print("not a socket")
+                event(logging.DEBUG, "not_a_socket", "not a socket")
                 self.remove(conn)
+                self.addrs.pop(conn, None)
                 return
-            addr = conn.getpeername()
+            addr = self.addrs.get(conn)
             flag_error = False
             try:
-                msg = conn.recvMsg()  # receive msg
-            except OSError:
+                msg = conn.tryRecvMsg()  # receive msg
+                if msg is None:  # 报文未完整到达, 或接收预算不足
+                    if conn.waitingRecvBudget():
+                        self.park(conn)
+                    return
+            except OSError as e:
                 flag_error = True
-                print("connection error: {}".format(addr))
-            except MessageError:
+                self.hserver._onError(e)
+                event(logging.INFO, "connection_error", "connection error: %s", addr, addr=addr, error=e)
+            except MessageError as e:
                 flag_error = True
-                print("message error: {}".format(addr))
+                self.hserver._onError(e)
+                event(logging.WARNING, "message_error", "message error: %s", addr, addr=addr, error=e)
             if flag_error:
                 self.remove(conn)
-                print("connection closed (read): {}".format(addr))
+                event(logging.INFO, "disconnected", "connection closed (read): %s", addr, addr=addr)
                 self.hserver.closeconn(conn)
             else:
                 self.msgs[conn] = msg
                 self.selector.modify(conn, selectors.EVENT_WRITE, self.callback_write)
 
         def callback_write(self, conn: HTcpSocket):
-            addr = conn.getpeername()
+            addr = self.addrs.get(conn)
             msg = self.msgs[conn]
+            if conn in self.closing:  # 只写出剩余数据
+                try:
+                    empty = conn.sendQueue().writeSome()
+                except OSError:
+                    empty = True
+                if empty:
+                    self.finish_close(conn)
+                return
             if msg:
-                self.hserver._onMessageReceived(conn, msg)
                 self.msgs[conn] = None
+                if msg.contenttype() == ContentType.STREAM:
+                    self.start_stream(conn, msg)
+                    return
+                self.hserver._onMessageReceived(conn, msg)
+                conn.releaseRecv()
+                if conn not in self.msgs or conn in self.closing:  # 在回调中被关闭
+                    return
             if conn.isValid():  # may be disconnected in messageHandle
-                self.selector.modify(conn, selectors.EVENT_READ, self.callback_read)
+                try:
+                    empty = conn.sendQueue().writeSome()
+                except OSError as e:
+                    self.hserver._onError(e)
+                    event(logging.INFO, "connection_error", "connection error: %s", addr, addr=addr, error=e)
+                    self.remove(conn)
+                    event(logging.INFO, "disconnected", "connection closed (write): %s", addr, addr=addr)
+                    self.hserver.closeconn(conn)
+                    return
+                if empty:
+                    self.selector.modify(conn, selectors.EVENT_READ, self.callback_read)
+                # 发送队列未清空时暂停读取, 直至对端接收完毕
             else:
                 # 主动关闭连接后会进入以下代码段
-                self.remove(conn)
-                print("connection closed (write): {}".format(addr))
+                if conn in self.msgs:
+                    self.remove(conn)
+                self.addrs.pop(conn, None)
+                event(logging.INFO, "disconnected", "connection closed (write): %s", addr, addr=addr)
 
-        def remove(self, conn: HTcpSocket):
+        def start_stream(self, conn: HTcpSocket, msg: Message):
+            """STREAM报文的正文需边处理边从套接字读取, 在独立线程中处理以免阻塞事件循环, 处理期间不再读取该连接"""
             self.selector.unregister(conn)
+            self.streaming[conn] = False
+            if conn.sendQueue().size():
+                self.draining.add(conn)
+                self.selector.register(conn, selectors.EVENT_WRITE, self.callback_drain)
+            threading.Thread(target=self.handle_stream, args=(conn, msg), daemon=True).start()
+
+        def handle_stream(self, conn: HTcpSocket, msg: Message):
+            error = None
+            try:
+                self.hserver._onMessageReceived(conn, msg)
+                msg.content().discard()  # 读完剩余正文, 事件循环才能接收下一个报文
+            except Exception as e:
+                error = e
+            finally:
+                conn.releaseRecv()
+            self.streamed.append((conn, error))
+            self.wakeup()
+
+        def finish_stream(self, conn: HTcpSocket, error: Optional[Exception]):
+            close_requested = self.streaming.pop(conn, False)
+            if conn in self.draining:
+                self.draining.discard(conn)
+                self.selector.unregister(conn)
+            if conn not in self.msgs:  # 处理期间已被移除
+                return
+            addr = self.addrs.get(conn)
+            if not conn.isValid():  # 在处理线程中被主动关闭, 已触发onDisconnected
+                del self.msgs[conn]
+                self.addrs.pop(conn, None)
+                conn.sendQueue().close()
+                return
+            if error is not None:
+                self.hserver._onError(error)
+                if isinstance(error, OSError):
+                    event(logging.INFO, "connection_error", "connection error: %s", addr, addr=addr, error=error)
+                elif isinstance(error, MessageError):
+                    event(logging.WARNING, "message_error", "message error: %s", addr, addr=addr, error=error)
+                else:
+                    event(logging.ERROR, "callback_error", "callback error: %s", error, exc_info=error)
+                del self.msgs[conn]
+                conn.sendQueue().close()
+                event(logging.INFO, "disconnected", "connection closed (read): %s", addr, addr=addr)
+                self.hserver.closeconn(conn)
+                return
+            if conn.sendQueue().size():
+                self.selector.register(conn, selectors.EVENT_WRITE, self.callback_write)
+            else:
+                self.selector.register(conn, selectors.EVENT_READ, self.callback_read)
+            if close_requested:
+                self.close_conn(conn)
+
+        def callback_drain(self, conn: HTcpSocket):
+            """处理STREAM报文期间只写出发送队列, 读取由处理线程进行"""
+            try:
+                empty = conn.sendQueue().writeSome()
+            except OSError:  # 处理线程随后也会遇到连接异常
+                empty = True
+            if empty:
+                self.draining.discard(conn)
+                self.selector.unregister(conn)
+
+        def remove(self, conn: HTcpSocket):
+            self.closing.pop(conn, None)
+            if conn in self.parked:
+                self.parked.discard(conn)
+            elif conn in self.streaming:  # 处理线程结束后由finish_stream清理
+                if conn in self.draining:
+                    self.draining.discard(conn)
+                    self.selector.unregister(conn)
+            else:
+                self.selector.unregister(conn)
             del self.msgs[conn]
+            conn.sendQueue().close()
+
+        def peername(self, conn: HTcpSocket) -> Optional[tuple]:
+            addr = self.addrs.pop(conn, None)
+            if addr is None:
+                try:
+                    addr = conn.getpeername()
+                except OSError:
+                    pass
+            return addr
 
     def __init__(self, addr):
         super().__init__(addr)
         self.__selector = self.__HServerSelector(self)
+        self.__thread_workers: Optional[int] = None
+        self.__process_workers: Optional[int] = None
+        self.__thread_pool: Optional[ThreadPoolExecutor] = None
+        self.__process_pool: Optional[ProcessPoolExecutor] = None
 
     def startserver(self):
         self.__selector.start(self._address)
 
     def closeserver(self):
         self.__selector.stop()
+        _unlinkUnixSocket(self._address)
+        for pool in (self.__thread_pool, self.__process_pool):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        self.__thread_pool = self.__process_pool = None
 
     def closeconn(self, conn: HTcpSocket):
         """主动关闭一个连接
 
         如果直接使用 conn.close() 则会导致不触发 onDisconnected 回调.
+        在事件循环中调用时不等待, 发送队列中剩余的数据写完(或超时)后再关闭.
         """
-        addr = conn.getpeername()
+        if threading.get_ident() == self.__selector.loop_ident:
+            self.__selector.close_conn(conn)
+            return
+        addr = self.__selector.peername(conn)
+        conn.flush(SocketConfig.sendQueueFlushTimeout)
         conn.close()
         self._onDisconnected(conn, addr)
 
+    def set_pool_size(self, thread_workers: Optional[int] = None, process_workers: Optional[int] = None):
+        """设置线程池与进程池的工作者数量, 需在启动server前调用
+
+        Args:
+            thread_workers (Optional[int]): 线程池大小, None时使用ThreadPoolExecutor默认值
+            process_workers (Optional[int]): 进程池大小, None时使用CPU核心数
+        """
+        self.__thread_workers = thread_workers
+        self.__process_workers = process_workers
+
+    def setOffloadCallback(self, opcode: int, callback: OffloadCallback,
+                           policy: ExecutionPolicy = ExecutionPolicy.THREAD):
+        """设置收到指定操作码报文时在事件循环外执行的回调
+
+        回调返回的报文会在执行完成后由事件循环发送回原连接, 返回None时不回复.
+        该回调优先于`setOnMsgRecvByOpCodeCallback`设置的回调, 且不会继续进行OnMessageReceivedCallback.
+        报文先在事件循环中经过所有中间件, 再由该回调作为处理链的末端执行.
+        STREAM报文的正文只在处理期间有效, 在该连接的独立处理线程中直接执行, 不再交给线程池或进程池.
+
+        Args:
+            opcode (int): 操作码
+            callback (OffloadCallback): 回调方法, policy为PROCESS时需为模块级函数
+            policy (ExecutionPolicy): 执行方式
+        """
+        self._router.setTerminalHandler(opcode, lambda conn, msg: self.__offload(conn, msg, callback, policy))
+
+    def popOffloadCallback(self, opcode: int):
+        """取消收到指定操作码报文时在事件循环外执行的回调
+
+        Args:
+            opcode (int): 操作码
+        """
+        self._router.popTerminalHandler(opcode)
+
+    def __offload(self, conn: HTcpSocket, msg: Message, callback: OffloadCallback, policy: ExecutionPolicy):
+        if msg.contenttype() == ContentType.STREAM:  # 流式正文只在处理期间有效, 已在独立的处理线程中
+            policy = ExecutionPolicy.INLINE
+        match policy:
+            case ExecutionPolicy.THREAD:
+                if self.__thread_pool is None:
+                    self.__thread_pool = ThreadPoolExecutor(self.__thread_workers)
+                self.__selector.submit(conn, msg, callback, self.__thread_pool)
+            case ExecutionPolicy.PROCESS:
+                if self.__process_pool is None:
+                    self.__process_pool = ProcessPoolExecutor(self.__process_workers)
+                self.__selector.submit(conn, msg, callback, self.__process_pool)
+            case _:
+                reply = callback(msg)
+                if reply is not None:
+                    self.__selector.send_reply(conn, reply)
+
 
 class HTcpThreadingServer(__HTcpServer):
     """以socketserver.ThreadingTCPServer实现并发的HTcpServer"""
@@ -329,7 +1048,9 @@ class HTcpThreadingServer(__HTcpServer):
             super().__init__(request, client_address, server)
 
         def setup(self):
-            print("connected: {}".format(self.client_address))
+            event(logging.INFO, "connected", "connected: %s", self.client_address, addr=self.client_address)
+            queue = self.server.hserver._createSendQueue(self.request)
+            threading.Thread(target=queue.run, daemon=True).start()
             self.server.hserver._onConnected(self.request, self.client_address)
 
         def handle(self):
@@ -339,24 +1060,29 @@ class HTcpThreadingServer(__HTcpServer):
                 try:
                     msg = conn.recvMsg()  # receive msg
                 # except ConnectionResetError:
-                #     print("connection reset: {}".format(addr))
+                #     event(logging.INFO, "connection_reset", "connection reset: %s", addr)
                 #     return
-                except OSError:
-                    print("connection error: {}".format(addr))
+                except OSError as e:
+                    self.server.hserver._onError(e)
+                    event(logging.INFO, "connection_error", "connection error: %s", addr, addr=addr, error=e)
                     return
-                except MessageError:  # message error
-                    print("message error: {}".format(addr))
+                except MessageError as e:  # message error
+                    self.server.hserver._onError(e)
+                    event(logging.WARNING, "message_error", "message error: %s", addr, addr=addr, error=e)
                     self.server.hserver.closeconn(conn)  # close connection
                     return
                 else:
                     self.server.hserver._onMessageReceived(conn, msg)
+                    conn.releaseRecv()
 
         def finish(self):
-            print("connection closed: {}".format(self.client_address))
+            event(logging.INFO, "disconnected", "connection closed: %s", self.client_address, addr=self.client_address)
+            self.request.sendQueue().close()
             self.server.hserver._onDisconnected(self.request, self.client_address)
 
     class __HThreadingTCPServer(ThreadingTCPServer):
         def __init__(self, hserver: "HTcpThreadingServer", server_address, RequestHandlerClass):
+            self.address_family = hserver._family
             super().__init__(server_address, RequestHandlerClass, bind_and_activate=False)
             self.socket = HTcpSocket(self.address_family)
             self.hserver: "HTcpThreadingServer" = hserver
@@ -370,21 +1096,139 @@ class HTcpThreadingServer(__HTcpServer):
 
     def startserver(self):
         try:
+            _unlinkUnixSocket(self._address)  # 上次运行遗留的套接字文件
             self.__server.server_bind()
             self.__server.server_activate()
         except:
             self.__server.server_close()
             raise
-        print("server start at {}".format(self.__server.server_address))
+        event(logging.INFO, "server_started", "server start at %s", self.__server.server_address,
+              addr=self.__server.server_address)
         self.__server.serve_forever()
 
     def closeserver(self):
         self.__server.shutdown()
+        _unlinkUnixSocket(self._address)
 
     def closeconn(self, conn: HTcpSocket):
+        conn.flush(SocketConfig.sendQueueFlushTimeout)
         self.__server.shutdown_request(conn)
 
 
+class HShmServer(__HTcpServer):
+    """通过共享内存环形缓冲区收发报文的server, 只能与同一主机上的HShm客户端通信
+
+    客户端通过unix域套接字addr连接并完成握手, 之后报文经共享内存收发, 每个连接由一个线程接收.
+    回调API与HTcpThreadingServer相同, 回调中的conn为HShmSocket; 文件传输经unix域套接字进行.
+    """
+
+    def __init__(self, addr, backlog: int = 64):
+        super().__init__(addr)
+        self.__backlog = backlog
+        self.__listener: Optional[HTcpSocket] = None
+        self.__running = False
+        self.__handshake_timeout = 5.0
+
+    def startserver(self):
+        listener = HTcpSocket(self._family)
+        try:
+            _unlinkUnixSocket(self._address)  # 上次运行遗留的套接字文件
+            listener.bind(self._address)
+            listener.listen(self.__backlog)
+        except:
+            listener.close()
+            raise
+        self.__listener = listener
+        self.__running = True
+        event(logging.INFO, "server_started", "server start at %s", self._address, addr=self._address)
+        while self.__running:
+            try:
+                sock, addr = listener.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.__handle, args=(sock, addr), daemon=True).start()
+
+    def closeserver(self):
+        self.__running = False
+        if self.__listener is not None:
+            try:
+                self.__listener.shutdown(socket.SHUT_RDWR)  # 唤醒accept
+            except OSError:
+                pass
+            self.__listener.close()
+        _unlinkUnixSocket(self._address)
+
+    def closeconn(self, conn: HShmSocket):
+        conn.flush(SocketConfig.sendQueueFlushTimeout)
+        conn.close()
+
+    def __handle(self, sock: HTcpSocket, addr):
+        try:
+            conn = HShmSocket.accept(sock, self.__handshake_timeout)
+        except (OSError, MessageError) as e:
+            self._onError(e)
+            event(logging.WARNING, "handshake_error", "shared memory handshake failed: %s", e, error=e)
+            sock.close()
+            return
+        conn.setMetrics(self._metrics)
+        conn.setRecvLimits(self._recv_limits)
+        event(logging.INFO, "connected", "connected: %s", addr, addr=addr)
+        self._onConnected(conn, addr)
+        try:
+            while conn.isValid():
+                try:
+                    msg = conn.recvMsg()
+                except OSError as e:
+                    self._onError(e)
+                    event(logging.INFO, "connection_error", "connection error: %s", addr, addr=addr, error=e)
+                    return
+                except MessageError as e:
+                    if not isinstance(e, EmptyMessageError):
+                        self._onError(e)
+                        event(logging.WARNING, "message_error", "message error: %s", addr, addr=addr, error=e)
+                    return
+                self._onMessageReceived(conn, msg)
+                conn.releaseRecv()
+        finally:
+            event(logging.INFO, "disconnected", "connection closed: %s", addr, addr=addr)
+            conn.close()
+            self._onDisconnected(conn, addr)
+
+
+class _RateCounter:
+    """线程安全的累计计数器, 同时统计最近一秒的速率"""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__total = 0
+        self.__window_start = time.monotonic()
+        self.__window_count = 0
+        self.__rate = 0.0
+
+    def add(self, n: int = 1):
+        with self.__lock:
+            self.__roll()
+            self.__total += n
+            self.__window_count += n
+
+    def total(self) -> int:
+        return self.__total
+
+    def rate(self) -> float:
+        """最近一个完整统计窗口内的每秒计数"""
+        with self.__lock:
+            self.__roll()
+            return self.__rate
+
+    def __roll(self):
+        now = time.monotonic()
+        elapsed = now - self.__window_start
+        if elapsed >= 1.0:
+            self.__rate = self.__window_count / elapsed if elapsed < 2.0 else 0.0
+            self.__window_start = now
+            self.__window_count = 0
+
+
 class HUdpServer:
     OnMsgRecvByOpCodeCallback = Callable[[Message, Optional[tuple]], bool]  # 返回False时会继续进行OnMessageReceivedCallback
     OnMessageReceivedCallback = Callable[[Message, Optional[tuple]], None]
@@ -392,35 +1236,203 @@ class HUdpServer:
     def __init__(self, addr):
         self._address = addr
         self.__udp_socket = HUdpSocket()
-
-        self.__onMsgRecvByOpCodeCallbackDict: dict[int, self.OnMsgRecvByOpCodeCallback] = {}
-        self.__onMessageReceivedCallback: Optional[self.OnMessageReceivedCallback] = None
+        self.__sockets: list[HUdpSocket] = [self.__udp_socket]
+        self.__socket_count = 1
+        self.__worker_count = 0
+        self.__worker_queue_size = 1024
+        self.__work_queue: Optional[queue.Queue] = None
+        self.__workers: list[threading.Thread] = []
+        self.__received = _RateCounter()
+        self.__dropped = _RateCounter()
+        self.__reliable: Optional[ReliableUdp] = None
+        self.__context = threading.local()  # 当前处理中的请求 (c_addr, 请求id)
+        self._metrics: Optional[Metrics] = None
+        self._profiler: Optional[Profiler] = None
+
+        self._router = Router()
 
     def socket(self) -> HUdpSocket:
         return self.__udp_socket
 
+    def set_reliable(self, enabled: bool = True):
+        """启用或关闭可靠udp模式, 对端也需启用可靠udp模式
+
+        启用后`sendto`发送的报文会被确认与重传, 收到的重复报文会被丢弃.
+        """
+        if self.__reliable is not None:
+            self.__reliable.close()
+        self.__reliable = ReliableUdp(self.__udp_socket) if enabled else None
+
+    def reliable(self) -> Optional[ReliableUdp]:
+        """获取可靠udp层, 未启用时返回None"""
+        return self.__reliable
+
+    def set_reuseport(self, socket_count: int):
+        """使用SO_REUSEPORT绑定多个套接字, 由内核将数据包分散到各个套接字, 每个套接字由一个线程接收
+
+        需在启动server前调用.
+
+        Raises:
+            ValueError: 平台不支持SO_REUSEPORT时抛出
+        """
+        if socket_count > 1 and not hasattr(socket, "SO_REUSEPORT"):
+            raise ValueError("SO_REUSEPORT is not supported on this platform")
+        self.__socket_count = max(1, socket_count)
+
+    def set_workers(self, worker_count: int, queue_size: int = 1024):
+        """设置处理报文的工作线程数, 为0时在接收线程中直接处理
+
+        需在启动server前调用. 工作队列(以批为单位)已满时新到达的报文会被丢弃并计入丢弃数.
+
+        Args:
+            worker_count (int): 工作线程数
+            queue_size (int): 工作队列容量
+        """
+        self.__worker_count = worker_count
+        self.__worker_queue_size = queue_size
+
+    def set_metrics(self, metrics: Optional[Metrics]):
+        """设置统计使用的Metrics, None表示关闭统计, 需在启动server前调用"""
+        if self._metrics is not None:
+            self._router.removeMiddleware(self._metrics.middleware)
+            for name in ("hsocket_udp_dropped_total", "hsocket_udp_work_queue", "hsocket_udp_unacked"):
+                self._metrics.setCollector(name, None)
+        self._metrics = metrics
+        for sock in self.__sockets:
+            sock.setMetrics(metrics)
+        if metrics is not None:
+            self._router.use(metrics.middleware)
+            metrics.setCollector("hsocket_udp_dropped_total", self.__dropped.total)
+            metrics.setCollector("hsocket_udp_work_queue",
+                                 lambda: self.__work_queue.qsize() if self.__work_queue is not None else 0)
+            metrics.setCollector("hsocket_udp_unacked",
+                                 lambda: self.__reliable.pending() if self.__reliable is not None else 0)
+
+    def set_profiler(self, profiler: Optional[Profiler]):
+        """设置分析回调耗时的Profiler, None表示关闭"""
+        if self._profiler is not None:
+            self._router.removeMiddleware(self._profiler.middleware)
+        self._profiler = profiler
+        if profiler is not None:
+            self._router.use(profiler.middleware)
+
+    def stats(self) -> dict[str, float]:
+        """获取接收统计
+
+        Returns:
+            dict[str, float]: received/dropped为累计数, received_per_sec/dropped_per_sec为最近一秒的速率
+        """
+        return {
+            "received": self.__received.total(),
+            "dropped": self.__dropped.total(),
+            "received_per_sec": self.__received.rate(),
+            "dropped_per_sec": self.__dropped.rate(),
+        }
+
     def startserver(self):
         """启动server"""
-        self.__udp_socket.bind(self._address)
-        while self.__udp_socket.isValid():
-            try:
-                msg, from_ = self.__udp_socket.recvMsg()
-                self._onMessageReceived(msg, from_)
-            except MessageError:
-                continue
+        for i in range(1, self.__socket_count):
+            sock = HUdpSocket()
+            sock.setMetrics(self._metrics)
+            self.__sockets.append(sock)
+        for sock in self.__sockets:
+            if self.__socket_count > 1:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if SocketConfig.udpSocketRecvBufferSize > 0:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SocketConfig.udpSocketRecvBufferSize)
+            sock.bind(self._address)
+        if self.__worker_count > 0:
+            self.__work_queue = queue.Queue(self.__worker_queue_size)
+            for i in range(self.__worker_count):
+                worker = threading.Thread(target=self.__work, daemon=True)
+                worker.start()
+                self.__workers.append(worker)
+        for sock in self.__sockets[1:]:
+            threading.Thread(target=self.__receive, args=(sock,), daemon=True).start()
+        self.__receive(self.__udp_socket)
 
     def closeserver(self):
         """关闭server"""
-        self.__udp_socket.close()
+        for sock in self.__sockets:
+            sock.close()
+        if self.__reliable is not None:
+            self.__reliable.close()
+        if self.__work_queue is not None:
+            for worker in self.__workers:
+                self.__work_queue.put(None)
+            self.__workers.clear()
+
+    def __receive(self, sock: HUdpSocket):
+        buffer = bytearray(65535)
+        work_queue = self.__work_queue
+        while sock.isValid():
+            try:
+                batch, errors = sock.recvMsgBatch(buffer, SocketConfig.udpRecvBatchSize)
+            except TimeoutError:
+                continue
+            except OSError:
+                if sock.isValid():
+                    raise
+                break  # closed by closeserver
+            self.__received.add(len(batch) + errors)
+            if errors:
+                self.__dropped.add(errors)
+            if not batch:
+                continue
+            if work_queue is None:
+                for msg, from_ in batch:
+                    self._onMessageReceived(msg, from_)
+            else:
+                try:
+                    work_queue.put_nowait(batch)
+                except queue.Full:
+                    self.__dropped.add(len(batch))
+
+    def __work(self):
+        while True:
+            batch = self.__work_queue.get()
+            if batch is None:
+                return
+            for msg, from_ in batch:
+                self._onMessageReceived(msg, from_)
 
     def sendto(self, msg: Message, c_addr):
         """向指定地址发送报文
 
+        在回调中处理HUdpReqResClient的请求时, 回调线程中第一个发往请求方的报文会作为该请求的响应.
+
         Args:
             msg (Message): 发送的报文
             c_addr (_type_): 客户端地址
         """
-        self.__udp_socket.sendMsg(msg, c_addr)
+        msg = self.__response(msg, c_addr)
+        if self.__reliable is not None:
+            self.__reliable.send(msg, c_addr)
+        else:
+            self.__udp_socket.sendMsg(msg, c_addr)
+
+    def sendto_many(self, items: Iterable[tuple[Message, tuple]]) -> int:
+        """批量发送报文, 同一报文对象只转换一次二进制流, 支持时使用UDP GSO合并发往同一地址的报文
+
+        Args:
+            items (Iterable[tuple[Message, tuple]]): (报文, 客户端地址)序列
+
+        Returns:
+            int: 全部发送成功的报文数, 可靠模式下为已提交的报文数
+        """
+        items = [(self.__response(msg, c_addr), c_addr) for msg, c_addr in items]
+        if self.__reliable is not None:
+            for msg, c_addr in items:
+                self.__reliable.send(msg, c_addr)
+            return len(items)
+        return self.__udp_socket.sendMsgBatch(items)
+
+    def __response(self, msg: Message, c_addr) -> Message:
+        request = getattr(self.__context, "request", None)
+        if request is not None and request[0] == c_addr:
+            self.__context.request = None
+            return _packIdMsg(BuiltInOpCode.UDP_RESPONSE, request[1], msg)
+        return msg
 
     def setOnMsgRecvByOpCodeCallback(self, opcode: int, callback: OnMessageReceivedCallback):
         """设置收到指定操作码报文时的回调
@@ -429,7 +1441,7 @@ class HUdpServer:
             opcode (int): 操作码
             callback (OnMessageReceivedCallback): 回调方法
         """
-        self.__onMsgRecvByOpCodeCallbackDict[opcode] = callback
+        self._router.setHandler(opcode, callback)
 
     def popOnMsgRecvByOpCodeCallback(self, opcode: int):
         """取消收到指定操作码报文时的回调
@@ -437,7 +1449,7 @@ class HUdpServer:
         Args:
             opcode (int): 操作码
         """
-        self.__onMsgRecvByOpCodeCallbackDict.pop(opcode)
+        self._router.popHandler(opcode)
 
     def setOnMessageReceivedCallback(self, callback: OnMessageReceivedCallback):
         """设置收到报文时的回调(调用晚于`SetOnMsgRecvByOpCodeCallback`设置的回调)
@@ -445,14 +1457,39 @@ class HUdpServer:
         Args:
             callback (OnMessageReceivedCallback): 回调方法
         """
-        self.__onMessageReceivedCallback = callback
+        self._router.setDefaultHandler(callback)
+
+    def route(self, opcode: int) -> Callable[[OnMsgRecvByOpCodeCallback], OnMsgRecvByOpCodeCallback]:
+        """以装饰器形式设置收到指定操作码报文时的回调, 等同于`setOnMsgRecvByOpCodeCallback`
+
+        Args:
+            opcode (int): 操作码
+        """
+        return self._router.route(opcode)
+
+    def use(self, middleware: Middleware):
+        """添加一个报文分发中间件, 按添加顺序由外向内执行
+
+        Args:
+            middleware (Middleware): 中间件工厂方法 `middleware(opcode, next_handler) -> handler`
+        """
+        self._router.use(middleware)
 
     def _onMessageReceived(self, msg: Message, c_addr: Optional[tuple]):
-        opcode = msg.opcode()
-        callback = self.__onMsgRecvByOpCodeCallbackDict.get(opcode)
-        if callback is not None:
-            finished = callback(msg, c_addr)
-            if finished:
+        if self.__reliable is not None:
+            msg = self.__reliable.receive(msg, c_addr)
+            if msg is None:
                 return
-        if self.__onMessageReceivedCallback:
-            self.__onMessageReceivedCallback(msg, c_addr)
+        if msg.opcode() != BuiltInOpCode.UDP_REQUEST:
+            self._router.handler(msg.opcode())(msg, c_addr)
+            return
+        try:
+            request_id, msg = _unpackIdMsg(msg)
+        except (MessageError, UnicodeDecodeError):
+            return
+        self.__context.request = (c_addr, request_id)
+        try:
+            self._router.handler(msg.opcode())(msg, c_addr)
+        finally:
+            self.__context.request = None
+
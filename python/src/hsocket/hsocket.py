@@ -1,14 +1,769 @@
 # -*- coding: utf-8 -*-
-from typing import Optional, Union, BinaryIO
+from typing import Optional, Union, BinaryIO, Callable, Iterable, Iterator
+from collections import deque, OrderedDict
+import threading
+import logging
+import itertools
+import struct
+import time
+import errno
+import selectors
 import socket
+import array
+import io
 import os
 from .message import *
+from .message import _isBuffer, _byteView
+from .metrics import Metrics
+from .log import event
 
 
 class SocketConfig:
     recvBufferSize = 1024
     fileBufferSize = 2048
     downloadDirectory = "download/"
+    sendQueueHighWatermark = 1 << 20  # 发送队列高水位(字节)
+    sendQueueLowWatermark = 1 << 18  # 发送队列低水位(字节)
+    sendQueueFlushTimeout = 1.0  # 主动关闭连接前等待发送队列清空的时间(秒)
+    udpRecvBatchSize = 64  # udp每次批量接收的最大报文数
+    udpSocketRecvBufferSize = 0  # udp套接字的SO_RCVBUF, 0表示使用系统默认值
+    udpMaxDatagramSize = 65507  # 超过该大小的udp报文会被分片发送, 可设为路径MTU对应的值(如1472)
+    udpReassemblyTimeout = 5.0  # 未收齐分片的报文的保留时间(秒)
+    udpReassemblyMemory = 64 << 20  # 每个套接字用于重组分片的最大内存(字节)
+    udpMaxFragments = 1 << 16  # 单个报文允许的最大分片数, 超过时丢弃分片
+    udpGso = True  # 批量发送时在支持UDP_SEGMENT的系统上使用UDP GSO
+    tcpZeroCopyThreshold = 4096  # 正文不小于该大小的BINARY/NDARRAY报文使用分散写(sendmsg)发送, 不与报头拼接复制
+    udsPassFd = True  # unix域套接字传输文件时通过SCM_RIGHTS传递文件描述符, 由接收方在本地复制文件
+    shmRingSize = 1 << 22  # 共享内存传输每个方向的环形缓冲区大小(字节)
+    shmSpinTime = 50e-6 if (os.cpu_count() or 1) > 1 else 0.0  # 共享内存传输的接收方睡眠前自旋等待的时间(秒), 单核时自旋只会拖慢对端
+    shmPollInterval = 0.05  # 共享内存传输的接收方睡眠时检查数据的最长间隔(秒), 兜底可能错过的唤醒
+    streamChunkSize = 1 << 16  # 发送流式正文时每个分块的大小(字节)
+    streamMaxChunkSize = 1 << 20  # 接收流式正文时允许的最大分块(字节), 超过时视为报头异常
+    streamReadTimeout = 30.0  # 在非阻塞套接字(selector服务端)上读取流式正文时等待数据的超时时间(秒)
+    maxMessageSize = 256 << 20  # 未设置RecvLimits时允许接收的最大正文(字节), 流式正文按累计长度计算
+
+
+def addressFamily(addr) -> int:
+    """根据地址推断地址族: 路径(str, bytes, PathLike)为AF_UNIX, 主机名含':'的(host, port, ...)为AF_INET6, 其余为AF_INET
+
+    Raises:
+        ValueError: 平台不支持AF_UNIX时抛出
+    """
+    if isinstance(addr, (str, bytes, os.PathLike)):
+        if not hasattr(socket, "AF_UNIX"):
+            raise ValueError("AF_UNIX is not supported on this platform")
+        return socket.AF_UNIX
+    if isinstance(addr[0], str) and ":" in addr[0]:
+        return socket.AF_INET6
+    return socket.AF_INET
+
+
+def _copyFileFd(src_fd: int, dst_fd: int, size: int) -> int:
+    """从src_fd的开头复制size字节到dst_fd, 优先使用copy_file_range在内核中复制, 返回复制的字节数"""
+    offset = 0
+    if hasattr(os, "copy_file_range"):
+        while offset < size:
+            try:
+                n = os.copy_file_range(src_fd, dst_fd, size - offset, offset, offset)
+            except OSError:  # 跨文件系统或不支持时逐块复制
+                break
+            if not n:
+                return offset
+            offset += n
+    while offset < size:
+        data = os.pread(src_fd, min(size - offset, 1 << 20), offset)
+        if not data:
+            break
+        offset += os.pwrite(dst_fd, data, offset)
+    return offset
+
+
+try:
+    _IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 1024
+_HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+
+def _snapshot(buffer):
+    """可能在发送前被调用方修改的缓冲区(bytearray、numpy数组、mmap及其上的视图)复制为bytes, bytes及其视图原样返回"""
+    if isinstance(buffer, bytes) or isinstance(memoryview(buffer).obj, bytes):
+        return buffer
+    return bytes(buffer)
+
+
+def _sendSome(sock: socket.socket, buffers: list) -> int:
+    """一次系统调用发送多段缓冲区, 返回发送的字节数"""
+    if len(buffers) == 1:
+        return sock.send(buffers[0])
+    if _HAS_SENDMSG:
+        return sock.sendmsg(buffers[:_IOV_MAX])
+    return sock.send(b"".join(buffers))
+
+
+def _advance(buffers: list, sent: int) -> list:
+    """去掉已发送的sent字节, 返回剩余的缓冲区"""
+    i = 0
+    while sent and sent >= len(buffers[i]):
+        sent -= len(buffers[i])
+        i += 1
+    buffers = buffers[i:]
+    if sent:
+        buffers[0] = buffers[0][sent:]
+    return buffers
+
+
+def _sendAll(sock: socket.socket, buffers: list):
+    """阻塞地发送多段缓冲区, 类似sendall但不拼接数据"""
+    if len(buffers) == 1 or not _HAS_SENDMSG:
+        sock.sendall(buffers[0] if len(buffers) == 1 else b"".join(buffers))
+        return
+    buffers = [memoryview(buf).cast("B") for buf in buffers]
+    while buffers:
+        buffers = _advance(buffers, sock.sendmsg(buffers[:_IOV_MAX]))
+
+
+_STREAM_CHUNK = struct.Struct("<I")  # 流式正文分块的长度
+_STREAM_END = 0  # 正文结束
+_STREAM_ABORT = 0xFFFFFFFF  # 发送方放弃发送, 正文不完整
+
+
+def _streamChunks(body, chunk_size: int) -> Iterator:
+    """将StreamMsg的body转换为非空分块的迭代器"""
+    if _isBuffer(body):
+        view = _byteView(body)
+        for i in range(0, len(view), chunk_size):
+            yield view[i:i + chunk_size]
+    elif hasattr(body, "read"):
+        while chunk := body.read(chunk_size):
+            yield chunk
+    else:
+        for chunk in body:
+            view = _byteView(chunk)
+            for i in range(0, len(view), chunk_size):  # 过大的分块再切分
+                yield view[i:i + chunk_size]
+
+
+class _StreamBody:
+    """流式正文的帧迭代器: 每次产生一个分块帧 [长度(4), 数据], 最后为结束帧
+
+    分块来源出错时以放弃帧结束, 异常保存在error中, 由发送方抛出.
+    """
+
+    def __init__(self, body, chunk_size: int):
+        self.__chunks = _streamChunks(body, chunk_size)
+        self.__ended = False
+        self.size = 0  # 已产生的字节数
+        self.error: Optional[BaseException] = None
+        self.done = False  # 由发送队列置位: 已全部写出或被丢弃
+        self.dropped = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> list:
+        if self.__ended:
+            raise StopIteration
+        try:
+            chunk = next(self.__chunks, None)
+        except Exception as e:
+            self.error = e
+            chunk = None
+        if chunk is None:
+            self.__ended = True
+            frame = [_STREAM_CHUNK.pack(_STREAM_ABORT if self.error is not None else _STREAM_END)]
+        else:
+            frame = [_STREAM_CHUNK.pack(len(chunk)), chunk]
+        self.size += sum(memoryview(buf).nbytes for buf in frame)
+        return frame
+
+
+class _WrittenMarker:
+    """发送队列中报文末尾的标记, 报文全部写出(True)或被丢弃(False)时调用回调"""
+
+    def __init__(self, callback: Callable[[bool], None]):
+        self.callback = callback
+
+
+class MessageStream(io.RawIOBase):
+    """收到的STREAM报文的正文, 在正文完整到达前即可按流(read/readinto)或按分块(chunks)读取
+
+    只在处理该报文期间有效: 接收下一个报文前会丢弃未读完的部分, 之后再读取将抛出ValueError.
+    读取时可能抛出OSError, EmptyMessageError(正文结束前连接关闭), StreamAbortedError(发送方放弃发送),
+    MessageHeaderError(分块超过SocketConfig.streamMaxChunkSize)与MessageTooLargeError(累计长度超过上限).
+    """
+
+    def __init__(self, recv_into: Callable[[memoryview], int], max_size: Optional[int] = None):
+        super().__init__()
+        self.__recv_into = recv_into  # 读取至少1字节, 连接关闭时返回0
+        self.__max_size = max_size  # 正文累计长度上限
+        self.__size = 0  # 已到达的分块的累计长度
+        self.__remaining = 0  # 当前分块未读的字节数
+        self.__eof = False
+        self.__discarded = False
+        self.__lock = threading.Lock()
+        self.onClose: Optional[Callable[[], None]] = None  # 关闭(含被丢弃)时调用
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        if self.onClose:
+            self.onClose()
+
+    def readinto(self, buffer) -> int:
+        with self.__lock:
+            self.__checkDiscarded()
+            if not self.__remaining and not self.__nextChunk():
+                return 0
+            view = memoryview(buffer).cast("B")[:self.__remaining]
+            n = self.__recvSome(view)
+            self.__remaining -= n
+            return n
+
+    def chunks(self) -> Iterator[bytearray]:
+        """按发送方的分块迭代剩余的正文, 每个分块不超过SocketConfig.streamMaxChunkSize"""
+        while True:
+            with self.__lock:
+                self.__checkDiscarded()
+                if not self.__remaining and not self.__nextChunk():
+                    return
+                chunk = bytearray(self.__remaining)
+                self.__readExactly(memoryview(chunk))
+                self.__remaining = 0
+            yield chunk
+
+    def discard(self):
+        """丢弃未读完的正文并关闭, 接收方在接收下一个报文前调用
+
+        Raises:
+            OSError: 套接字异常时抛出
+            MessageError: 连接关闭或分块异常时抛出, 此后连接上的数据流已无法解析
+        """
+        with self.__lock:
+            if self.__discarded:
+                return
+            self.__discarded = True
+            try:
+                scratch = memoryview(bytearray(SocketConfig.streamChunkSize))
+                while True:
+                    try:
+                        if not self.__remaining and not self.__nextChunk():
+                            break
+                    except StreamAbortedError:
+                        break
+                    self.__remaining -= self.__recvSome(scratch[:self.__remaining])
+            finally:
+                self.close()
+
+    def __checkDiscarded(self):
+        if self.__discarded:
+            raise ValueError("stream was discarded, it is only valid while handling its message")
+
+    def __nextChunk(self) -> bool:
+        if self.__eof:
+            return False
+        head = bytearray(_STREAM_CHUNK.size)
+        self.__readExactly(memoryview(head))
+        (length,) = _STREAM_CHUNK.unpack(head)
+        if length == _STREAM_END:
+            self.__eof = True
+            return False
+        if length == _STREAM_ABORT:
+            self.__eof = True
+            raise StreamAbortedError()
+        if length > SocketConfig.streamMaxChunkSize:
+            raise MessageHeaderError("stream chunk of {} bytes exceeds the limit".format(length))
+        self.__size += length
+        if self.__max_size is not None and self.__size > self.__max_size:
+            raise MessageTooLargeError("stream body exceeds {} bytes".format(self.__max_size))
+        self.__remaining = length
+        return True
+
+    def __readExactly(self, view: memoryview):
+        while view:
+            view = view[self.__recvSome(view):]
+
+    def __recvSome(self, view: memoryview) -> int:
+        n = self.__recv_into(view)
+        if not n:
+            raise EmptyMessageError()
+        return n
+
+
+class _BodyBuffer:
+    """随数据到达逐步增长的报文正文缓冲区
+
+    报头声明的长度来自对端, 缓冲区从min(长度, INITIAL_SIZE)开始写满后加倍, 不会为尚未到达的正文预先分配全部内存.
+    """
+    INITIAL_SIZE = 1 << 16
+
+    def __init__(self, size: int):
+        self.size = size
+        self.data = bytearray(min(size, self.INITIAL_SIZE))
+        self.received = 0
+
+    def done(self) -> bool:
+        return self.received >= self.size
+
+    def space(self) -> memoryview:
+        """下一次读取可写入的区域, 已写满时先扩大缓冲区. 扩大前需释放上次返回的视图"""
+        if self.received == len(self.data):
+            self.data.extend(bytes(min(self.size, 2 * len(self.data)) - len(self.data)))
+        return memoryview(self.data)[self.received:]
+
+    def readFrom(self, recv_into: Callable[[memoryview], int]) -> int:
+        """从recv_into读取一次, 返回读取的字节数"""
+        n = recv_into(self.space())
+        self.received += n
+        return n
+
+    def message(self, header: Header) -> Message:
+        """正文接收完毕后构造报文, BINARY/RECORD/NDARRAY的正文为缓冲区的只读memoryview"""
+        if header.contenttype in (ContentType.BINARY, ContentType.RECORD, ContentType.NDARRAY):
+            return Message.HeaderContent(header, memoryview(self.data).toreadonly())
+        elif self.data:
+            return Message.HeaderContent(header, str(self.data, "UTF-8"))
+        else:
+            return Message.HeaderContent(header, "")
+
+
+class RecvBudget:
+    """多个连接共享的接收内存预算(字节)
+
+    接收报文前按正文大小占用预算, 报文处理完毕后归还. 预算不足时停止读取该连接,
+    由tcp流量控制使对端减速. 单个报文超过总预算时占用全部预算, 以免永远无法接收.
+    """
+
+    def __init__(self, capacity: int):
+        self.__capacity = capacity
+        self.__used = 0
+        self.__cond = threading.Condition()
+        self.__listeners: list[Callable[[], None]] = []
+
+    def capacity(self) -> int:
+        return self.__capacity
+
+    def used(self) -> int:
+        return self.__used
+
+    def acquire(self, size: int, block: bool = True) -> int:
+        """占用预算, 预算不足时等待
+
+        Args:
+            size (int): 报文正文的字节数
+            block (bool): 为False时预算不足直接返回0
+
+        Returns:
+            int: 实际占用的字节数(不超过总预算), 需原样归还
+        """
+        size = min(size, self.__capacity)
+        with self.__cond:
+            if self.__used + size > self.__capacity:
+                if not block:
+                    return 0
+                self.__cond.wait_for(lambda: self.__used + size <= self.__capacity)
+            self.__used += size
+        return size
+
+    def release(self, size: int):
+        """归还acquire返回的字节数"""
+        with self.__cond:
+            self.__used -= size
+            self.__cond.notify_all()
+        for listener in self.__listeners:
+            listener()
+
+    def addListener(self, listener: Callable[[], None]):
+        """添加归还预算时调用的回调, 在归还的线程中执行"""
+        self.__listeners.append(listener)
+
+    def removeListener(self, listener: Callable[[], None]):
+        self.__listeners.remove(listener)
+
+
+class RecvLimits:
+    """接收报文的正文大小上限(可按操作码设置)及接收内存预算, 可由多个连接共享
+
+    正文超过上限的报文在报头到达时即被拒绝(MessageTooLargeError), 不会为其分配内存.
+    """
+
+    def __init__(self, max_size: Optional[int] = None, budget: Optional[RecvBudget] = None):
+        """RecvLimits
+
+        Args:
+            max_size (Optional[int]): 默认的正文上限(字节), None时使用SocketConfig.maxMessageSize
+            budget (Optional[RecvBudget]): 接收内存预算, None表示不限制
+        """
+        self.__max_size = max_size
+        self.__opcode_max_size: dict[int, int] = {}
+        self.budget = budget
+
+    def setMaxSize(self, size: Optional[int], opcode: Optional[int] = None):
+        """设置正文上限, opcode为None时设置默认值; size为None时恢复默认值"""
+        if opcode is None:
+            self.__max_size = size
+        elif size is None:
+            self.__opcode_max_size.pop(opcode, None)
+        else:
+            self.__opcode_max_size[opcode] = size
+
+    def maxSize(self, opcode: int) -> int:
+        size = self.__opcode_max_size.get(opcode)
+        if size is None:
+            size = self.__max_size if self.__max_size is not None else SocketConfig.maxMessageSize
+        return size
+
+
+class OverflowPolicy(IntEnum):
+    BLOCK = 0  # 阻塞发送方直至队列回落至低水位
+    DROP_OLDEST = 1  # 丢弃最早的待发送报文
+    DISCONNECT = 2  # 断开连接
+
+
+class SendQueue:
+    """连接的有界发送队列
+
+    待发送字节数超过高水位时按溢出策略处理, 超过高水位后回落至低水位时调用onDrain.
+    队列由唯一的写者线程(owner)写出: selector事件循环调用`writeSome`, 专用写线程调用`run`.
+    `run`每次将队列中积攒的所有报文以一次分散写写出, 多个生产者线程的小报文会被合并为较大的写入.
+    """
+
+    def __init__(self, sock: socket.socket, high_watermark: Optional[int] = None, low_watermark: Optional[int] = None,
+                 policy: OverflowPolicy = OverflowPolicy.BLOCK):
+        self.__sock = sock
+        self.__high = high_watermark if high_watermark is not None else SocketConfig.sendQueueHighWatermark
+        self.__low = low_watermark if low_watermark is not None else min(SocketConfig.sendQueueLowWatermark,
+                                                                          self.__high)
+        self.__policy = policy
+        # _StreamBody在到达队首时才逐帧展开, _WrittenMarker在到达队首时调用回调
+        self.__buffers: deque[Union[memoryview, _StreamBody, _WrittenMarker]] = deque()
+        self.__starts: deque[bool] = deque()  # 对应的缓冲区是否为一个报文的开头
+        self.__head_partial = False  # 队首报文是否已部分发送
+        self.__size = 0  # 队列中及正在发送的字节数
+        self.__above_high = False
+        self.__closed = False
+        self.__inflight: list[_WrittenMarker] = []  # run正在写出的报文的标记
+        self.__inflight_size = 0  # run正在写出的字节数, 已计入size但已不在队列中
+        self.__cond = threading.Condition()
+
+        self.owner: Optional[int] = None  # 写者线程的ident
+        self.onPut: Optional[Callable[[], None]] = None  # 队列由空变为非空时调用
+        self.onDrain: Optional[Callable[[], None]] = None
+        self.onOverflow: Optional[Callable[[], None]] = None  # 策略为DISCONNECT且溢出时调用
+
+    def size(self) -> int:
+        """待发送的字节数"""
+        return self.__size
+
+    def isClosed(self) -> bool:
+        return self.__closed
+
+    def put(self, data: bytes, block: bool = True, on_written: Optional[Callable[[bool], None]] = None) -> bool:
+        """将一段数据放入队列
+
+        Args:
+            data (bytes): 数据, 放入队列后不应再修改
+            block (bool): 为False时, 策略为BLOCK且溢出的情况下不等待, 直接放弃该数据
+            on_written (Optional[Callable[[bool], None]]): 同putBuffers
+
+        Returns:
+            bool: 是否成功放入队列, 队列已关闭、因溢出断开或放弃时返回False
+        """
+        return self.putBuffers([data], block, on_written)
+
+    def putBuffers(self, buffers: list, block: bool = True,
+                   on_written: Optional[Callable[[bool], None]] = None) -> bool:
+        """将组成一个报文的多段缓冲区放入队列, 写出时使用分散写而不拼接
+
+        Args:
+            buffers (list): 支持buffer协议的对象, 放入队列后不应再修改
+            block (bool): 为False时, 策略为BLOCK且溢出的情况下不等待, 直接放弃该报文
+            on_written (Optional[Callable[[bool], None]]): 报文全部写出(True)或未能写出(False)时调用一次,
+                可能在写者线程中持有队列锁时调用, 不应阻塞
+
+        Returns:
+            bool: 是否成功放入队列, 队列已关闭、因溢出断开或放弃时返回False
+        """
+        views = [memoryview(buf).cast("B") for buf in buffers]
+        length = sum(len(view) for view in views)
+        overflow = False
+        with self.__cond:
+            if self.__closed:
+                return self.__rejected(on_written)
+            if self.__size and self.__size + length > self.__high:
+                self.__above_high = True
+                match self.__policy:
+                    case OverflowPolicy.BLOCK if not block:
+                        return self.__rejected(on_written)
+                    case OverflowPolicy.BLOCK:
+                        if threading.get_ident() == self.owner:  # 写者线程无法等待自己, 直接写出
+                            self.__writeUntil(self.__low)
+                        else:
+                            self.__cond.wait_for(lambda: self.__size <= self.__low or self.__closed)
+                        if self.__closed:
+                            return self.__rejected(on_written)
+                    case OverflowPolicy.DROP_OLDEST:
+                        self.__dropUntil(self.__high - length)
+                    case _:
+                        overflow = True
+                        self.__closed = True
+                        self.__clear()
+                        self.__cond.notify_all()
+            if not overflow:
+                was_empty = not self.__buffers
+                for i, view in enumerate(views):
+                    self.__buffers.append(view)
+                    self.__starts.append(i == 0)
+                if on_written is not None:
+                    self.__buffers.append(_WrittenMarker(on_written))
+                    self.__starts.append(False)  # 与报文一同丢弃
+                self.__size += length
+                self.__cond.notify_all()
+        if overflow:
+            if self.onOverflow:
+                self.onOverflow()
+            return self.__rejected(on_written)
+        if was_empty and self.onPut:
+            self.onPut()
+        return True
+
+    def putStream(self, header: bytes, body: _StreamBody) -> bool:
+        """将报头与流式正文放入队列, 并阻塞直至正文全部写出
+
+        正文由写者在其到达队首时逐帧读取, 队列中最多只有一帧正文. 流式正文不受高水位限制, 也不会被部分丢弃.
+
+        Returns:
+            bool: 是否已全部写出, 队列已关闭或报文被丢弃时返回False
+        """
+        with self.__cond:
+            if self.__closed:
+                return False
+            was_empty = not self.__buffers
+            self.__buffers.append(memoryview(header))
+            self.__starts.append(True)
+            self.__buffers.append(body)
+            self.__starts.append(False)
+            self.__size += len(header) + 1  # 正文计为1字节, 写完前flush不会返回
+            self.__cond.notify_all()
+        if was_empty and self.onPut:
+            self.onPut()
+        with self.__cond:
+            if threading.get_ident() == self.owner:  # 写者线程无法等待自己, 直接写出
+                try:
+                    while not body.done and not self.__closed:
+                        self.__writeUntil(0)
+                except OSError:
+                    return False
+            else:
+                self.__cond.wait_for(lambda: body.done or self.__closed)
+            return body.done and not body.dropped
+
+    def writeSome(self) -> bool:
+        """非阻塞地尽可能写出队列中的数据
+
+        Raises:
+            OSError: 套接字异常时抛出
+
+        Returns:
+            bool: 队列是否已清空
+        """
+        with self.__cond:
+            while self.__buffers:
+                if isinstance(self.__buffers[0], _StreamBody):
+                    self.__expandStream()
+                    continue
+                if isinstance(self.__buffers[0], _WrittenMarker):
+                    self.__popMarker(True)
+                    continue
+                batch = list(itertools.islice(self.__pendingViews(), _IOV_MAX))
+                try:
+                    sent = _sendSome(self.__sock, batch)
+                except BlockingIOError:
+                    break
+                self.__size -= sent
+                self.__consume(sent)
+                if sent < sum(len(buf) for buf in batch):
+                    break
+            drained = self.__checkDrain()
+            empty = not self.__buffers
+            if empty:
+                self.__cond.notify_all()  # 唤醒等待flush的线程
+        if drained and self.onDrain:
+            self.onDrain()
+        return empty
+
+    def run(self):
+        """在专用写线程中阻塞地写出队列, 直至队列关闭或套接字异常"""
+        self.owner = threading.get_ident()
+        while True:
+            with self.__cond:
+                self.__cond.wait_for(lambda: self.__buffers or self.__closed)
+                if self.__closed:
+                    return
+                if isinstance(self.__buffers[0], _StreamBody):
+                    self.__expandStream()
+                    continue
+                buffers = []
+                markers = []
+                while self.__buffers and not isinstance(self.__buffers[0], _StreamBody):
+                    buf = self.__buffers.popleft()
+                    self.__starts.popleft()
+                    (markers if isinstance(buf, _WrittenMarker) else buffers).append(buf)
+                self.__inflight = markers
+                self.__inflight_size = sum(len(buf) for buf in buffers)
+            try:
+                _sendAll(self.__sock, buffers)  # 分散写, 合并为尽量少的系统调用
+            except OSError:
+                self.close()
+                return
+            with self.__cond:
+                if self.__inflight is markers:  # 写出期间未被close丢弃
+                    self.__inflight = []
+                    for marker in markers:
+                        marker.callback(True)
+                self.__size -= self.__inflight_size
+                self.__inflight_size = 0
+                drained = self.__checkDrain()
+                self.__cond.notify_all()
+            if drained and self.onDrain:
+                self.onDrain()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """阻塞直至队列清空
+
+        Returns:
+            bool: 队列是否已清空
+        """
+        with self.__cond:
+            if threading.get_ident() == self.owner:
+                try:
+                    self.__writeUntil(0, timeout)
+                except OSError:
+                    return False
+                return self.__size == 0
+            return self.__cond.wait_for(lambda: self.__size == 0 or self.__closed, timeout) and self.__size == 0
+
+    def close(self):
+        """关闭队列并丢弃未发送的数据, 唤醒所有阻塞的发送方"""
+        with self.__cond:
+            self.__closed = True
+            self.__clear()
+            self.__cond.notify_all()
+
+    def __writeUntil(self, limit: int, timeout: Optional[float] = None):
+        # 由写者线程调用, 阻塞地写出直至队列不超过limit
+        if self.__sock.fileno() == -1:
+            raise OSError("socket is closed")
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.__sock, selectors.EVENT_WRITE)
+            while self.__size > limit and self.__buffers:
+                if not selector.select(timeout):
+                    break
+                self.writeSome()
+
+    def __expandStream(self):
+        # 队首为流式正文时读取下一帧放在其前面, 正文结束时将其移出队列
+        body = self.__buffers[0]
+        frame = next(body, None)
+        if frame is None:
+            self.__buffers.popleft()
+            self.__starts.popleft()
+            self.__size -= 1
+            body.done = True
+            self.__cond.notify_all()
+            return
+        for buf in reversed(frame):
+            view = memoryview(buf).cast("B")
+            self.__buffers.appendleft(view)
+            self.__starts.appendleft(False)
+            self.__size += len(view)
+
+    def __pendingViews(self) -> Iterator[memoryview]:
+        # 队首起连续的待写出缓冲区(跳过标记, 止于流式正文)
+        for buf in self.__buffers:
+            if isinstance(buf, _StreamBody):
+                return
+            if not isinstance(buf, _WrittenMarker):
+                yield buf
+
+    def __popMarker(self, written: bool):
+        marker = self.__buffers.popleft()
+        self.__starts.popleft()
+        marker.callback(written)
+
+    def __consume(self, sent: int):
+        # 从队首去掉已发送的sent字节, 并调用已写完的报文的标记
+        while sent:
+            buf = self.__buffers[0]
+            if isinstance(buf, _WrittenMarker):
+                self.__popMarker(True)
+                continue
+            if sent < len(buf):
+                self.__buffers[0] = buf[sent:]
+                self.__head_partial = True
+                return
+            sent -= len(buf)
+            self.__buffers.popleft()
+            self.__starts.popleft()
+        while self.__buffers and isinstance(self.__buffers[0], _WrittenMarker):
+            self.__popMarker(True)
+        self.__head_partial = bool(self.__starts) and not self.__starts[0]
+
+    def __dropUntil(self, limit: int):
+        # 不能丢弃已部分发送的报文(含其后续缓冲区), 否则会破坏数据流.
+        # 正在写出的字节写完即会释放, 丢弃队列中的报文并不能使其更快释放, 因此不计入
+        limit += self.__inflight_size
+        keep = 0
+        if self.__head_partial:
+            keep = 1
+            while keep < len(self.__buffers) and not self.__starts[keep]:
+                keep += 1
+        while self.__size > limit and len(self.__buffers) > keep:
+            del self.__starts[keep]
+            self.__size -= self.__discard(self.__buffers[keep])
+            del self.__buffers[keep]
+            while len(self.__buffers) > keep and not self.__starts[keep]:  # 同一报文的后续缓冲区
+                del self.__starts[keep]
+                self.__size -= self.__discard(self.__buffers[keep])
+                del self.__buffers[keep]
+
+    def __discard(self, buf: Union[memoryview, _StreamBody, _WrittenMarker]) -> int:
+        # 丢弃一个缓冲区, 返回其计入size的字节数
+        if isinstance(buf, _StreamBody):
+            buf.done = buf.dropped = True
+            self.__cond.notify_all()
+            return 1
+        if isinstance(buf, _WrittenMarker):
+            buf.callback(False)
+            return 0
+        return len(buf)
+
+    def __clear(self):
+        for buf in itertools.chain(self.__inflight, self.__buffers):
+            if isinstance(buf, _StreamBody):
+                buf.done = buf.dropped = True
+            elif isinstance(buf, _WrittenMarker):
+                buf.callback(False)
+        self.__inflight = []
+        self.__buffers.clear()
+        self.__starts.clear()
+
+    @staticmethod
+    def __rejected(on_written: Optional[Callable[[bool], None]]) -> bool:
+        if on_written is not None:
+            on_written(False)
+        return False
+
+    def __checkDrain(self) -> bool:
+        if self.__above_high and self.__size <= self.__low:
+            self.__above_high = False
+            self.__cond.notify_all()
+            return True
+        return False
 
 
 class _HSocket(socket.socket):
@@ -23,6 +778,52 @@ class _HSocket(socket.socket):
 class HTcpSocket(_HSocket):
     def __init__(self, family=socket.AF_INET, fileno=None):
         super().__init__(family, socket.SOCK_STREAM, fileno=fileno)
+        self.__send_queue: Optional[SendQueue] = None
+        self.__metrics: Optional[Metrics] = None
+        self.__stream: Optional[MessageStream] = None  # 最近收到的STREAM报文的正文
+        self.__recv_limits: Optional[RecvLimits] = None
+        self.__budget_held = 0  # 最近收到的报文占用的接收预算
+        # tryRecvMsg的接收进度: 已到达的报头字节, 已解析的报头, 正文缓冲区, 是否在等待接收预算
+        self.__rx_head = bytearray()
+        self.__rx_header: Optional[Header] = None
+        self.__rx_body: Optional[_BodyBuffer] = None
+        self.__rx_waiting_budget = False
+
+    def setMetrics(self, metrics: Optional[Metrics]):
+        """设置统计收发报文的Metrics, None表示不统计"""
+        self.__metrics = metrics
+
+    def setSendQueue(self, queue: Optional[SendQueue]):
+        """设置发送队列, 设置后`sendMsg`只将报文放入队列, 由队列的写者负责写出"""
+        self.__send_queue = queue
+
+    def sendQueue(self) -> Optional[SendQueue]:
+        return self.__send_queue
+
+    def setRecvLimits(self, limits: Optional[RecvLimits]):
+        """设置接收报文的大小上限与接收内存预算, None时只按SocketConfig.maxMessageSize限制"""
+        self.__recv_limits = limits
+
+    def releaseRecv(self):
+        """归还最近收到的报文占用的接收预算, 处理完报文后调用. 接收下一个报文或关闭连接时也会归还"""
+        self.__releaseHeld()
+
+    def __releaseHeld(self):
+        if self.__budget_held:
+            held, self.__budget_held = self.__budget_held, 0
+            self.__recv_limits.budget.release(held)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """阻塞直至发送队列清空, 未设置发送队列时直接返回True"""
+        if self.__send_queue is None:
+            return True
+        return self.__send_queue.flush(timeout)
+
+    def close(self):
+        if self.__send_queue is not None:
+            self.__send_queue.close()
+        self.__releaseHeld()
+        super().close()
 
     def accept(self) -> tuple["HTcpSocket", tuple[str, int]]:
         # Paraphrased from socket.socket.accept()
@@ -32,41 +833,239 @@ class HTcpSocket(_HSocket):
             sock.setblocking(True)
         return sock, addr
 
-    def sendMsg(self, msg: Message):
+    def sendMsg(self, msg: Message, on_written: Optional[Callable[[bool], None]] = None, copy: bool = False):
         """发送一个数据包
 
         Args:
             msg (Message): 发送的文件
+            on_written (Optional[Callable[[bool], None]]): 同SendQueue.putBuffers, 未设置发送队列时发送后立即调用
+            copy (bool): 是否复制正文中可变的缓冲区. 正文较大时发送队列直接引用正文缓冲区,
+                为False时调用方在报文写出前不能修改它; 为True时返回后即可修改
+
+        Raises:
+            OSError: 套接字异常或发送队列已关闭时抛出
+            Exception: STREAM报文的正文读取出错时抛出(对端收到不完整的正文)
+        """
+        if msg.contenttype() == ContentType.STREAM:
+            sent = self.sendStream(msg.opcode(), msg.stream())
+            if on_written is not None:
+                on_written(sent)
+        elif msg.contenttype() in (ContentType.BINARY, ContentType.NDARRAY):
+            buffers = msg.toBuffers()
+            if sum(len(buffer) for buffer in buffers[1:]) >= SocketConfig.tcpZeroCopyThreshold:
+                if copy and self.__send_queue is not None:
+                    buffers = [_snapshot(buffer) for buffer in buffers]
+                sent = self.sendBuffers(buffers, on_written=on_written)  # 正文较大时不与报头拼接
+            else:
+                sent = self.sendBytes(b"".join(buffers), on_written=on_written)
+        else:
+            sent = self.sendBytes(msg.toBytes(), on_written=on_written)
+        if not sent:
+            raise ConnectionAbortedError("send queue is closed")
+
+    def sendBytes(self, data: bytes, block: bool = True,
+                  on_written: Optional[Callable[[bool], None]] = None) -> bool:
+        """发送已转换为二进制流的报文, 多个连接可共享同一段数据
+
+        Args:
+            data (bytes): 报文二进制流
+            block (bool): 发送队列溢出策略为BLOCK时是否等待, 不等待时放弃发送
+            on_written (Optional[Callable[[bool], None]]): 同SendQueue.putBuffers, 未设置发送队列时发送后立即调用
+
+        Raises:
+            OSError: 套接字异常时抛出
+
+        Returns:
+            bool: 是否已发送或放入发送队列
+        """
+        if self.__metrics is not None:
+            self.__metrics.messageSent(data)
+        if self.__send_queue is None:
+            self.sendall(data)
+            if on_written is not None:
+                on_written(True)
+            return True
+        return self.__send_queue.put(data, block, on_written)
+
+    def sendBuffers(self, buffers: list, block: bool = True,
+                    on_written: Optional[Callable[[bool], None]] = None) -> bool:
+        """以分散写发送由多段缓冲区(报头在第一段)组成的一个报文, 缓冲区不会被拼接复制
+
+        Args:
+            buffers (list): 支持buffer协议的对象(bytes, bytearray, memoryview, mmap等)
+            block (bool): 发送队列溢出策略为BLOCK时是否等待, 不等待时放弃发送
+            on_written (Optional[Callable[[bool], None]]): 同SendQueue.putBuffers, 未设置发送队列时发送后立即调用
 
         Raises:
             OSError: 套接字异常时抛出
+
+        Returns:
+            bool: 是否已发送或放入发送队列
         """
-        self.sendall(msg.toBytes())
+        if self.__metrics is not None:
+            self.__metrics.messageSent(buffers[0], sum(memoryview(buf).nbytes for buf in buffers))
+        if self.__send_queue is None:
+            _sendAll(self, buffers)
+            if on_written is not None:
+                on_written(True)
+            return True
+        return self.__send_queue.putBuffers(buffers, block, on_written)
+
+    def sendStream(self, opcode: int, body) -> bool:
+        """逐块读取并发送流式正文, 阻塞直至全部写出, 内存占用只与分块大小有关
+
+        设置了发送队列时正文由队列的写者读取, 期间该连接上其他报文排在其后.
+
+        Args:
+            opcode (int): 操作码
+            body: 同Message.StreamMsg
+
+        Raises:
+            OSError: 套接字异常时抛出
+            Exception: 正文读取出错时抛出, 此时对端会收到放弃发送的标记
+
+        Returns:
+            bool: 是否已全部发送, 发送队列已关闭或报文被丢弃时返回False
+        """
+        header = Header(ContentType.STREAM, opcode, 0).toBytes()
+        body = _StreamBody(body, SocketConfig.streamChunkSize)
+        if self.__send_queue is None:
+            _sendAll(self, [header])
+            for frame in body:
+                _sendAll(self, frame)
+            sent = True
+        else:
+            sent = self.__send_queue.putStream(header, body)
+        if body.error is not None:
+            raise body.error
+        if sent and self.__metrics is not None:
+            self.__metrics.messageSent(header, len(header) + body.size)
+        return sent
 
     def recvMsg(self) -> Message:
         """尝试接收一个数据包
 
+        BINARY报文的正文为接收缓冲区的只读memoryview(每个报文独立的缓冲区, 不复制、不解码), NDARRAY报文的数组为其上的只读视图.
+        STREAM报文在报头到达后即返回, 正文为从本套接字读取的MessageStream, 下次调用时丢弃其未读完的部分.
+
         Raises:
             TimeoutError: 阻塞模式下等待超时时抛出
             OSError: 套接字异常时抛出
-            EmptyMessageError: 收到空报文时抛出
+            EmptyMessageError: 收到空报文或正文未接收完时连接关闭时抛出
             MessageHeaderError: 报头解析异常时抛出
+            MessageTooLargeError: 正文超过上限时抛出, 此后连接上的数据流已无法解析
+            MessageSchemaError: RECORD正文不符合注册的格式时抛出
             UnicodeDecodeError: 报文内容编码异常时抛出
 
         Returns:
             Message: 收到的报文
         """
-        data = b""
+        if self.__stream is not None:
+            stream, self.__stream = self.__stream, None
+            stream.discard()
+        self.__releaseHeld()
         header = Header.fromBytes(self.recv(Header.HEADER_LENGTH))
-        size = header.length
-        while len(data) < size:  # 未接收完
-            recv_size = min(size - len(data), SocketConfig.recvBufferSize)
-            recv_data = self.recv(recv_size)
-            data += recv_data
-        if data:
-            return Message.HeaderContent(header, data.decode("UTF-8"))
-        else:
-            return Message.HeaderContent(header, "")
+        limits = self.__recv_limits
+        max_size = limits.maxSize(header.opcode) if limits is not None else SocketConfig.maxMessageSize
+        if header.contenttype == ContentType.STREAM:
+            if self.__metrics is not None:
+                self.__metrics.messageReceived(header.opcode, Header.HEADER_LENGTH)
+            self.__stream = MessageStream(self.__recvSome, max_size)
+            return Message.HeaderContent(header, self.__stream)
+        if header.length > max_size:  # 只凭报头拒绝, 不分配内存
+            raise MessageTooLargeError("message of {} bytes exceeds {} (opcode {})".format(
+                header.length, max_size, header.opcode))
+        if header.length and limits is not None and limits.budget is not None:
+            self.__budget_held = limits.budget.acquire(header.length)  # 预算不足时暂停读取
+        body = _BodyBuffer(header.length)
+        while not body.done():  # 未接收完, 直接写入报文缓冲区
+            if not body.readFrom(self.recv_into):
+                raise EmptyMessageError()
+        if self.__metrics is not None:
+            self.__metrics.messageReceived(header.opcode, Header.HEADER_LENGTH + header.length)
+        return body.message(header)
+
+    def tryRecvMsg(self) -> Optional[Message]:
+        """非阻塞地接收报文, 供事件循环在套接字可读时调用
+
+        每次调用只读取已到达的数据并保存接收进度, 报文完整到达后返回, 不会因报文分多次到达而阻塞或出错.
+        正文缓冲区随数据到达逐步增长. 接收预算不足时不读取正文, 此时`waitingRecvBudget`返回True,
+        应暂停读取该连接直至预算被归还. STREAM报文在报头到达后即返回, 正文需在处理期间读取.
+
+        Raises:
+            OSError: 套接字异常时抛出
+            EmptyMessageError: 对端关闭连接时抛出
+            MessageHeaderError: 报头解析异常时抛出
+            MessageTooLargeError: 正文超过上限时抛出, 此后连接上的数据流已无法解析
+            MessageSchemaError: RECORD正文不符合注册的格式时抛出
+            UnicodeDecodeError: 报文内容编码异常时抛出
+
+        Returns:
+            Optional[Message]: 收到的报文, 报文未完整到达或接收预算不足时返回None
+        """
+        limits = self.__recv_limits
+        if self.__rx_header is None:
+            if not self.__rx_head:  # 新的报文
+                if self.__stream is not None:
+                    stream, self.__stream = self.__stream, None
+                    stream.discard()
+                self.__releaseHeld()
+            try:
+                data = self.recv(Header.HEADER_LENGTH - len(self.__rx_head))
+            except BlockingIOError:
+                return None
+            if not data:
+                raise EmptyMessageError()
+            self.__rx_head += data
+            if len(self.__rx_head) < Header.HEADER_LENGTH:
+                return None
+            header = Header.fromBytes(bytes(self.__rx_head))
+            self.__rx_head.clear()
+            max_size = limits.maxSize(header.opcode) if limits is not None else SocketConfig.maxMessageSize
+            if header.contenttype == ContentType.STREAM:
+                if self.__metrics is not None:
+                    self.__metrics.messageReceived(header.opcode, Header.HEADER_LENGTH)
+                self.__stream = MessageStream(self.__recvSome, max_size)
+                return Message.HeaderContent(header, self.__stream)
+            if header.length > max_size:  # 只凭报头拒绝, 不分配内存
+                raise MessageTooLargeError("message of {} bytes exceeds {} (opcode {})".format(
+                    header.length, max_size, header.opcode))
+            self.__rx_header = header
+        header = self.__rx_header
+        if self.__rx_body is None:
+            if header.length and limits is not None and limits.budget is not None:
+                self.__budget_held = limits.budget.acquire(header.length, False)
+                self.__rx_waiting_budget = not self.__budget_held
+                if self.__rx_waiting_budget:  # 正文留在内核缓冲区, 由tcp流量控制使对端减速
+                    return None
+            self.__rx_body = _BodyBuffer(header.length)
+        body = self.__rx_body
+        while not body.done():
+            try:
+                n = body.readFrom(self.recv_into)
+            except BlockingIOError:
+                return None
+            if not n:
+                raise EmptyMessageError()
+        self.__rx_header = self.__rx_body = None
+        if self.__metrics is not None:
+            self.__metrics.messageReceived(header.opcode, Header.HEADER_LENGTH + header.length)
+        return body.message(header)
+
+    def waitingRecvBudget(self) -> bool:
+        """`tryRecvMsg`是否因接收预算不足而暂停"""
+        return self.__rx_waiting_budget
+
+    def __recvSome(self, view: memoryview) -> int:
+        # 供MessageStream读取, 非阻塞套接字上等待数据到达
+        try:
+            return self.recv_into(view)
+        except BlockingIOError:
+            with selectors.DefaultSelector() as selector:
+                selector.register(self, selectors.EVENT_READ)
+                if not selector.select(SocketConfig.streamReadTimeout):
+                    raise TimeoutError("timed out reading a stream body")
+            return self.recv_into(view)
 
     def sendFile(self, file: BinaryIO, filename: str):
         """发送一个文件
@@ -83,6 +1082,13 @@ class HTcpSocket(_HSocket):
         file.seek(0, os.SEEK_END)
         filesize = file.tell()
         file.seek(0, os.SEEK_SET)
+        fd = self.__passableFd(file)
+        if fd != -1:  # 只发送文件头与文件描述符, 由接收方复制文件内容
+            header = filename.encode("UTF-8") + b'\0' + filesize.to_bytes(4, 'little', signed=False)
+            sent = self.sendmsg([header], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [fd]))])
+            if sent < len(header):
+                self.sendall(header[sent:])
+            return
         # file header
         self.sendall(filename.encode("UTF-8"))  # filename
         self.sendall(b'\0')  # name end
@@ -95,7 +1101,7 @@ class HTcpSocket(_HSocket):
             self.sendall(data)
 
     def recvFile(self) -> str:
-        """尝试接收一个文件
+        """尝试接收一个文件, 对方通过unix域套接字传递了文件描述符时直接从该文件复制
 
         Raises:
             TimeoutError: 阻塞模式下等待超时时抛出
@@ -106,34 +1112,71 @@ class HTcpSocket(_HSocket):
             str: 成功接收的文件路径，若接收失败则返回空字符串
         """
         # filename
+        fds: list[int] = []
         filename_b: bytes = b""
-        while True:
-            char = self.recv(1)
-            if not char:  # empty data
-                return ""
-            elif char != b'\0':
-                filename_b += char
+        try:
+            char = self.__recvWithFds(fds)  # 文件描述符随文件头的第一个字节到达
+            while True:
+                if not char:  # empty data
+                    return ""
+                elif char != b'\0':
+                    filename_b += char
+                else:
+                    break
+                char = self.recv(1)
+            filename = filename_b.decode("UTF-8")
+            # filesize
+            filesize_b = self.recv(4)
+            filesize = int.from_bytes(filesize_b, 'little', signed=False)
+            # file content
+            if filename and filesize > 0:
+                if not os.path.exists(SocketConfig.downloadDirectory):
+                    os.makedirs(SocketConfig.downloadDirectory)
+                down_path = os.path.join(SocketConfig.downloadDirectory, filename)
+                total_recv_size = 0
+                with open(down_path, 'wb') as fp:
+                    if fds:
+                        total_recv_size = _copyFileFd(fds[0], fp.fileno(), filesize)
+                    else:
+                        while total_recv_size < filesize:
+                            recv_size = min(filesize - total_recv_size, SocketConfig.recvBufferSize)
+                            data = self.recv(recv_size)
+                            fp.write(data)
+                            total_recv_size += len(data)
+                if total_recv_size != filesize:  # 传递的文件在发送后被截断, 不保留不完整的文件
+                    event(logging.WARNING, "file_error", "file truncated: %s, %d of %d bytes", filename,
+                          total_recv_size, filesize, path=down_path)
+                    os.remove(down_path)
+                    return ""
+                return down_path
             else:
-                break
-        filename = filename_b.decode("UTF-8")
-        # filesize
-        filesize_b = self.recv(4)
-        filesize = int.from_bytes(filesize_b, 'little', signed=False)
-        # file content
-        if filename and filesize > 0:
-            if not os.path.exists(SocketConfig.downloadDirectory):
-                os.makedirs(SocketConfig.downloadDirectory)
-            down_path = os.path.join(SocketConfig.downloadDirectory, filename)
-            total_recv_size = 0
-            with open(down_path, 'wb') as fp:
-                while total_recv_size < filesize:
-                    recv_size = min(filesize - total_recv_size, SocketConfig.recvBufferSize)
-                    data = self.recv(recv_size)
-                    fp.write(data)
-                    total_recv_size += len(data)
-            return down_path
-        else:
-            return ""
+                return ""
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def __passableFd(self, file: BinaryIO) -> int:
+        # 可通过SCM_RIGHTS传递时返回文件描述符, 否则返回-1
+        if self.family != getattr(socket, "AF_UNIX", None) or not SocketConfig.udsPassFd \
+                or not hasattr(socket, "SCM_RIGHTS"):
+            return -1
+        try:
+            return file.fileno()
+        except (AttributeError, OSError, ValueError):  # 非真实文件(如BytesIO)时照常发送内容
+            return -1
+
+    def __recvWithFds(self, fds: list[int]) -> bytes:
+        # 接收1字节, 同时取出随之到达的文件描述符
+        if self.family != getattr(socket, "AF_UNIX", None) or not hasattr(socket, "SCM_RIGHTS"):
+            return self.recv(1)
+        itemsize = array.array("i").itemsize
+        data, ancdata, flags, addr = self.recvmsg(1, socket.CMSG_SPACE(4 * itemsize))
+        for level, type_, cdata in ancdata:
+            if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+                received = array.array("i")
+                received.frombytes(cdata[:len(cdata) - len(cdata) % itemsize])
+                fds.extend(received)
+        return data
 
     def sendFiles(self, path_list: BinaryIO, filename_list: str, succeed_path_list_out: list[str]):
         """发送多个文件
@@ -162,7 +1205,7 @@ class HTcpSocket(_HSocket):
             try:
                 fin = open(path, 'rb')
             except OSError as e:  # file error
-                print(e)
+                event(logging.WARNING, "file_error", "file error: %s", e, path=path)
                 continue
             with fin:
                 self.sendFile(fin, filename)
@@ -190,12 +1233,109 @@ class HTcpSocket(_HSocket):
                 download_path_list_out.append(path)
 
 
+class _Reassembler:
+    """udp分片重组缓冲区, 超时或超出内存上限时淘汰最早的未完成报文
+
+    分片数来自不可信的报头, 因此分片按序号存入字典而不按分片数预分配, 每个未完成报文及分片的固定开销也计入内存上限.
+    """
+    FRAGMENT_HEADER = struct.Struct("<III")  # 报文id, 分片序号, 分片数
+    PARTIAL_OVERHEAD = 512  # 每个未完成报文计入内存上限的固定开销(字节)
+    CHUNK_OVERHEAD = 128  # 每个分片计入内存上限的固定开销(字节)
+
+    class _Partial:
+        def __init__(self, count: int, now: float):
+            self.count = count
+            self.chunks: dict[int, bytes] = {}
+            self.size = _Reassembler.PARTIAL_OVERHEAD
+            self.created = now
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__partials: OrderedDict[tuple, _Reassembler._Partial] = OrderedDict()
+        self.__memory = 0
+
+    def feed(self, content: bytes, addr: tuple) -> Optional[bytes]:
+        """放入一个分片
+
+        Returns:
+            Optional[bytes]: 收齐所有分片时返回完整的报文二进制流, 否则返回None
+        """
+        header = self.FRAGMENT_HEADER
+        if len(content) < header.size:
+            return None
+        msg_id, index, count = header.unpack_from(content)
+        if index >= count or count > SocketConfig.udpMaxFragments:
+            return None
+        chunk = content[header.size:]
+        # 除最后一个分片外分片等长, 可据此估算报文大小, 放不进重组内存的报文无需缓存
+        if index < count - 1 and len(chunk) * (count - 1) > SocketConfig.udpReassemblyMemory:
+            return None
+        now = time.monotonic()
+        with self.__lock:
+            self.__evict(now)
+            key = (addr, msg_id)
+            partial = self.__partials.get(key)
+            if partial is None:
+                partial = self.__partials[key] = self._Partial(count, now)
+                self.__memory += partial.size
+            elif partial.count != count:
+                return None
+            if index in partial.chunks:  # 重复分片
+                return None
+            partial.chunks[index] = chunk
+            size = len(chunk) + self.CHUNK_OVERHEAD
+            partial.size += size
+            self.__memory += size
+            if len(partial.chunks) == count:
+                del self.__partials[key]
+                self.__memory -= partial.size
+                return b"".join(partial.chunks[i] for i in range(count))
+            while self.__memory > SocketConfig.udpReassemblyMemory and self.__partials:
+                self.__drop(next(iter(self.__partials)))
+            return None
+
+    def __evict(self, now: float):
+        while self.__partials:
+            key, partial = next(iter(self.__partials.items()))
+            if now - partial.created < SocketConfig.udpReassemblyTimeout:
+                break
+            self.__drop(key)
+
+    def __drop(self, key: tuple):
+        partial = self.__partials.pop(key)
+        self.__memory -= partial.size
+
+
 class HUdpSocket(_HSocket):
+    UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)  # linux/udp.h
+    GSO_MAX_SEGMENTS = 64  # UDP_MAX_SEGMENTS
+    GSO_MAX_BYTES = 65507  # 一次GSO发送的最大负载
+
     def __init__(self, family=socket.AF_INET, fileno=None):
         super().__init__(family, socket.SOCK_DGRAM, fileno=fileno)
+        self.__max_datagram_size = SocketConfig.udpMaxDatagramSize
+        self.__msg_ids = itertools.count()
+        self.__reassembler = _Reassembler()
+        self.__gso = (SocketConfig.udpGso and hasattr(socket, "SOL_UDP") and hasattr(self, "sendmsg")
+                      and family in (socket.AF_INET, socket.AF_INET6))
+        self.__metrics: Optional[Metrics] = None
+
+    def setMetrics(self, metrics: Optional[Metrics]):
+        """设置统计收发数据包的Metrics, None表示不统计"""
+        self.__metrics = metrics
+
+    def setMaxDatagramSize(self, size: int):
+        """设置单个数据报的最大长度, 超过该长度的报文会被分片发送
+
+        Raises:
+            ValueError: 长度不足以容纳分片报头时抛出
+        """
+        if size <= Header.HEADER_LENGTH + _Reassembler.FRAGMENT_HEADER.size:
+            raise ValueError("datagram size is too small")
+        self.__max_datagram_size = size
 
     def sendMsg(self, msg: "Message", address: tuple[str, int]) -> bool:
-        """发送一个数据包
+        """发送一个数据包, 超过最大数据报长度时分片发送
 
         Args:
             msg (Message): 发送的报文
@@ -204,11 +1344,97 @@ class HUdpSocket(_HSocket):
         Returns:
             bool: 数据是否全部发送
         """
-        data = msg.toBytes()
-        return self.sendto(data, address) == len(data)
+        return self.sendBytes(msg.toBytes(), address)
+
+    def sendBytes(self, data: bytes, address: tuple[str, int]) -> bool:
+        """发送已转换为二进制流的报文, 超过最大数据报长度时分片发送
+
+        Args:
+            data (bytes): 报文二进制流
+            address (tuple[str, int]): 目标地址
+
+        Returns:
+            bool: 数据是否全部发送
+        """
+        if self.__metrics is not None:
+            self.__metrics.messageSent(data)
+        if len(data) <= self.__max_datagram_size:
+            return self.sendto(data, address) == len(data)
+        header = _Reassembler.FRAGMENT_HEADER
+        chunk_size = self.__max_datagram_size - Header.HEADER_LENGTH - header.size
+        count = (len(data) + chunk_size - 1) // chunk_size
+        msg_id = next(self.__msg_ids) & 0xFFFFFFFF
+        view = memoryview(data)
+        success = True
+        for index in range(count):
+            chunk = view[index * chunk_size:(index + 1) * chunk_size]
+            fragment = (Header(ContentType.BINARY, BuiltInOpCode.UDP_FRAGMENT, header.size + len(chunk)).toBytes()
+                        + header.pack(msg_id, index, count) + chunk)
+            if self.sendto(fragment, address) != len(fragment):
+                success = False
+        return success
+
+    def sendMsgBatch(self, items: Iterable[tuple["Message", tuple[str, int]]]) -> int:
+        """批量发送数据包
+
+        同一个报文对象只转换一次二进制流. 支持UDP GSO时, 连续发往同一地址的等长数据包(最后一个可以更短)
+        通过一次sendmsg交由内核分段, 不支持时退化为逐个sendto. 超过最大数据报长度的报文分片发送.
+
+        Args:
+            items (Iterable[tuple[Message, tuple[str, int]]]): (报文, 目标地址)序列
+
+        Returns:
+            int: 全部发送成功的报文数
+        """
+        serialized: dict[int, tuple["Message", bytes]] = {}  # 同时持有报文对象, 避免其被回收后id被新对象复用
+        batch: list[bytes] = []  # 等待合并发送的数据包, 均发往batch_addr
+        batch_addr = None
+        batch_bytes = 0
+        sent = 0
+        for msg, address in items:
+            cached = serialized.get(id(msg))
+            if cached is None:
+                cached = serialized[id(msg)] = (msg, msg.toBytes())
+            data = cached[1]
+            if len(data) > self.__max_datagram_size:
+                sent += self.__sendBatch(batch, batch_addr)
+                batch = []
+                sent += self.sendBytes(data, address)
+                continue
+            if self.__metrics is not None:
+                self.__metrics.messageSent(data)
+            if batch and (not self.__gso or address != batch_addr or len(data) > len(batch[0])
+                          or len(batch[-1]) != len(batch[0]) or len(batch) >= self.GSO_MAX_SEGMENTS
+                          or batch_bytes + len(data) > self.GSO_MAX_BYTES):
+                sent += self.__sendBatch(batch, batch_addr)
+                batch = []
+            if not batch:
+                batch_addr = address
+                batch_bytes = 0
+            batch.append(data)
+            batch_bytes += len(data)
+        sent += self.__sendBatch(batch, batch_addr)
+        return sent
+
+    def __sendBatch(self, batch: list[bytes], address) -> int:
+        if len(batch) == 1 or (batch and not self.__gso):
+            return sum(self.sendto(data, address) == len(data) for data in batch)
+        if not batch:
+            return 0
+        total = sum(len(data) for data in batch)
+        try:
+            segment = struct.pack("H", len(batch[0]))
+            if self.sendmsg(batch, [(socket.SOL_UDP, self.UDP_SEGMENT, segment)], 0, address) == total:
+                return len(batch)
+            return 0
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOPROTOOPT, errno.EOPNOTSUPP, errno.EIO):
+                raise
+            self.__gso = False  # 内核或网卡不支持GSO
+            return self.__sendBatch(batch, address)
 
     def recvMsg(self) -> tuple[Message, tuple[str, int]]:
-        """接收一个数据包
+        """接收一个数据包, 收到分片时会继续接收直至重组出完整的报文
 
         Raises:
             TimeoutError: 阻塞模式下等待超时时抛出。
@@ -219,8 +1445,74 @@ class HUdpSocket(_HSocket):
         Returns:
             tuple[Message, tuple[str, int]]: 数据包，源地址
         """
+        while True:
+            try:
+                data, from_ = self.recvfrom(65535)
+            except ConnectionResetError:  # received an ICMP unreachable
+                raise EmptyMessageError()
+            msg = self.__reassemble(self.__parse(data), from_)
+            if msg is not None:
+                return msg, from_
+
+    def __parse(self, data) -> Message:
+        msg = Message.fromBytes(data)
+        if self.__metrics is not None:
+            self.__metrics.messageReceived(msg.opcode(), len(data))
+        return msg
+
+    def __reassemble(self, msg: Message, from_: tuple) -> Optional[Message]:
+        if msg.opcode() != BuiltInOpCode.UDP_FRAGMENT or msg.contenttype() != ContentType.BINARY:
+            return msg
+        data = self.__reassembler.feed(bytes(msg.content()), from_)  # 分片会被缓存, 不能引用接收缓冲区
+        return Message.fromBytes(data) if data is not None else None
+
+    def recvMsgBatch(self, buffer: bytearray, max_count: int) -> tuple[list[tuple[Message, tuple[str, int]]], int]:
+        """批量接收数据包, 阻塞至第一个数据包到达后非阻塞地取出已到达的数据包
+
+        所有数据包依次读入同一个可复用的缓冲区, 再按实际大小复制出来, 不会为每个数据包分配64KB的缓冲.
+        不支持MSG_DONTWAIT的平台上每次只接收一个数据包. 收齐分片的报文会被重组后返回.
+
+        Args:
+            buffer (bytearray): 接收缓冲区, 应不小于65535字节
+            max_count (int): 最多接收的数据包数
+
+        Raises:
+            TimeoutError: 阻塞模式下等待超时时抛出
+            OSError: 套接字异常时抛出
+
+        Returns:
+            tuple[list[tuple[Message, tuple[str, int]]], int]: (数据包, 源地址)列表, 无法解析的数据包数
+        """
+        msgs = []
+        errors = 0
+        view = memoryview(buffer)
+        flags = 0
+        dontwait = getattr(socket, "MSG_DONTWAIT", 0)
+        # 设置了超时时间的套接字在每次接收前都会等待可读, MSG_DONTWAIT不起作用, 第一个数据包之后临时改为非阻塞
+        timeout = self.gettimeout()
         try:
-            data, from_ = self.recvfrom(65535)
-        except ConnectionResetError:  # received an ICMP unreachable
-            raise EmptyMessageError()
-        return Message.fromBytes(data), from_
+            for i in range(max_count if dontwait else 1):
+                try:
+                    size, from_ = self.recvfrom_into(buffer, 0, flags)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except ConnectionResetError:  # received an ICMP unreachable
+                    errors += 1
+                    continue
+                if not flags and timeout:
+                    self.settimeout(0.0)
+                flags = dontwait
+                try:
+                    # 缓冲区会被下一个数据包覆盖, 报文不能引用它
+                    msg = self.__reassemble(self.__parse(bytes(view[:size])), from_)
+                except (MessageError, UnicodeDecodeError) as e:
+                    errors += 1
+                    if self.__metrics is not None:
+                        self.__metrics.error(e)
+                else:
+                    if msg is not None:
+                        msgs.append((msg, from_))
+        finally:
+            if timeout and self.isValid():
+                self.settimeout(timeout)
+        return msgs, errors
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""HSocket负载生成器
+
+    python -m hsocket.loadgen 127.0.0.1:40000 --protocol tcp-reqres -p 4 -c 16 --rate 20000 --duration 30 \\
+        --mix 1:binary:1024:3,2:json:64:1
+
+服务端需对每个请求回复一个报文(如回显). tcp-channel模式按连接内的顺序匹配响应.
+"""
+from typing import Optional
+from collections import deque
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import threading
+import time
+from .hclient import HTcpReqResClient, HTcpChannelClient, HUdpReqResClient
+from .message import Message, ContentType
+from .metrics import Histogram
+
+PROTOCOLS = ("tcp-reqres", "tcp-channel", "udp-reqres")
+LATENCY_BOUNDS = tuple(1e-6 * 1.05 ** i for i in range(370))  # 1us ~ 67s, 相对误差5%
+
+
+class MixEntry:
+    """报文组合中的一项: 操作码、内容类型、正文大小与权重"""
+
+    def __init__(self, opcode: int, contenttype: ContentType, size: int, weight: float = 1.0):
+        self.opcode = opcode
+        self.contenttype = contenttype
+        self.size = size
+        self.weight = weight
+
+    def __str__(self):
+        return "{}:{}:{}".format(self.opcode, self.contenttype.name.lower(), self.size)
+
+    def message(self) -> Message:
+        match self.contenttype:
+            case ContentType.HEADERONLY:
+                return Message.HeaderOnlyMsg(self.opcode)
+            case ContentType.PLAINTEXT:
+                return Message.PlainTextMsg(self.opcode, "x" * self.size)
+            case ContentType.JSONOBJRCT:
+                return Message.JsonMsg(self.opcode, data="x" * max(0, self.size - 12))
+            case _:
+                return Message.BinaryMsg(self.opcode, os.urandom(self.size))
+
+    @classmethod
+    def parse(cls, text: str) -> list["MixEntry"]:
+        """解析"opcode:type:size[:weight],..."格式的报文组合, type为headeronly/text/json/binary
+
+        Raises:
+            ValueError: 格式错误时抛出
+        """
+        types = {"headeronly": ContentType.HEADERONLY, "text": ContentType.PLAINTEXT,
+                 "json": ContentType.JSONOBJRCT, "binary": ContentType.BINARY}
+        entries = []
+        for item in text.split(","):
+            fields = item.strip().split(":")
+            if len(fields) not in (3, 4) or fields[1].lower() not in types:
+                raise ValueError("invalid mix entry: '{}'".format(item))
+            weight = float(fields[3]) if len(fields) == 4 else 1.0
+            entries.append(cls(int(fields[0]), types[fields[1].lower()], int(fields[2]), weight))
+        return entries
+
+
+class _Result:
+    """单个进程的统计, 可在进程间传递并合并"""
+
+    def __init__(self, mix: list[MixEntry]):
+        self.latency = Histogram(LATENCY_BOUNDS)
+        self.per_entry = [Histogram(LATENCY_BOUNDS) for entry in mix]
+        self.sent = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.max_latency = 0.0
+
+    def record(self, index: int, latency: float):
+        self.latency.observe(latency)
+        self.per_entry[index].observe(latency)
+        self.max_latency = max(self.max_latency, latency)
+
+    def merge(self, other: "_Result"):
+        self.latency.merge(other.latency)
+        for mine, theirs in zip(self.per_entry, other.per_entry):
+            mine.merge(theirs)
+        self.sent += other.sent
+        self.errors += other.errors
+        self.bytes_sent += other.bytes_sent
+        self.max_latency = max(self.max_latency, other.max_latency)
+
+
+class LoadGenerator:
+    """多进程负载生成器
+
+    每个进程建立若干连接, 每个连接按目标速率在固定的计划时刻发送请求(开环).
+    延迟从计划发送时刻而非实际发送时刻起算, 因此服务端变慢导致的发送推迟也会计入延迟(修正协调遗漏).
+    rate为0时为闭环压测, 每个连接收到响应后立即发送下一个请求.
+    """
+
+    def __init__(self, addr: tuple[str, int], protocol: str = "tcp-reqres", mix: Optional[list[MixEntry]] = None,
+                 processes: int = 1, connections: int = 1, rate: float = 0.0, duration: float = 10.0,
+                 warmup: float = 0.0, timeout: float = 5.0):
+        """LoadGenerator
+
+        Args:
+            addr (tuple[str, int]): 服务端地址
+            protocol (str): tcp-reqres / tcp-channel / udp-reqres
+            mix (Optional[list[MixEntry]]): 报文组合, 默认为操作码1的1KB BINARY报文
+            processes (int): 进程数
+            connections (int): 每个进程的连接数
+            rate (float): 所有连接合计的目标速率(报文/秒), 0表示闭环
+            duration (float): 统计时长(秒)
+            warmup (float): 开始统计前的预热时长(秒)
+            timeout (float): 等待响应的超时时间(秒)
+
+        Raises:
+            ValueError: 协议不支持时抛出
+        """
+        if protocol not in PROTOCOLS:
+            raise ValueError("unknown protocol: {}".format(protocol))
+        self.addr = addr
+        self.protocol = protocol
+        self.mix = mix or [MixEntry(1, ContentType.BINARY, 1024)]
+        self.processes = processes
+        self.connections = connections
+        self.rate = rate
+        self.duration = duration
+        self.warmup = warmup
+        self.timeout = timeout
+
+    def run(self) -> dict:
+        """运行负载并返回汇总结果"""
+        ctx = multiprocessing.get_context()
+        results = ctx.Queue()
+        start_at = time.time() + 1.0 + 0.05 * self.connections  # 留出进程启动与建立连接的时间
+        procs = [ctx.Process(target=self._worker, args=(i, start_at, results), daemon=True)
+                 for i in range(self.processes)]
+        for p in procs:
+            p.start()
+        total = _Result(self.mix)
+        for p in procs:
+            total.merge(results.get())
+        for p in procs:
+            p.join()
+        return self.report(total)
+
+    def report(self, result: _Result) -> dict:
+        def summary(hist: Histogram) -> dict:
+            return {
+                "count": hist.count,
+                "mean_ms": round(hist.sum / hist.count * 1e3, 3) if hist.count else 0.0,
+                "p50_ms": round(hist.quantile(0.50) * 1e3, 3),
+                "p90_ms": round(hist.quantile(0.90) * 1e3, 3),
+                "p99_ms": round(hist.quantile(0.99) * 1e3, 3),
+                "p999_ms": round(hist.quantile(0.999) * 1e3, 3),
+            }
+
+        report = {
+            "protocol": self.protocol,
+            "processes": self.processes,
+            "connections": self.processes * self.connections,
+            "target_rate": self.rate,
+            "duration": self.duration,
+            "sent": result.sent,
+            "completed": result.latency.count,
+            "errors": result.errors,
+            "throughput": round(result.latency.count / self.duration, 1),
+            "send_mbps": round(result.bytes_sent * 8 / self.duration / 1e6, 3),
+            "max_ms": round(result.max_latency * 1e3, 3),
+        }
+        report.update(summary(result.latency))
+        report["mix"] = {str(entry): summary(hist) for entry, hist in zip(self.mix, result.per_entry)}
+        return report
+
+    # ------------------------------------------------------------ 子进程
+
+    def _worker(self, index: int, start_at: float, results):
+        result = _Result(self.mix)
+        lock = threading.Lock()
+        drivers = [threading.Thread(target=self._drive, args=(index * self.connections + i, start_at, result, lock),
+                                    daemon=True) for i in range(self.connections)]
+        for t in drivers:
+            t.start()
+        for t in drivers:
+            t.join()
+        results.put(result)
+
+    def _drive(self, seed: int, start_at: float, result: _Result, lock: threading.Lock):
+        rng = random.Random(seed)
+        messages = [entry.message() for entry in self.mix]
+        payloads = [len(msg.toBytes()) for msg in messages]
+        weights = [entry.weight for entry in self.mix]
+        interval = self.processes * self.connections / self.rate if self.rate > 0 else 0.0
+        try:
+            client = self.__connect()
+        except OSError:
+            with lock:
+                result.errors += 1
+            return
+        # 各连接错开发送时刻, 避免同时突发
+        begin = time.perf_counter() + max(0.0, start_at - time.time()) + rng.random() * interval
+        record_from = begin + self.warmup
+        end = record_from + self.duration
+
+        def complete(i: int, intended: float, ok: bool):
+            now = time.perf_counter()
+            if intended < record_from:
+                return
+            with lock:
+                if ok:
+                    result.record(i, now - intended)
+                else:
+                    result.errors += 1
+
+        outstanding: deque[tuple[int, float]] = deque()  # 在途的请求, tcp-channel按顺序匹配响应
+
+        def settle(entry: tuple[int, float], ok: bool):
+            # udp-reqres的请求在接收线程中完成, 可能晚于等待结束
+            with lock:
+                try:
+                    outstanding.remove(entry)
+                except ValueError:  # 已在等待超时后计为错误
+                    return
+            complete(*entry, ok)
+
+        if self.protocol == "tcp-channel":
+            def onMessageReceived(msg: Message):
+                if outstanding:
+                    i, intended = outstanding.popleft()
+                    complete(i, intended, True)
+            client.setOnMessageReceivedCallback(onMessageReceived)
+
+        k = 0
+        while True:
+            intended = begin + k * interval
+            now = time.perf_counter()
+            if interval == 0:
+                intended = now
+            elif intended > now:
+                time.sleep(intended - now)
+            if intended >= end:
+                break
+            k += 1
+            i = rng.choices(range(len(messages)), weights)[0]
+            if intended >= record_from:
+                with lock:
+                    result.sent += 1
+                    result.bytes_sent += payloads[i]
+            match self.protocol:
+                case "tcp-reqres":
+                    response = client.request(messages[i])
+                    complete(i, intended, response is not None)
+                    if response is None:  # 超时或异常后连接已关闭, 重新建立连接
+                        try:
+                            client = self.__connect()
+                        except OSError:
+                            time.sleep(self.timeout)
+                case "tcp-channel":
+                    outstanding.append((i, intended))
+                    if not client.sendmsg(messages[i]):
+                        outstanding.pop()
+                        complete(i, intended, False)
+                case _:
+                    with lock:
+                        outstanding.append((i, intended))
+                    future = client.request_async(messages[i])
+                    future.add_done_callback(lambda f, entry=(i, intended): settle(entry, f.result() is not None))
+        # 等待在途的请求
+        deadline = time.perf_counter() + self.timeout
+        while outstanding and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        with lock:
+            result.errors += sum(1 for _, intended in outstanding if intended >= record_from)
+            outstanding.clear()
+        client.close()
+
+    def __connect(self):
+        match self.protocol:
+            case "tcp-reqres":
+                client = HTcpReqResClient()
+                client.settimeout(self.timeout)
+                client.connect(self.addr)
+            case "tcp-channel":
+                client = HTcpChannelClient()
+                client.connect(self.addr)
+            case _:
+                client = HUdpReqResClient(self.addr)
+                client.settimeout(self.timeout)
+                client.set_request_ids(True)
+        return client
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m hsocket.loadgen", description="HSocket load generator")
+    parser.add_argument("address", help="host:port")
+    parser.add_argument("--protocol", choices=PROTOCOLS, default="tcp-reqres")
+    parser.add_argument("-p", "--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("-c", "--connections", type=int, default=1, help="每个进程的连接数")
+    parser.add_argument("-r", "--rate", type=float, default=0.0, help="合计目标速率(报文/秒), 0表示闭环")
+    parser.add_argument("-d", "--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--timeout", type=float, default=5.0)
+    parser.add_argument("--mix", default="1:binary:1024", help="opcode:type:size[:weight],... type为headeronly/text/json/binary")
+    parser.add_argument("--output", default=None, help="结果JSON文件")
+    args = parser.parse_args(argv)
+
+    host, _, port = args.address.rpartition(":")
+    try:
+        mix = MixEntry.parse(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    generator = LoadGenerator((host or "127.0.0.1", int(port)), args.protocol, mix, args.processes, args.connections,
+                              args.rate, args.duration, args.warmup, args.timeout)
+    report = generator.run()
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
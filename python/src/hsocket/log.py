@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+from typing import Optional
+import logging
+import logging.handlers
+import threading
+import queue
+import time
+
+logger = logging.getLogger("hsocket")
+logger.addHandler(logging.NullHandler())  # 由使用方配置输出, 未配置时不输出
+
+
+def event(level: int, name: str, msg: str, *args, exc_info=None, **fields):
+    """记录一个结构化事件
+
+    事件名与字段会附加到LogRecord上(record.event, record.fields), 供Formatter或Handler使用.
+    日志级别未启用时直接返回, 不会格式化消息.
+
+    Args:
+        level (int): 日志级别
+        name (str): 事件名, 如"connected", 同时作为限流的键
+        msg (str): %格式的消息模板, 仅在输出时格式化
+        *args: 消息参数
+        **fields: 附加字段
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, msg, *args, exc_info=exc_info, extra={"event": name, "fields": fields})
+
+
+class RateLimitFilter(logging.Filter):
+    """按事件限流的过滤器(令牌桶)
+
+    每个事件每秒最多输出rate条, 允许burst条的突发. 被丢弃的条数会附加在该事件下一条输出的消息之后.
+    没有事件名的记录以消息模板作为键.
+    """
+
+    def __init__(self, rate: float = 10.0, burst: int = 50):
+        super().__init__()
+        self.__rate = rate
+        self.__burst = burst
+        self.__lock = threading.Lock()
+        self.__buckets: dict[str, list] = {}  # 键 -> [令牌数, 上次补充时间, 已丢弃数]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, "event", None) or str(record.msg)
+        now = time.monotonic()
+        with self.__lock:
+            bucket = self.__buckets.get(key)
+            if bucket is None:
+                bucket = self.__buckets[key] = [float(self.__burst), now, 0]
+            bucket[0] = min(self.__burst, bucket[0] + (now - bucket[1]) * self.__rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.msg = "{} ({} similar messages suppressed)".format(record.msg, suppressed)
+        return True
+
+
+rateLimitFilter = RateLimitFilter()
+logger.addFilter(rateLimitFilter)
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[logging.handlers.QueueHandler] = None
+
+
+def startAsyncLogging(*handlers: logging.Handler, queue_size: int = 10000) -> logging.handlers.QueueListener:
+    """将hsocket日志交由后台线程输出, 使I/O线程不会被日志输出阻塞
+
+    I/O线程只将记录放入有界队列, 队列已满时丢弃记录.
+
+    Args:
+        *handlers (logging.Handler): 实际输出日志的Handler, 为空时输出到stderr
+        queue_size (int): 队列容量
+
+    Returns:
+        QueueListener: 已启动的后台输出线程
+    """
+    global _listener, _queue_handler
+    stopAsyncLogging()
+    if not handlers:
+        handlers = (logging.StreamHandler(),)
+    q = queue.Queue(queue_size)
+    _queue_handler = _DroppingQueueHandler(q)
+    _listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+    _listener.start()
+    logger.addHandler(_queue_handler)
+    logger.propagate = False  # 避免上层logger的Handler在I/O线程中同步输出
+    return _listener
+
+
+def stopAsyncLogging():
+    """停止后台输出线程, 输出队列中剩余的记录"""
+    global _listener, _queue_handler
+    if _queue_handler is not None:
+        logger.removeHandler(_queue_handler)
+        logger.propagate = True
+        _queue_handler = None
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record  # 同进程队列无需序列化, 消息留给后台线程格式化
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
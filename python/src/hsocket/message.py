@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
-from typing import Optional, Union, Any, Self
+from abc import abstractmethod
+from typing import Optional, Union, Any, Self, Sequence, Iterator
 from enum import IntEnum
 import json
+import math
+import struct
+try:
+    import msgpack
+except ImportError:  # msgpack为可选依赖, 仅MsgpackSchema需要
+    msgpack = None
 
 
 class MessageError(Exception):
@@ -24,11 +31,42 @@ class MessageTypeError(MessageError):
     ...
 
 
+class MessageSchemaError(MessageError):
+    """Record does not match the schema registered for its opcode."""
+    ...
+
+
+class StreamAbortedError(MessageError):
+    """The sender aborted a streaming message body."""
+    ...
+
+
+class MessageTooLargeError(MessageError):
+    """Message body exceeds the configured maximum size."""
+    ...
+
+
 class ContentType(IntEnum):
     HEADERONLY = 0x1  # 只含报头
     PLAINTEXT = 0x2  # 纯文本内容
     JSONOBJRCT = 0x3  # JSON对象
     BINARY = 0x4  # 二进制串
+    RECORD = 0x5  # 按操作码注册格式的紧凑记录(struct定长记录或msgpack)
+    NDARRAY = 0x6  # numpy数组: 数组头(dtype、形状、分块位置) + 数组数据
+    STREAM = 0x7  # 流式正文: 报头长度为0, 之后为若干 长度(4) + 数据 的分块, 以长度为0的分块结束
+
+
+class BuiltInOpCode(IntEnum):
+    FT_TRANSFER_PORT = 60020  # 文件传输端口 {"port": port}, unix域套接字时为 {"path": path}
+    SUBSCRIBE = 60021  # 订阅主题 {"topic": topic}
+    UNSUBSCRIBE = 60022  # 取消订阅主题 {"topic": topic}
+    PUBLISH = 60023  # 发布报文 BINARY: 主题(UTF-8) + b"\0" + 报文二进制流
+    RUDP_DATA = 60024  # 可靠udp数据 BINARY: 会话号(4) + 序号(4) + 最小未确认序号(4) + 报文二进制流
+    RUDP_ACK = 60025  # 可靠udp确认 BINARY: 会话号(4) + 累计确认序号(4) + 选择确认序号(4 * n)
+    UDP_FRAGMENT = 60026  # udp分片 BINARY: 报文id(4) + 分片序号(4) + 分片数(4) + 分片数据
+    UDP_REQUEST = 60027  # udp请求 BINARY: 请求id(4) + 报文二进制流
+    UDP_RESPONSE = 60028  # udp响应 BINARY: 请求id(4) + 报文二进制流
+    SHM_HANDSHAKE = 60029  # 共享内存握手 {"c2s": 名称, "s2c": 名称}, 客户端映射后以HEADERONLY报文确认
 
 
 class Header:
@@ -65,19 +103,234 @@ class Header:
         return cls(contenttype, opcode, length)
 
 
+def _isBuffer(obj) -> bool:
+    """是否支持buffer协议(bytes, bytearray, memoryview, mmap等)"""
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return True
+    try:
+        memoryview(obj)
+    except TypeError:
+        return False
+    return True
+
+
+def _byteView(obj) -> memoryview:
+    """以字节为单位的只读视图, 不复制数据"""
+    view = memoryview(obj)
+    if view.format != "B" or view.ndim != 1:
+        view = view.cast("B")
+    return view.toreadonly()
+
+
+class Schema:
+    """RECORD报文的正文格式, 通过registerSchema按操作码注册"""
+
+    @abstractmethod
+    def pack(self, record: dict) -> bytes:
+        """记录转换为二进制流
+
+        Raises:
+            MessageSchemaError: 记录不符合格式时抛出
+        """
+        ...
+
+    @abstractmethod
+    def unpack(self, data) -> dict:
+        """二进制流转换为记录并校验
+
+        Raises:
+            MessageSchemaError: 数据不符合格式时抛出
+        """
+        ...
+
+
+class StructSchema(Schema):
+    """struct定长记录, 适用于字段固定的数值记录
+
+    StructSchema("<IHd", ("id", "kind", "value"))
+    """
+
+    def __init__(self, fmt: str, fields: Sequence[str]):
+        """StructSchema
+
+        Args:
+            fmt (str): struct格式串, 建议以"<"开头(小端、无对齐)
+            fields (Sequence[str]): 字段名, 与格式串中的项一一对应
+
+        Raises:
+            struct.error: 格式串无效时抛出
+            ValueError: 字段数与格式串不符时抛出
+        """
+        self.__struct = struct.Struct(fmt)
+        self.__fields = tuple(fields)
+        if len(self.__struct.unpack(bytes(self.__struct.size))) != len(self.__fields):
+            raise ValueError("number of fields does not match format '{}'".format(fmt))
+
+    @property
+    def size(self) -> int:
+        """记录长度(字节)"""
+        return self.__struct.size
+
+    @property
+    def fields(self) -> tuple[str, ...]:
+        return self.__fields
+
+    def pack(self, record: dict) -> bytes:
+        try:
+            return self.__struct.pack(*[record[field] for field in self.__fields])
+        except KeyError as e:
+            raise MessageSchemaError("missing field {}".format(e))
+        except struct.error as e:
+            raise MessageSchemaError(str(e))
+
+    def unpack(self, data) -> dict:
+        if len(data) != self.__struct.size:
+            raise MessageSchemaError("record length {} != {}".format(len(data), self.__struct.size))
+        return dict(zip(self.__fields, self.__struct.unpack(data)))
+
+
+class MsgpackSchema(Schema):
+    """msgpack编码的记录(map), 适用于字段可选或含变长字段的记录
+
+    MsgpackSchema({"id": int, "name": str, "score": (int, float)})
+    """
+
+    def __init__(self, fields: Optional[dict[str, Union[type, tuple[type, ...]]]] = None):
+        """MsgpackSchema
+
+        Args:
+            fields (Optional[dict[str, Union[type, tuple[type, ...]]]]): 必需字段及其类型, 为None时只要求正文为map
+
+        Raises:
+            ImportError: 未安装msgpack时抛出
+        """
+        if msgpack is None:
+            raise ImportError("MsgpackSchema requires msgpack")
+        self.__fields = dict(fields) if fields else {}
+
+    @property
+    def fields(self) -> dict[str, Union[type, tuple[type, ...]]]:
+        return self.__fields
+
+    def pack(self, record: dict) -> bytes:
+        self.__validate(record)
+        try:
+            return msgpack.packb(record, use_bin_type=True)
+        except (TypeError, ValueError, OverflowError) as e:
+            raise MessageSchemaError(str(e))
+
+    def unpack(self, data) -> dict:
+        try:
+            record = msgpack.unpackb(data, raw=False)
+        except (ValueError, TypeError, msgpack.UnpackException) as e:
+            raise MessageSchemaError(str(e))
+        self.__validate(record)
+        return record
+
+    def __validate(self, record):
+        if not isinstance(record, dict):
+            raise MessageSchemaError("record must be a map")
+        for field, types in self.__fields.items():
+            if field not in record:
+                raise MessageSchemaError("missing field '{}'".format(field))
+            if not isinstance(record[field], types):
+                raise MessageSchemaError("field '{}' has type {}".format(field, type(record[field]).__name__))
+
+
+_schemas: dict[int, Schema] = {}  # 操作码 -> RECORD正文格式
+
+
+def registerSchema(opcode: int, schema: Schema):
+    """为操作码注册RECORD报文的正文格式, 收发双方需注册相同的格式"""
+    _schemas[opcode] = schema
+
+
+def unregisterSchema(opcode: int):
+    _schemas.pop(opcode, None)
+
+
+def schemaOf(opcode: int) -> Schema:
+    """获取操作码对应的正文格式
+
+    Raises:
+        MessageSchemaError: 操作码未注册格式时抛出
+    """
+    schema = _schemas.get(opcode)
+    if schema is None:
+        raise MessageSchemaError("no schema registered for opcode {}".format(opcode))
+    return schema
+
+
+def _numpy():
+    """按需导入numpy(可选依赖)
+
+    Raises:
+        ImportError: 未安装numpy时抛出
+    """
+    import numpy
+    return numpy
+
+
+# NDARRAY正文的数组头: 标志(1) + 维数(1) + dtype长度(1) + dtype(numpy dtype.str, 含字节序)
+#   + 形状(8 * 维数) + 分块起始(8) + 分块长度(8), 按16字节补齐使数组数据对齐
+_ARRAY_HEAD = struct.Struct("<BBB")
+_ARRAY_FORTRAN = 0x1  # Fortran顺序, 分块沿最后一维; 否则为C顺序, 分块沿第一维
+_ARRAY_ALIGN = 16
+
+
+def _packArrayHeader(dtype: str, fortran: bool, shape: tuple[int, ...], start: int, count: int) -> bytes:
+    code = dtype.encode("ascii")
+    head = _ARRAY_HEAD.pack(_ARRAY_FORTRAN if fortran else 0, len(shape), len(code)) + code
+    head += struct.pack("<{}Q".format(len(shape) + 2), *shape, start, count)
+    return head + bytes(-len(head) % _ARRAY_ALIGN)
+
+
+def _unpackArrayHeader(view: memoryview) -> tuple[str, bool, tuple[int, ...], int, int, int]:
+    """解析数组头, 返回(dtype, fortran, 形状, 分块起始, 分块长度, 数据偏移)
+
+    Raises:
+        MessageTypeError: 数组头异常时抛出
+    """
+    try:
+        flags, ndim, size = _ARRAY_HEAD.unpack_from(view)
+        dtype = str(view[_ARRAY_HEAD.size:_ARRAY_HEAD.size + size], "ascii")
+        offset = _ARRAY_HEAD.size + size
+        *shape, start, count = struct.unpack_from("<{}Q".format(ndim + 2), view, offset)
+    except (struct.error, UnicodeDecodeError):
+        raise MessageTypeError("invalid NDARRAY header")
+    offset += 8 * (ndim + 2)
+    return dtype, bool(flags & _ARRAY_FORTRAN), tuple(shape), start, count, offset + -offset % _ARRAY_ALIGN
+
+
 class Message:
-    def __init__(self, contenttype: ContentType, opcode: int = 0, content: Union[str, bytes] = ""):
+    def __init__(self, contenttype: ContentType, opcode: int = 0, content: Union[str, bytes, memoryview] = ""):
         """Message
 
+        BINARY类型的正文可以是任意支持buffer协议的对象(bytes, bytearray, memoryview, mmap等), 发送时不会转换.
+        RECORD类型的正文为二进制流, 按操作码注册的格式解码并校验.
+        NDARRAY类型的正文为二进制流, 解码为其上的numpy数组视图(不复制).
+        STREAM类型的正文为流式正文(见StreamMsg), 接收时为hsocket.MessageStream.
+
         Raises:
             MessageTypeError: 当正文内容与类型不匹配时抛出
+            MessageSchemaError: RECORD正文不符合注册的格式时抛出
         """
         self.__contenttype: ContentType = contenttype  # 报文内容码
         self.__opcode: int = opcode  # 操作码
-        self.__content: Union[str, bytes] = ""
+        self.__content: Union[str, bytes, memoryview] = b"" if contenttype in (
+            ContentType.BINARY, ContentType.RECORD, ContentType.STREAM) else ""
         self.__json: Optional[dict] = None
-
-        if content:
+        self.__record: Optional[dict] = None
+        self.__array_fortran: bool = False  # NDARRAY是否为Fortran顺序(沿最后一维分块)
+        self.__array_shape: tuple[int, ...] = ()  # NDARRAY完整数组的形状
+        self.__array_start: int = 0  # NDARRAY分块的起始位置
+
+        if contenttype == ContentType.RECORD and _isBuffer(content):  # 空正文同样需要校验
+            self.__record = schemaOf(opcode).unpack(content)
+            self.__content = content
+        elif contenttype == ContentType.NDARRAY and _isBuffer(content):
+            self.__loadArray(_byteView(content))
+        elif content:
             match self.__contenttype:
                 case ContentType.HEADERONLY:
                     pass
@@ -86,13 +339,15 @@ class Message:
                 case ContentType.JSONOBJRCT if isinstance(content, str):
                     self.__content = content
                     self.__json = json.loads(content)
-                case ContentType.BINARY if isinstance(content, bytes):
+                case ContentType.BINARY if _isBuffer(content):
+                    self.__content = content
+                case ContentType.STREAM if not isinstance(content, str):
                     self.__content = content
                 case _:
                     raise MessageTypeError("content does not match ContentType")
 
     @classmethod
-    def HeaderContent(cls, header: Header, content: Union[str, bytes]) -> Self:
+    def HeaderContent(cls, header: Header, content: Union[str, bytes, memoryview]) -> Self:
         """由Header和正文内容组成Message"""
         return Message(header.contenttype, header.opcode, content)
 
@@ -127,33 +382,267 @@ class Message:
                 msg.__json[key] = kw[key]
         return msg
 
+    @classmethod
+    def RecordMsg(cls, opcode: int = 0, record: dict = None, **kw) -> Self:
+        """正文为紧凑记录的Message, 按操作码注册的格式立即编码
+
+        Args:
+            opcode (int): 操作码.
+            record (dict): 记录.
+            **kw: 自动转换为记录字段.
+
+        Raises:
+            MessageSchemaError: 操作码未注册格式或记录不符合格式时抛出
+        """
+        msg = Message(ContentType.RECORD, opcode)
+        msg.__record = dict(record) if record is not None else {}
+        for key in kw.keys():
+            if kw[key] is not None:
+                msg.__record[key] = kw[key]
+        msg.__content = schemaOf(opcode).pack(msg.__record)
+        return msg
+
+    @classmethod
+    def ArrayMsg(cls, opcode: int = 0, array=None) -> Self:
+        """正文为numpy数组的Message, 发送时直接使用数组的缓冲区(不复制)
+
+        非连续的数组会先复制为连续数组. 不支持对象、结构化等没有固定二进制表示的dtype.
+
+        Raises:
+            ImportError: 未安装numpy时抛出
+            MessageTypeError: dtype不支持时抛出
+        """
+        np = _numpy()
+        array = np.asarray(array)
+        if not (array.flags.c_contiguous or array.flags.f_contiguous):
+            array = np.ascontiguousarray(array)
+        fortran = array.ndim > 1 and not array.flags.c_contiguous
+        return cls.__arrayMsg(opcode, array, array.shape, fortran)
+
+    @classmethod
+    def ArrayChunks(cls, opcode: int = 0, array=None, chunk_size: int = 1 << 24) -> Iterator[Self]:
+        """将numpy数组沿第一维(Fortran顺序时为最后一维)切分为多个NDARRAY报文, 每个报文的正文约为chunk_size字节
+
+        各分块均为原数组的视图, 对np.memmap等大于内存的数组逐块读取. 接收端可按arraySlice()写入目标数组:
+            out[msg.arraySlice()] = msg.array()
+
+        Raises:
+            ImportError: 未安装numpy时抛出
+            MessageTypeError: dtype不支持时抛出
+        """
+        np = _numpy()
+        array = np.asarray(array)
+        if not (array.flags.c_contiguous or array.flags.f_contiguous):
+            array = np.ascontiguousarray(array)
+        if array.ndim == 0 or array.size == 0:
+            yield cls.ArrayMsg(opcode, array)
+            return
+        fortran = array.ndim > 1 and not array.flags.c_contiguous
+        axis = array.ndim - 1 if fortran else 0
+        step = max(1, chunk_size // (array.nbytes // array.shape[axis] or 1))
+        for start in range(0, array.shape[axis], step):
+            count = min(step, array.shape[axis] - start)
+            chunk = array[..., start:start + count] if fortran else array[start:start + count]
+            yield cls.__arrayMsg(opcode, chunk, array.shape, fortran, start)
+
+    @classmethod
+    def __arrayMsg(cls, opcode: int, array, shape: tuple[int, ...], fortran: bool, start: int = 0) -> Self:
+        if array.dtype.hasobject or array.dtype.fields is not None:
+            raise MessageTypeError("unsupported dtype {}".format(array.dtype))
+        msg = Message(ContentType.NDARRAY, opcode)
+        msg.__content = array
+        msg.__array_shape = tuple(shape)
+        msg.__array_start = start
+        msg.__array_fortran = fortran
+        return msg
+
+    def __loadArray(self, view: memoryview):
+        """解码NDARRAY正文为numpy数组视图
+
+        Raises:
+            MessageTypeError: 数组头异常、数据长度与形状不符或未安装numpy时抛出
+        """
+        dtype, fortran, shape, start, count, offset = _unpackArrayHeader(view)
+        try:
+            np = _numpy()
+        except ImportError:
+            raise MessageTypeError("numpy is required to decode NDARRAY messages")
+        try:
+            dtype = np.dtype(dtype)
+        except (TypeError, ValueError, SyntaxError):  # 非法的类型字符串可能抛出其中任意一种
+            raise MessageTypeError("unsupported dtype {}".format(dtype))
+        # 零长度类型无法由数据长度校验形状, 子数组类型会改变数组的维数
+        if dtype.hasobject or dtype.fields is not None or dtype.subdtype is not None or dtype.itemsize == 0:
+            raise MessageTypeError("unsupported dtype {}".format(dtype))
+        axis = len(shape) - 1 if fortran else 0
+        if shape:
+            if start + count > shape[axis]:
+                raise MessageTypeError("NDARRAY chunk out of range")
+            chunk = shape[:axis] + (count,) + shape[axis + 1:]
+        else:
+            chunk = ()
+        data = view[offset:]
+        if len(data) != dtype.itemsize * math.prod(chunk):
+            raise MessageTypeError("NDARRAY data does not match shape")
+        try:
+            self.__content = np.frombuffer(data, dtype).reshape(chunk, order="F" if fortran else "C")
+        except (TypeError, ValueError) as e:
+            raise MessageTypeError("invalid NDARRAY content: {}".format(e))
+        self.__array_shape = shape
+        self.__array_start = start
+        self.__array_fortran = fortran
+
+    def __arrayBuffers(self) -> list[Union[bytes, memoryview]]:
+        """NDARRAY正文的缓冲区: [数组头, 数组数据(数组缓冲区的字节视图)]"""
+        array = self.__content
+        count = array.shape[-1 if self.__array_fortran else 0] if array.ndim else 0
+        header = _packArrayHeader(array.dtype.str, self.__array_fortran, self.__array_shape, self.__array_start, count)
+        return [header, memoryview(array.ravel(order="K").view("u1"))]
+
+    @classmethod
+    def StreamMsg(cls, opcode: int = 0, body=b"") -> Self:
+        """正文为流式正文的Message, 发送时按SocketConfig.streamChunkSize逐块读取并发送, 不需要将正文全部放入内存
+
+        Args:
+            opcode (int): 操作码.
+            body: 可读的二进制文件对象(有read方法), 产生bytes类对象的可迭代对象, 或支持buffer协议的对象.
+                发送过程中读取或迭代出错时, 对端读取该报文将抛出StreamAbortedError.
+        """
+        msg = Message(ContentType.STREAM, opcode)
+        msg.__content = body
+        return msg
+
     @classmethod
     def BinaryMsg(cls, opcode: int = 0, content: bytes = b"") -> Self:
-        """正文为二进制(自定义解析方式)的Message"""
+        """正文为二进制(自定义解析方式)的Message, content可以是任意支持buffer协议的对象"""
         msg = Message(ContentType.BINARY, opcode)
         msg.__content = content
         return msg
 
     def get(self, key: str) -> Any:
-        """当正文为JSONOBJRCT类型时获取json值
+        """当正文为JSONOBJRCT或RECORD类型时获取字段值
 
         Args:
-            key (str): json键名
+            key (str): 字段名
 
         Raises:
-            MessageTypeError: 正文内容不为json时抛出
+            MessageTypeError: 正文内容不为json或记录时抛出
 
         Returns:
-            Any: json值
+            Any: 字段值, 不存在时为None
         """
         if self.__contenttype == ContentType.JSONOBJRCT:
             ret = self.__json.get(key)
             return ret
+        elif self.__contenttype == ContentType.RECORD:
+            return self.__record.get(key)
         else:
-            raise MessageTypeError("need a JSONOBJRCT message")
+            raise MessageTypeError("need a JSONOBJRCT or RECORD message")
 
-    def content(self) -> Union[str, bytes]:
-        """直接获取正文"""
+    def getInt(self, key: str, default: Optional[int] = None) -> Optional[int]:
+        """获取整数字段, 不存在时返回default
+
+        Raises:
+            MessageTypeError: 正文内容不为json或记录, 或字段不为整数时抛出
+        """
+        value = self.get(key)
+        if value is None:
+            return default
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise MessageTypeError("field '{}' is not an int".format(key))
+        return value
+
+    def getFloat(self, key: str, default: Optional[float] = None) -> Optional[float]:
+        """获取浮点数字段(整数会被转换), 不存在时返回default
+
+        Raises:
+            MessageTypeError: 正文内容不为json或记录, 或字段不为数值时抛出
+        """
+        value = self.get(key)
+        if value is None:
+            return default
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            raise MessageTypeError("field '{}' is not a number".format(key))
+        return float(value)
+
+    def getStr(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        """获取字符串字段, 不存在时返回default
+
+        Raises:
+            MessageTypeError: 正文内容不为json或记录, 或字段不为字符串时抛出
+        """
+        value = self.get(key)
+        if value is None:
+            return default
+        if not isinstance(value, str):
+            raise MessageTypeError("field '{}' is not a str".format(key))
+        return value
+
+    def getBytes(self, key: str, default: Optional[bytes] = None) -> Optional[bytes]:
+        """获取二进制字段(struct的s格式或msgpack的bin类型), 不存在时返回default
+
+        Raises:
+            MessageTypeError: 正文内容不为记录, 或字段不为二进制时抛出
+        """
+        value = self.get(key)
+        if value is None:
+            return default
+        if not isinstance(value, bytes):
+            raise MessageTypeError("field '{}' is not bytes".format(key))
+        return value
+
+    def stream(self):
+        """当正文为STREAM类型时获取正文: 收到的报文为hsocket.MessageStream, 发送的报文为StreamMsg传入的body
+
+        Raises:
+            MessageTypeError: 正文内容不为流式正文时抛出
+        """
+        if self.__contenttype != ContentType.STREAM:
+            raise MessageTypeError("need a STREAM message")
+        return self.__content
+
+    def record(self) -> dict:
+        """当正文为RECORD类型时获取解码后的记录(不应修改, 修改不影响发送的内容)
+
+        Raises:
+            MessageTypeError: 正文内容不为记录时抛出
+        """
+        if self.__contenttype != ContentType.RECORD:
+            raise MessageTypeError("need a RECORD message")
+        return self.__record
+
+    def array(self):
+        """当正文为NDARRAY类型时获取numpy数组
+
+        收到的数组为接收缓冲区上的视图(通过tcp收到时为只读), 分块报文只包含完整数组的一部分, 见arraySlice().
+
+        Raises:
+            MessageTypeError: 正文内容不为数组时抛出
+        """
+        if self.__contenttype != ContentType.NDARRAY:
+            raise MessageTypeError("need a NDARRAY message")
+        return self.__content
+
+    def arrayShape(self) -> tuple[int, ...]:
+        """当正文为NDARRAY类型时获取完整数组的形状"""
+        if self.__contenttype != ContentType.NDARRAY:
+            raise MessageTypeError("need a NDARRAY message")
+        return self.__array_shape
+
+    def arraySlice(self) -> tuple:
+        """当正文为NDARRAY类型时获取该分块在完整数组中的位置, 可直接用于索引"""
+        array = self.array()
+        if array.ndim == 0:
+            return ()
+        part = slice(self.__array_start, self.__array_start + array.shape[-1 if self.__array_fortran else 0])
+        return (Ellipsis, part) if self.__array_fortran else (part,)
+
+    def content(self) -> Union[str, bytes, memoryview]:
+        """直接获取正文
+
+        通过tcp收到的BINARY报文的正文为接收缓冲区的只读memoryview, 需要bytes时可调用bytes(content)复制.
+        NDARRAY报文的正文为numpy数组, 同array().
+        """
         return self.__content
 
     def contenttype(self) -> ContentType:
@@ -177,39 +666,66 @@ class Message:
                 content = self.__content.encode("UTF-8")
             case ContentType.JSONOBJRCT if isinstance(self.__content, str):
                 content = json.dumps(self.__json).encode("UTF-8")
-            case ContentType.BINARY if isinstance(self.__content, bytes):
+            case ContentType.BINARY | ContentType.RECORD if isinstance(self.__content, bytes):
                 content = self.__content
+            case ContentType.BINARY | ContentType.RECORD if _isBuffer(self.__content):
+                content = _byteView(self.__content)
+            case ContentType.NDARRAY:
+                content = b"".join(self.__arrayBuffers())
+            case ContentType.STREAM:
+                raise MessageTypeError("STREAM message can only be sent by HTcpSocket.sendMsg")
             case _:
                 raise MessageTypeError("content does not match ContentType")
         length = len(content)  # 数据包长度(不包含报头)
         header = Header(self.__contenttype, self.__opcode, length)
         return header.toBytes() + content
 
+    def toBuffers(self) -> list[Union[bytes, memoryview]]:
+        """转换为可用于分散写(sendmsg)的缓冲区列表, BINARY报文的正文与NDARRAY报文的数组数据不会被复制
+
+        Raises:
+            MessageTypeError: 当正文内容与类型不匹配时抛出
+        """
+        if self.__contenttype == ContentType.NDARRAY:
+            buffers = self.__arrayBuffers()
+            length = sum(len(buffer) for buffer in buffers)
+            return [Header(self.__contenttype, self.__opcode, length).toBytes(), *buffers]
+        if self.__contenttype != ContentType.BINARY:
+            return [self.toBytes()]
+        if not _isBuffer(self.__content):
+            raise MessageTypeError("content does not match ContentType")
+        content = _byteView(self.__content)
+        return [Header(self.__contenttype, self.__opcode, len(content)).toBytes(), content]
+
     @classmethod
     def fromBytes(cls, data: bytes) -> Self:
         """二进制流转换为Message
 
         Args:
-            data (bytes): _description_
+            data (bytes): 二进制流, 也可以是bytearray或memoryview
 
         Raises:
             EmptyMessageError: 收到空报文时抛出
             MessageHeaderError: 报头解析异常时抛出
+            MessageSchemaError: RECORD正文不符合注册的格式时抛出
             UnicodeDecodeError: 报文内容编码异常时抛出
 
         Returns:
             Self: _description_
         """
         header = Header.fromBytes(data[0:Header.HEADER_LENGTH])
-        if header.contenttype == ContentType.BINARY:
-            msg = Message.HeaderContent(header, data[Header.HEADER_LENGTH:])
+        if header.contenttype in (ContentType.BINARY, ContentType.RECORD, ContentType.NDARRAY):
+            # memoryview直接切片(不复制), 其余类型复制为bytes
+            content = data[Header.HEADER_LENGTH:]
+            msg = Message.HeaderContent(header, content if isinstance(content, memoryview) else bytes(content))
         else:
-            msg = Message.HeaderContent(header, data[Header.HEADER_LENGTH:].decode("UTF-8"))
+            msg = Message.HeaderContent(header, str(data[Header.HEADER_LENGTH:], "UTF-8"))
         return msg
 
     def __str__(self):
+        content = self.__record if self.__contenttype == ContentType.RECORD else self.__content
         return (f"<Message>({ContentType(self.__contenttype).name}) opcode:{self.__opcode}\n"
-                f"content:\n{self.__content}")
+                f"content:\n{content}")
 
     def __repr__(self):
         return str(self)
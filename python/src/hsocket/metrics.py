@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+from typing import Optional, Callable, Union
+from bisect import bisect_left
+import threading
+import time
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Histogram:
+    """固定分桶的直方图, 同分桶的直方图可以合并"""
+    DEFAULT_BOUNDS = tuple(1e-6 * 2 ** i for i in range(25))  # 1us ~ 16.7s
+
+    def __init__(self, bounds: Optional[tuple[float, ...]] = None):
+        self.bounds: tuple[float, ...] = bounds if bounds is not None else self.DEFAULT_BOUNDS
+        self.counts: list[int] = [0] * (len(self.bounds) + 1)  # 最后一个桶为+Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other: "Histogram"):
+        """合并另一个直方图
+
+        Raises:
+            ValueError: 分桶不同时抛出
+        """
+        if other.bounds != self.bounds:
+            raise ValueError("histogram bounds differ")
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q: float) -> float:
+        """估算分位数, 返回所在桶的上界, 落在+Inf桶时返回最大上界"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return self.bounds[min(i, len(self.bounds) - 1)]
+        return self.bounds[-1]
+
+    def copy(self) -> "Histogram":
+        h = Histogram(self.bounds)
+        h.merge(self)
+        return h
+
+
+class Metrics:
+    """服务端与客户端的统计
+
+    通过`set_metrics`交给server/client后开始统计, 未设置时各处只有一次None判断的开销.
+    处理耗时由路由中间件统计, 仅在启用时编译进处理链.
+
+    主要指标:
+        hsocket_messages_received_total / hsocket_bytes_received_total{opcode}: 收到的报文数/字节数
+        hsocket_messages_sent_total / hsocket_bytes_sent_total{opcode}: 发送的报文数/字节数
+        hsocket_handler_seconds{opcode}: 回调处理耗时直方图, 未注册操作码的报文记为opcode="default"
+        hsocket_accepted_total: 建立的连接数, hsocket_connections: 当前连接数
+        hsocket_send_queue_bytes: 所有连接发送队列中的字节数
+        hsocket_file_bytes_total / hsocket_file_seconds_total{direction}: 文件传输字节数/耗时
+        hsocket_errors_total{type}: 按异常类型统计的错误数
+        hsocket_endpoint_up / hsocket_endpoint_outstanding{endpoint}: HTcpBalancedClient各服务端是否可用/在途请求数
+    """
+    Collector = Callable[[], float]
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters: dict[tuple[str, Labels], float] = {}
+        self.__histograms: dict[tuple[str, Labels], Histogram] = {}
+        self.__collectors: dict[tuple[str, Labels], Metrics.Collector] = {}
+        self.__sent_keys: dict[int, tuple] = {}
+        self.__received_keys: dict[int, tuple] = {}
+
+    @staticmethod
+    def __key(name: str, labels: dict) -> tuple[str, Labels]:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """增加一个计数器"""
+        key = self.__key(name, labels)
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """向直方图中记录一个值"""
+        hist = self.__histogram(self.__key(name, labels))
+        with self.__lock:
+            hist.observe(value)
+
+    def setCollector(self, name: str, collector: Optional[Collector], **labels):
+        """设置读取时才计算的指标(如当前连接数), 名称以_total结尾的视为计数器, 否则视为仪表
+
+        Args:
+            name (str): 指标名
+            collector (Optional[Collector]): 返回当前值的方法, None表示移除
+        """
+        key = self.__key(name, labels)
+        with self.__lock:
+            if collector is None:
+                self.__collectors.pop(key, None)
+            else:
+                self.__collectors[key] = collector
+
+    def counter(self, name: str, **labels) -> float:
+        """读取计数器或collector的当前值, 不存在时返回0"""
+        key = self.__key(name, labels)
+        collector = self.__collectors.get(key)
+        if collector is not None:
+            return collector()
+        return self.__counters.get(key, 0)
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        """读取直方图的副本"""
+        hist = self.__histogram(self.__key(name, labels))
+        with self.__lock:
+            return hist.copy()
+
+    def snapshot(self) -> dict[str, dict[Labels, Union[float, Histogram]]]:
+        """读取所有指标
+
+        Returns:
+            dict[str, dict[Labels, Union[float, Histogram]]]: 指标名 -> {标签: 值或直方图副本}
+        """
+        result: dict[str, dict[Labels, Union[float, Histogram]]] = {}
+        with self.__lock:
+            for (name, labels), value in self.__counters.items():
+                result.setdefault(name, {})[labels] = value
+            for (name, labels), hist in self.__histograms.items():
+                result.setdefault(name, {})[labels] = hist.copy()
+            collectors = list(self.__collectors.items())
+        for (name, labels), collector in collectors:
+            result.setdefault(name, {})[labels] = collector()
+        return result
+
+    def reset(self):
+        """清空计数器与直方图"""
+        with self.__lock:
+            self.__counters.clear()
+            for hist in self.__histograms.values():
+                hist.counts = [0] * len(hist.counts)
+                hist.count = 0
+                hist.sum = 0.0
+
+    def toPrometheus(self) -> str:
+        """以Prometheus文本格式输出所有指标"""
+        lines = []
+        for name, series in sorted(self.snapshot().items()):
+            first = next(iter(series.values()))
+            if isinstance(first, Histogram):
+                lines.append("# TYPE {} histogram".format(name))
+                for labels, hist in series.items():
+                    cumulative = 0
+                    for bound, n in zip(hist.bounds + (float("inf"),), hist.counts):
+                        cumulative += n
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append("{}_bucket{} {}".format(name, _formatLabels(labels + (("le", le),)), cumulative))
+                    lines.append("{}_sum{} {}".format(name, _formatLabels(labels), hist.sum))
+                    lines.append("{}_count{} {}".format(name, _formatLabels(labels), hist.count))
+            else:
+                lines.append("# TYPE {} {}".format(name, "counter" if name.endswith("_total") else "gauge"))
+                for labels, value in series.items():
+                    lines.append("{}{} {}".format(name, _formatLabels(labels), value))
+        lines.append("")
+        return "\n".join(lines)
+
+    def serve(self, addr: tuple[str, int]):
+        """在后台线程中启动HTTP服务, 以Prometheus文本格式提供/metrics
+
+        Returns:
+            ThreadingHTTPServer: 已启动的HTTP服务, 调用shutdown()停止
+        """
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.toPrometheus().encode("UTF-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(addr, Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    # 以下方法由套接字、server与client调用
+
+    def messageSent(self, data: bytes, size: Optional[int] = None):
+        """记录一个已发送的报文二进制流
+
+        Args:
+            data (bytes): 报文二进制流, 分散写时可以只是报头
+            size (Optional[int]): 报文的总字节数, None表示len(data)
+        """
+        opcode = int.from_bytes(data[2:4], "little", signed=False)
+        keys = self.__sent_keys.get(opcode)
+        if keys is None:
+            keys = self.__sent_keys[opcode] = (("hsocket_messages_sent_total", (("opcode", str(opcode)),)),
+                                                ("hsocket_bytes_sent_total", (("opcode", str(opcode)),)))
+        self.__add(keys, len(data) if size is None else size)
+
+    def messageReceived(self, opcode: int, size: int):
+        """记录一个收到的报文
+
+        Args:
+            opcode (int): 操作码
+            size (int): 含报头的字节数
+        """
+        keys = self.__received_keys.get(opcode)
+        if keys is None:
+            keys = self.__received_keys[opcode] = (("hsocket_messages_received_total", (("opcode", str(opcode)),)),
+                                                    ("hsocket_bytes_received_total", (("opcode", str(opcode)),)))
+        self.__add(keys, size)
+
+    def error(self, e: BaseException):
+        """按异常类型记录一个错误"""
+        self.inc("hsocket_errors_total", type=type(e).__name__)
+
+    def fileTransferred(self, direction: str, size: int, seconds: float):
+        """记录一次文件传输
+
+        Args:
+            direction (str): "send" 或 "recv"
+            size (int): 传输的字节数
+            seconds (float): 耗时
+        """
+        self.inc("hsocket_files_total", direction=direction)
+        self.inc("hsocket_file_bytes_total", size, direction=direction)
+        self.inc("hsocket_file_seconds_total", seconds, direction=direction)
+
+    def middleware(self, opcode: Optional[int], next_handler: Callable) -> Callable:
+        """统计回调处理耗时的路由中间件"""
+        hist = self.__histogram(("hsocket_handler_seconds", (("opcode", "default" if opcode is None else str(opcode)),)))
+        lock = self.__lock
+        perf_counter = time.perf_counter
+
+        def handler(*args):
+            start = perf_counter()
+            try:
+                return next_handler(*args)
+            finally:
+                elapsed = perf_counter() - start
+                with lock:
+                    hist.observe(elapsed)
+        return handler
+
+    def __add(self, keys: tuple, size: int):
+        msgs_key, bytes_key = keys
+        counters = self.__counters
+        with self.__lock:
+            counters[msgs_key] = counters.get(msgs_key, 0) + 1
+            counters[bytes_key] = counters.get(bytes_key, 0) + size
+
+    def __histogram(self, key: tuple[str, Labels]) -> Histogram:
+        hist = self.__histograms.get(key)
+        if hist is None:
+            with self.__lock:
+                hist = self.__histograms.setdefault(key, Histogram())
+        return hist
+
+
+def _formatLabels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                          for k, v in labels) + "}"
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+from typing import Optional, Callable, Iterable
+import cProfile
+import pstats
+import logging
+import random
+import threading
+import time
+from .message import Message
+from .log import event
+
+
+class Profiler:
+    """按操作码分析回调耗时的路由中间件
+
+    通过`set_profiler`交给server/client后生效, 未设置时不会出现在处理链中.
+    支持处理前后的回调、按采样率对回调进行cProfile分析(按操作码累计)以及慢回调日志.
+    同一时刻只有一个回调被cProfile采样, 其余回调照常执行而不采样.
+    """
+    OnBeforeHandleCallback = Callable[[int], None]  # (opcode)
+    OnAfterHandleCallback = Callable[[int, float, Optional[BaseException]], None]  # (opcode, 耗时, 异常)
+
+    def __init__(self, slow_threshold: Optional[float] = None, sample_rate: float = 0.0,
+                 opcodes: Optional[Iterable[int]] = None):
+        """Profiler
+
+        Args:
+            slow_threshold (Optional[float]): 回调耗时超过该值(秒)时记录warning日志, None表示不记录
+            sample_rate (float): 回调被cProfile采样的概率, 0表示不采样
+            opcodes (Optional[Iterable[int]]): 只采样这些操作码, None表示所有操作码
+        """
+        self.__slow_threshold = slow_threshold
+        self.__sample_rate = sample_rate
+        self.__opcodes: Optional[frozenset[int]] = frozenset(opcodes) if opcodes is not None else None
+        self.__sample_lock = threading.Lock()  # 同一时刻只能有一个cProfile采样
+        self.__stats_lock = threading.Lock()
+        self.__stats: dict[int, pstats.Stats] = {}
+        self.__samples: dict[int, int] = {}
+
+        self.__onBeforeHandleCallback: Optional[Profiler.OnBeforeHandleCallback] = None
+        self.__onAfterHandleCallback: Optional[Profiler.OnAfterHandleCallback] = None
+
+    def setOnBeforeHandleCallback(self, callback: Optional[OnBeforeHandleCallback]):
+        """设置回调执行前的回调"""
+        self.__onBeforeHandleCallback = callback
+
+    def setOnAfterHandleCallback(self, callback: Optional[OnAfterHandleCallback]):
+        """设置回调执行后的回调, 回调抛出异常时也会调用"""
+        self.__onAfterHandleCallback = callback
+
+    def setSlowThreshold(self, seconds: Optional[float]):
+        """设置慢回调阈值(秒), None表示不记录"""
+        self.__slow_threshold = seconds
+
+    def setSampleRate(self, sample_rate: float, opcodes: Optional[Iterable[int]] = None):
+        """设置cProfile采样率及采样的操作码"""
+        self.__sample_rate = sample_rate
+        self.__opcodes = frozenset(opcodes) if opcodes is not None else None
+
+    def stats(self, opcode: int) -> Optional[pstats.Stats]:
+        """获取某操作码累计的cProfile统计, 尚无采样时返回None"""
+        with self.__stats_lock:
+            return self.__stats.get(opcode)
+
+    def samples(self) -> dict[int, int]:
+        """各操作码已采样的次数"""
+        with self.__stats_lock:
+            return dict(self.__samples)
+
+    def printStats(self, opcode: int, sort: str = "cumulative", limit: int = 20):
+        """打印某操作码累计的cProfile统计"""
+        stats = self.stats(opcode)
+        if stats is not None:
+            stats.sort_stats(sort).print_stats(limit)
+
+    def reset(self):
+        """清空累计的cProfile统计"""
+        with self.__stats_lock:
+            self.__stats.clear()
+            self.__samples.clear()
+
+    def middleware(self, opcode: Optional[int], next_handler: Callable) -> Callable:
+        """路由中间件, opcode为None(默认处理链)时从参数中的报文取得操作码"""
+        perf_counter = time.perf_counter
+
+        def handler(*args):
+            op = opcode
+            if op is None:
+                op = next((arg.opcode() for arg in args if isinstance(arg, Message)), -1)
+            before = self.__onBeforeHandleCallback
+            if before is not None:
+                before(op)
+            profile = self.__startSample(op)
+            error = None
+            start = perf_counter()
+            try:
+                return next_handler(*args)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                elapsed = perf_counter() - start
+                if profile is not None:
+                    self.__stopSample(op, profile)
+                threshold = self.__slow_threshold
+                if threshold is not None and elapsed >= threshold:
+                    event(logging.WARNING, "slow_handler", "slow handler: opcode %s took %.3fs", op, elapsed,
+                          opcode=op, seconds=elapsed)
+                after = self.__onAfterHandleCallback
+                if after is not None:
+                    after(op, elapsed, error)
+        return handler
+
+    def __startSample(self, opcode: int) -> Optional[cProfile.Profile]:
+        rate = self.__sample_rate
+        if rate <= 0 or (self.__opcodes is not None and opcode not in self.__opcodes) or random.random() >= rate:
+            return None
+        if not self.__sample_lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # 已有其他分析工具在运行
+            self.__sample_lock.release()
+            return None
+        return profile
+
+    def __stopSample(self, opcode: int, profile: cProfile.Profile):
+        profile.disable()
+        self.__sample_lock.release()
+        with self.__stats_lock:
+            stats = self.__stats.get(opcode)
+            if stats is None:
+                self.__stats[opcode] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            self.__samples[opcode] = self.__samples.get(opcode, 0) + 1
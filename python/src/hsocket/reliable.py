@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+from typing import Optional, Callable
+import threading
+import struct
+import random
+import time
+from .hsocket import HUdpSocket
+from .message import *
+
+_SEQ_MASK = 0xFFFFFFFF
+_DATA_HEADER = struct.Struct("<III")  # 发送方会话号, 序号, 最小未确认序号
+_ACK_HEADER = struct.Struct("<II")  # 被确认的会话号, 累计确认序号
+_SEQ = struct.Struct("<I")
+
+
+def _seq_lt(a: int, b: int) -> bool:
+    """考虑回绕的序号比较 a < b"""
+    return a != b and ((b - a) & _SEQ_MASK) < 0x80000000
+
+
+class _Pending:
+    def __init__(self, seq: int, msg: Message, data: bytes, now: float, rto: float):
+        self.seq = seq
+        self.msg = msg
+        self.data = data
+        self.first_sent = now
+        self.deadline = now + rto
+        self.retries = 0
+
+
+class _Peer:
+    def __init__(self, rto: float, now: float):
+        self.last_active = now
+        # 发送方
+        self.next_seq = 0
+        self.unacked: dict[int, _Pending] = {}
+        self.srtt: Optional[float] = None
+        self.rttvar = 0.0
+        self.rto = rto
+        # 接收方
+        self.epoch: Optional[int] = None  # 对端的会话号
+        self.cum: int = _SEQ_MASK  # 已连续收到的最大序号, 初始为-1
+        self.received: set[int] = set()  # 大于cum的已收到序号
+
+    def resetReceiver(self, epoch: int):
+        """对端重启(会话号变化)后丢弃旧会话的接收状态"""
+        self.epoch = epoch
+        self.cum = _SEQ_MASK
+        self.received.clear()
+
+    def base(self) -> int:
+        """最小未确认序号"""
+        if not self.unacked:
+            return self.next_seq
+        return min(self.unacked, key=lambda seq: (seq - self.next_seq) & _SEQ_MASK)
+
+
+class ReliableUdp:
+    """基于HUdpSocket的可靠udp层
+
+    提供序号、选择确认、自适应超时重传(RFC 6298)与重复抑制.
+    报文按到达顺序交付而不重新排序, 以避免队头阻塞.
+    每个数据报文携带发送方的最小未确认序号, 接收方据此丢弃过期状态.
+    每个实例启动时随机生成会话号并写入数据报文与确认报文, 对端重启后会话号变化, 接收方据此重置该对端的状态,
+    旧会话的迟到确认也会被忽略, 因此一端重启后无需重新握手.
+    空闲超过idle_timeout且没有未确认报文的对端状态会被清理.
+    """
+    OnLostCallback = Callable[[Message, tuple], None]
+
+    def __init__(self, sock: HUdpSocket, initial_rto: float = 1.0, min_rto: float = 0.05, max_rto: float = 5.0,
+                 max_retries: int = 8, max_sacks: int = 32, idle_timeout: float = 120.0):
+        """ReliableUdp
+
+        Args:
+            sock (HUdpSocket): 收发报文使用的套接字
+            initial_rto (float): 尚无RTT采样时的重传超时(秒)
+            min_rto (float): 最小重传超时(秒)
+            max_rto (float): 最大重传超时(秒)
+            max_retries (int): 最大重传次数, 超过后放弃并调用OnLostCallback
+            max_sacks (int): 每个确认报文中最多携带的选择确认序号数
+            idle_timeout (float): 对端状态的空闲过期时间(秒), 应大于报文被放弃前的最长重传时间
+        """
+        self.__sock = sock
+        self.__initial_rto = initial_rto
+        self.__min_rto = min_rto
+        self.__max_rto = max_rto
+        self.__max_retries = max_retries
+        self.__max_sacks = max_sacks
+        self.__idle_timeout = idle_timeout
+        self.__epoch = random.getrandbits(32)
+        self.__peers: dict[tuple, _Peer] = {}
+        self.__cond = threading.Condition()
+        self.__closed = False
+        self.__th_retransmit = threading.Thread(target=self.__retransmit, daemon=True)
+        self.__th_retransmit.start()
+
+        self.__onLostCallback: Optional[ReliableUdp.OnLostCallback] = None
+
+    def setOnLostCallback(self, callback: OnLostCallback):
+        """设置报文超过最大重传次数仍未被确认时的回调"""
+        self.__onLostCallback = callback
+
+    def close(self):
+        """停止重传线程并丢弃所有状态"""
+        with self.__cond:
+            self.__closed = True
+            self.__peers.clear()
+            self.__cond.notify_all()
+
+    def pending(self, addr: Optional[tuple] = None) -> int:
+        """未被确认的报文数
+
+        Args:
+            addr (Optional[tuple]): 对端地址, None时统计所有对端
+        """
+        with self.__cond:
+            if addr is not None:
+                peer = self.__peers.get(addr)
+                return len(peer.unacked) if peer is not None else 0
+            return sum(len(peer.unacked) for peer in self.__peers.values())
+
+    def rto(self, addr: tuple) -> float:
+        """当前对某个对端的重传超时(秒)"""
+        with self.__cond:
+            peer = self.__peers.get(addr)
+            return peer.rto if peer is not None else self.__initial_rto
+
+    def send(self, msg: Message, addr: tuple) -> bool:
+        """可靠地发送一个报文
+
+        Args:
+            msg (Message): 发送的报文
+            addr (tuple): 目标地址
+
+        Returns:
+            bool: 首次发送时数据是否全部发送, 发送失败的报文仍会被重传
+        """
+        payload = msg.toBytes()
+        with self.__cond:
+            now = time.monotonic()
+            peer = self.__peer(addr, now)
+            seq = peer.next_seq
+            base = peer.base()
+            peer.next_seq = (seq + 1) & _SEQ_MASK
+            data = Message.BinaryMsg(BuiltInOpCode.RUDP_DATA,
+                                     _DATA_HEADER.pack(self.__epoch, seq, base) + payload).toBytes()
+            pending = _Pending(seq, msg, data, now, peer.rto)
+            peer.unacked[seq] = pending
+            self.__cond.notify_all()
+        return self.__sendto(data, addr)
+
+    def receive(self, msg: Message, addr: tuple) -> Optional[Message]:
+        """处理一个收到的报文
+
+        Args:
+            msg (Message): 收到的报文
+            addr (tuple): 源地址
+
+        Returns:
+            Optional[Message]: 应交付给应用的报文. 确认报文、重复报文及无法解析的报文返回None, 普通报文原样返回
+        """
+        match msg.opcode():
+            case BuiltInOpCode.RUDP_DATA:
+                return self.__onData(msg, addr)
+            case BuiltInOpCode.RUDP_ACK:
+                self.__onAck(msg, addr)
+                return None
+            case _:
+                return msg
+
+    def __peer(self, addr: tuple, now: float) -> _Peer:
+        peer = self.__peers.get(addr)
+        if peer is None:
+            peer = self.__peers[addr] = _Peer(self.__initial_rto, now)
+            self.__cond.notify_all()  # 重新计算过期时间
+        peer.last_active = now
+        return peer
+
+    def __sendto(self, data: bytes, addr: tuple) -> bool:
+        try:
+            return self.__sock.sendBytes(data, addr)
+        except OSError:
+            return False
+
+    def __onData(self, msg: Message, addr: tuple) -> Optional[Message]:
+        content = msg.content()
+        if not isinstance(content, bytes) or len(content) < _DATA_HEADER.size:
+            return None
+        epoch, seq, base = _DATA_HEADER.unpack_from(content)
+        with self.__cond:
+            peer = self.__peer(addr, time.monotonic())
+            if peer.epoch != epoch:
+                peer.resetReceiver(epoch)
+            # 发送方已不会再重传base之前的报文
+            if _seq_lt(peer.cum, (base - 1) & _SEQ_MASK):
+                peer.cum = (base - 1) & _SEQ_MASK
+                peer.received = {s for s in peer.received if _seq_lt(peer.cum, s)}
+            duplicate = not _seq_lt(peer.cum, seq) or seq in peer.received
+            if not duplicate:
+                peer.received.add(seq)
+                while (peer.cum + 1) & _SEQ_MASK in peer.received:
+                    peer.cum = (peer.cum + 1) & _SEQ_MASK
+                    peer.received.remove(peer.cum)
+            sacks = sorted(peer.received, key=lambda s: (s - peer.cum) & _SEQ_MASK)[-self.__max_sacks:]
+            ack = _ACK_HEADER.pack(epoch, peer.cum) + b"".join(_SEQ.pack(s) for s in sacks)
+        self.__sendto(Message.BinaryMsg(BuiltInOpCode.RUDP_ACK, ack).toBytes(), addr)  # 重复报文也需确认, 以防确认丢失
+        if duplicate:
+            return None
+        try:
+            return Message.fromBytes(content[_DATA_HEADER.size:])
+        except (MessageError, UnicodeDecodeError):
+            return None
+
+    def __onAck(self, msg: Message, addr: tuple):
+        content = msg.content()
+        if not isinstance(content, bytes) or len(content) < _ACK_HEADER.size:
+            return
+        epoch, cum = _ACK_HEADER.unpack_from(content)
+        if epoch != self.__epoch:  # 确认的是本端重启前发送的报文
+            return
+        sacks = [_SEQ.unpack_from(content, offset)[0]
+                 for offset in range(_ACK_HEADER.size, len(content) - 3, _SEQ.size)]
+        now = time.monotonic()
+        with self.__cond:
+            peer = self.__peers.get(addr)
+            if peer is None:
+                return
+            peer.last_active = now
+            acked = [seq for seq in peer.unacked if not _seq_lt(cum, seq)]
+            acked.extend(seq for seq in sacks if seq in peer.unacked)
+            for seq in acked:
+                pending = peer.unacked.pop(seq, None)
+                if pending is not None and pending.retries == 0:  # Karn算法: 只对未重传的报文采样
+                    self.__sampleRtt(peer, now - pending.first_sent)
+
+    def __sampleRtt(self, peer: _Peer, rtt: float):
+        # RFC 6298
+        if peer.srtt is None:
+            peer.srtt = rtt
+            peer.rttvar = rtt / 2
+        else:
+            peer.rttvar = 0.75 * peer.rttvar + 0.25 * abs(peer.srtt - rtt)
+            peer.srtt = 0.875 * peer.srtt + 0.125 * rtt
+        peer.rto = min(max(peer.srtt + 4 * peer.rttvar, self.__min_rto), self.__max_rto)
+
+    def __retransmit(self):
+        while True:
+            resend: list[tuple[bytes, tuple]] = []
+            lost: list[tuple[Message, tuple]] = []
+            with self.__cond:
+                if self.__closed:
+                    return
+                now = time.monotonic()
+                next_deadline = None
+                for addr, peer in list(self.__peers.items()):
+                    if not peer.unacked:
+                        expire = peer.last_active + self.__idle_timeout
+                        if expire <= now:
+                            del self.__peers[addr]
+                        elif next_deadline is None or expire < next_deadline:
+                            next_deadline = expire
+                        continue
+                    for seq, pending in list(peer.unacked.items()):
+                        if pending.deadline <= now:
+                            if pending.retries >= self.__max_retries:
+                                del peer.unacked[seq]
+                                lost.append((pending.msg, addr))
+                                continue
+                            pending.retries += 1
+                            pending.deadline = now + min(peer.rto * (2 ** pending.retries), self.__max_rto)  # 指数退避
+                            resend.append((pending.data, addr))
+                        if next_deadline is None or pending.deadline < next_deadline:
+                            next_deadline = pending.deadline
+                if not resend and not lost:
+                    self.__cond.wait(None if next_deadline is None else next_deadline - now)
+                    continue
+            for data, addr in resend:
+                self.__sendto(data, addr)
+            if self.__onLostCallback is not None:
+                for msg, addr in lost:
+                    self.__onLostCallback(msg, addr)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+from typing import Callable, Optional
+import threading
+
+Handler = Callable[..., None]
+OpCodeHandler = Callable[..., bool]  # 返回False时会继续执行默认回调
+Middleware = Callable[[Optional[int], Handler], Handler]  # (opcode, next_handler) -> handler
+
+
+class Router:
+    """按操作码分发报文的路由表
+
+    每个操作码对应的处理链(中间件 -> 操作码回调 -> 默认回调)在注册时预先编译,
+    分发时只需一次字典查找与一次调用.
+    回调参数由使用方决定, 例如tcp服务端为(conn, msg), udp服务端为(msg, c_addr), 客户端为(msg,).
+
+    中间件为一个工厂方法 `middleware(opcode, next_handler) -> handler`,
+    在编译处理链时按注册顺序由外向内包装, opcode为None表示未注册操作码时使用的默认处理链.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__handlers: dict[int, OpCodeHandler] = {}
+        self.__terminals: dict[int, Handler] = {}
+        self.__default: Optional[Handler] = None
+        self.__middlewares: list[Middleware] = []
+        self.__chains: dict[int, Handler] = {}
+        self.__default_chain: Handler = self.__noop
+
+    @staticmethod
+    def __noop(*args):
+        pass
+
+    def route(self, opcode: int) -> Callable[[OpCodeHandler], OpCodeHandler]:
+        """以装饰器形式注册操作码回调
+
+        Args:
+            opcode (int): 操作码
+        """
+        def decorator(handler: OpCodeHandler) -> OpCodeHandler:
+            self.setHandler(opcode, handler)
+            return handler
+        return decorator
+
+    def setHandler(self, opcode: int, handler: OpCodeHandler):
+        """设置指定操作码的回调"""
+        with self.__lock:
+            self.__handlers[opcode] = handler
+            self.__compile()
+
+    def popHandler(self, opcode: int):
+        """取消指定操作码的回调
+
+        Raises:
+            KeyError: 操作码未注册时抛出
+        """
+        with self.__lock:
+            self.__handlers.pop(opcode)
+            self.__compile()
+
+    def setTerminalHandler(self, opcode: int, handler: Handler):
+        """设置指定操作码的终端回调, 优先于操作码回调且不会继续执行默认回调, 仍经过所有中间件"""
+        with self.__lock:
+            self.__terminals[opcode] = handler
+            self.__compile()
+
+    def popTerminalHandler(self, opcode: int):
+        """取消指定操作码的终端回调
+
+        Raises:
+            KeyError: 操作码未注册时抛出
+        """
+        with self.__lock:
+            self.__terminals.pop(opcode)
+            self.__compile()
+
+    def setDefaultHandler(self, handler: Optional[Handler]):
+        """设置默认回调(调用晚于操作码回调)"""
+        with self.__lock:
+            self.__default = handler
+            self.__compile()
+
+    def use(self, middleware: Middleware):
+        """追加一个中间件, 先注册的中间件位于处理链外层"""
+        with self.__lock:
+            self.__middlewares.append(middleware)
+            self.__compile()
+
+    def removeMiddleware(self, middleware: Middleware):
+        """移除一个中间件
+
+        Raises:
+            ValueError: 中间件未注册时抛出
+        """
+        with self.__lock:
+            self.__middlewares.remove(middleware)
+            self.__compile()
+
+    def handler(self, opcode: int) -> Handler:
+        """获取指定操作码预先编译好的处理链"""
+        return self.__chains.get(opcode, self.__default_chain)
+
+    def dispatch(self, opcode: int, *args):
+        """分发一个报文
+
+        Args:
+            opcode (int): 报文操作码
+            *args: 传递给回调的参数
+        """
+        self.__chains.get(opcode, self.__default_chain)(*args)
+
+    def __compile(self):
+        default = self.__default
+        chains = {opcode: self.__wrap(opcode, self.__chain(handler, default))
+                  for opcode, handler in self.__handlers.items()}
+        chains.update((opcode, self.__wrap(opcode, handler)) for opcode, handler in self.__terminals.items())
+        # 替换整个字典, 使分发线程无需加锁
+        self.__default_chain = self.__wrap(None, default if default is not None else self.__noop)
+        self.__chains = chains
+
+    @staticmethod
+    def __chain(handler: OpCodeHandler, default: Optional[Handler]) -> Handler:
+        if default is None:  # 无需回退, 直接调用操作码回调
+            return handler
+
+        def chain(*args):
+            if not handler(*args):
+                default(*args)
+        return chain
+
+    def __wrap(self, opcode: Optional[int], handler: Handler) -> Handler:
+        for middleware in reversed(self.__middlewares):
+            handler = middleware(opcode, handler)
+        return handler
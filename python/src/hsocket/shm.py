@@ -0,0 +1,505 @@
+# -*- coding: utf-8 -*-
+"""共享内存传输
+
+同一主机上的两个进程通过一对共享内存环形缓冲区(每个方向一个, 单生产者单消费者)交换HSocket报文,
+报文格式与tcp相同(8字节Header + 正文). unix域套接字只用于握手、唤醒空闲的接收方(门铃)以及检测对端断开,
+接收方忙碌时收发报文不需要任何系统调用.
+"""
+from typing import Optional, Callable
+from multiprocessing import shared_memory, resource_tracker
+import select
+import socket
+import struct
+import threading
+import time
+import os
+from .message import *
+from .hsocket import HTcpSocket, SocketConfig, MessageStream, RecvLimits, _StreamBody, _BodyBuffer
+from .metrics import Metrics
+
+_U64 = struct.Struct("<Q")
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """打开已存在的共享内存, 不交给resource_tracker管理(由创建方负责删除)"""
+    try:
+        return shared_memory.SharedMemory(name, track=False)  # python 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(name)
+        if os.name == "posix":
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class ShmRing:
+    """共享内存中的单生产者单消费者字节环形缓冲区
+
+    布局: head(8) | tail(8) | waiting(8) | 数据区, 三个字段各占一个缓存行.
+    head与tail为单调递增的字节计数, 分别只由生产者与消费者写入; waiting由消费者在准备睡眠时置位.
+    依赖于对齐的8字节读写是原子的, 且写入按程序顺序对其他核可见(x86-64).
+    """
+    HEAD = 0
+    TAIL = 64
+    WAITING = 128
+    DATA = 192
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool = False):
+        self.__shm = shm
+        self.__owner = owner
+        self.__buf = shm.buf
+        self.__data = shm.buf[self.DATA:]
+        self.__capacity = len(self.__data)
+
+    @classmethod
+    def create(cls, capacity: int) -> "ShmRing":
+        shm = shared_memory.SharedMemory(create=True, size=cls.DATA + capacity)
+        shm.buf[:cls.DATA] = bytes(cls.DATA)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str) -> "ShmRing":
+        return cls(_attach(name))
+
+    def name(self) -> str:
+        return self.__shm.name
+
+    def capacity(self) -> int:
+        return self.__capacity
+
+    def unlink(self):
+        """删除共享内存的名称, 已映射的进程可继续使用"""
+        if self.__owner:
+            self.__owner = False
+            try:
+                self.__shm.unlink()
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        """解除映射, 之后的读写会抛出ValueError或TypeError
+
+        Raises:
+            BufferError: 其他线程正在读写时抛出, 映射会在对象回收时解除
+        """
+        self.unlink()
+        self.__data.release()
+        self.__shm.close()
+
+    def readable(self) -> int:
+        """可读的字节数"""
+        return _U64.unpack_from(self.__buf, self.HEAD)[0] - _U64.unpack_from(self.__buf, self.TAIL)[0]
+
+    def writable(self) -> int:
+        """可写的字节数"""
+        return self.__capacity - self.readable()
+
+    def setWaiting(self, waiting: bool):
+        _U64.pack_into(self.__buf, self.WAITING, 1 if waiting else 0)
+
+    def waiting(self) -> bool:
+        return _U64.unpack_from(self.__buf, self.WAITING)[0] != 0
+
+    def write(self, data: memoryview) -> int:
+        """生产者写入尽可能多的数据, 返回写入的字节数"""
+        head = _U64.unpack_from(self.__buf, self.HEAD)[0]
+        n = min(len(data), self.__capacity - (head - _U64.unpack_from(self.__buf, self.TAIL)[0]))
+        if n <= 0:
+            return 0
+        start = head % self.__capacity
+        first = min(n, self.__capacity - start)
+        self.__data[start:start + first] = data[:first]
+        if first < n:
+            self.__data[:n - first] = data[first:n]
+        _U64.pack_into(self.__buf, self.HEAD, head + n)  # 数据写入后才发布
+        return n
+
+    def readInto(self, view: memoryview) -> int:
+        """消费者读出尽可能多的数据到view, 返回读出的字节数"""
+        tail = _U64.unpack_from(self.__buf, self.TAIL)[0]
+        n = min(len(view), _U64.unpack_from(self.__buf, self.HEAD)[0] - tail)
+        if n <= 0:
+            return 0
+        start = tail % self.__capacity
+        first = min(n, self.__capacity - start)
+        view[:first] = self.__data[start:start + first]
+        if first < n:
+            view[first:n] = self.__data[:n - first]
+        _U64.pack_into(self.__buf, self.TAIL, tail + n)
+        return n
+
+
+class HShmSocket:
+    """通过一对共享内存环形缓冲区收发报文的连接, 报文收发接口与HTcpSocket相同
+
+    同一连接只能有一个线程接收, 发送是线程安全的. 接收方空闲时先自旋`SocketConfig.shmSpinTime`,
+    之后置位等待标志并在unix域套接字上睡眠, 由发送方写入一个字节唤醒.
+    """
+    family = getattr(socket, "AF_UNIX", None)
+
+    def __init__(self, sock: HTcpSocket, tx: ShmRing, rx: ShmRing):
+        self.__sock = sock
+        self.__tx = tx
+        self.__rx = rx
+        self.__timeout: Optional[float] = None
+        self.__send_lock = threading.Lock()
+        self.__stream: Optional[MessageStream] = None  # 最近收到的STREAM报文的正文
+        self.__recv_limits: Optional[RecvLimits] = None
+        self.__budget_held = 0  # 最近收到的报文占用的接收预算
+        self.__closed = False
+        self.__metrics: Optional[Metrics] = None
+        sock.settimeout(None)  # 门铃的等待由select控制
+
+    @classmethod
+    def connect(cls, addr, timeout: Optional[float] = None) -> "HShmSocket":
+        """连接HShmServer并完成握手(客户端)
+
+        Raises:
+            OSError: 连接失败或握手超时时抛出
+            MessageError: 握手报文异常时抛出
+        """
+        sock = HTcpSocket(socket.AF_UNIX)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(addr)
+            msg = sock.recvMsg()
+            if msg.opcode() != BuiltInOpCode.SHM_HANDSHAKE:
+                raise MessageTypeError("need a SHM_HANDSHAKE message")
+            rx = ShmRing.attach(msg.get("s2c"))
+            tx = ShmRing.attach(msg.get("c2s"))
+            sock.sendMsg(Message.HeaderOnlyMsg(BuiltInOpCode.SHM_HANDSHAKE))  # 确认后服务端删除共享内存的名称
+        except BaseException:
+            sock.close()
+            raise
+        conn = cls(sock, tx, rx)
+        conn.settimeout(timeout)
+        return conn
+
+    @classmethod
+    def accept(cls, sock: HTcpSocket, timeout: Optional[float] = None) -> "HShmSocket":
+        """对已接受的unix域套接字连接完成握手(服务端)
+
+        Raises:
+            OSError: 握手超时或连接异常时抛出
+            MessageError: 握手报文异常时抛出
+        """
+        c2s = ShmRing.create(SocketConfig.shmRingSize)
+        s2c = ShmRing.create(SocketConfig.shmRingSize)
+        try:
+            sock.settimeout(timeout)
+            sock.sendMsg(Message.JsonMsg(BuiltInOpCode.SHM_HANDSHAKE, c2s=c2s.name(), s2c=s2c.name()))
+            if sock.recvMsg().opcode() != BuiltInOpCode.SHM_HANDSHAKE:
+                raise MessageTypeError("need a SHM_HANDSHAKE message")
+        except BaseException:
+            c2s.close()
+            s2c.close()
+            raise
+        c2s.unlink()  # 双方均已映射, 进程退出后由系统回收
+        s2c.unlink()
+        return cls(sock, s2c, c2s)
+
+    def setMetrics(self, metrics: Optional[Metrics]):
+        """设置统计收发报文的Metrics, None表示不统计"""
+        self.__metrics = metrics
+
+    def settimeout(self, timeout: Optional[float]):
+        """设置接收报文以及等待发送空间的超时时间, None表示一直等待"""
+        self.__timeout = timeout
+
+    def gettimeout(self) -> Optional[float]:
+        return self.__timeout
+
+    def sendQueue(self):
+        return None
+
+    def isValid(self) -> bool:
+        return not self.__closed
+
+    def fileno(self) -> int:
+        return self.__sock.fileno()
+
+    def getpeername(self):
+        return self.__sock.getpeername()
+
+    def getsockname(self):
+        return self.__sock.getsockname()
+
+    def setRecvLimits(self, limits: Optional[RecvLimits]):
+        """设置接收报文的大小上限与接收内存预算, None时只按SocketConfig.maxMessageSize限制"""
+        self.__recv_limits = limits
+
+    def releaseRecv(self):
+        """归还最近收到的报文占用的接收预算, 处理完报文后调用. 接收下一个报文或关闭连接时也会归还"""
+        if self.__budget_held:
+            held, self.__budget_held = self.__budget_held, 0
+            self.__recv_limits.budget.release(held)
+
+    def close(self):
+        self.releaseRecv()
+        if self.__closed:
+            return
+        self.__closed = True
+        try:
+            self.__sock.shutdown(socket.SHUT_RDWR)  # 唤醒正在等待门铃的接收线程
+        except OSError:
+            pass
+        self.__sock.close()
+        for ring in (self.__tx, self.__rx):
+            try:
+                ring.close()
+            except BufferError:  # 其他线程仍在读写
+                pass
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """阻塞直至对端读出所有已发送的数据
+
+        Returns:
+            bool: 是否已全部读出
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.0
+        try:
+            while self.__tx.readable():
+                if deadline is not None and time.monotonic() >= deadline:
+                    return False
+                time.sleep(delay)
+                delay = min(delay * 2 or 1e-5, 1e-3)
+        except (ValueError, TypeError):  # 已关闭
+            return False
+        return True
+
+    def sendMsg(self, msg: Message, on_written: Optional[Callable[[bool], None]] = None, copy: bool = False):
+        """发送一个数据包
+
+        Args:
+            msg (Message): 报文
+            on_written (Optional[Callable[[bool], None]]): 写入共享内存后(或放弃发送时)以是否已发送调用
+            copy (bool): 与HTcpSocket.sendMsg一致, 正文在返回前已写入共享内存, 总是可以在返回后修改
+
+        Raises:
+            OSError: 连接已关闭或等待发送空间超时时抛出
+            Exception: STREAM报文的正文读取出错时抛出(对端收到不完整的正文)
+        """
+        if msg.contenttype() == ContentType.STREAM:
+            sent = self.sendStream(msg.opcode(), msg.stream())
+        else:
+            sent = self.sendBuffers(msg.toBuffers())
+        if on_written is not None:
+            on_written(sent)
+        if not sent:
+            raise TimeoutError("shared memory ring is full")
+
+    def sendStream(self, opcode: int, body) -> bool:
+        """逐块读取并发送流式正文, 期间独占发送方向
+
+        Raises:
+            OSError: 连接已关闭, 或正文发送途中等待发送空间超时(连接随之关闭)时抛出
+            Exception: 正文读取出错时抛出, 此时对端会收到放弃发送的标记
+
+        Returns:
+            bool: 是否已发送, 报头等待发送空间超时时返回False
+        """
+        header = Header(ContentType.STREAM, opcode, 0).toBytes()
+        body = _StreamBody(body, SocketConfig.streamChunkSize)
+        with self.__send_lock:
+            deadline = None if self.__timeout is None else time.monotonic() + self.__timeout
+            if not self.__waitWritable(len(header), deadline):
+                return False
+            self.__write(memoryview(header), None)
+            for frame in body:
+                deadline = None if self.__timeout is None else time.monotonic() + self.__timeout
+                for buf in frame:
+                    if not self.__write(memoryview(buf).cast("B"), deadline):
+                        self.close()  # 正文已部分写入, 数据流无法恢复
+                        raise TimeoutError("shared memory ring is full")
+        if body.error is not None:
+            raise body.error
+        if self.__metrics is not None:
+            self.__metrics.messageSent(header, len(header) + body.size)
+        return True
+
+    def sendBytes(self, data: bytes, block: bool = True) -> bool:
+        """发送已转换为二进制流的报文
+
+        Args:
+            data (bytes): 报文二进制流
+            block (bool): 环形缓冲区空间不足时是否等待, 不等待时放弃发送
+
+        Raises:
+            OSError: 连接已关闭时抛出
+
+        Returns:
+            bool: 是否已发送
+        """
+        return self.sendBuffers([data], block)
+
+    def sendBuffers(self, buffers: list, block: bool = True) -> bool:
+        """发送由多段缓冲区(报头在第一段)组成的一个报文, 缓冲区直接复制进共享内存
+
+        Raises:
+            OSError: 连接已关闭, 或报文超过环形缓冲区容量且写入途中等待超时(连接随之关闭)时抛出
+
+        Returns:
+            bool: 是否已发送, 不等待或等待超时时返回False, 此时未写入任何数据
+        """
+        views = [memoryview(buf).cast("B") for buf in buffers]
+        size = sum(len(view) for view in views)
+        with self.__send_lock:
+            if not block and self.__tx.writable() < size:
+                return False
+            deadline = None if self.__timeout is None else time.monotonic() + self.__timeout
+            # 先等待整个报文的空间(超过容量时等待缓冲区清空), 超时时不会留下不完整的报文
+            if not self.__waitWritable(min(size, self.__tx.capacity()), deadline):
+                return False
+            for view in views:
+                if not self.__write(view, deadline):
+                    self.close()  # 报文已部分写入, 数据流无法恢复
+                    raise TimeoutError("shared memory ring is full")
+        if self.__metrics is not None:
+            self.__metrics.messageSent(views[0], size)
+        return True
+
+    def __write(self, view: memoryview, deadline: Optional[float]) -> bool:
+        delay = 0.0
+        while view:
+            try:
+                n = self.__tx.write(view)
+                if n:
+                    self.__ring()
+            except (ValueError, TypeError):  # 已关闭并解除映射
+                raise ConnectionAbortedError("connection is closed")
+            if n:
+                view = view[n:]
+                delay = 0.0
+                continue
+            if self.__closed:
+                raise ConnectionAbortedError("connection is closed")
+            # 缓冲区已满, 退避等待对端读出
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2 or 1e-5, 1e-3)
+        return True
+
+    def __waitWritable(self, size: int, deadline: Optional[float]) -> bool:
+        delay = 0.0
+        while True:
+            try:
+                if self.__tx.writable() >= size:
+                    return True
+            except (ValueError, TypeError):  # 已关闭并解除映射
+                raise ConnectionAbortedError("connection is closed")
+            if self.__closed:
+                raise ConnectionAbortedError("connection is closed")
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2 or 1e-5, 1e-3)
+
+    def __ring(self):
+        if self.__tx.waiting():
+            self.__tx.setWaiting(False)
+            try:
+                self.__sock.send(b"\0")
+            except OSError:
+                pass
+
+    def recvMsg(self) -> Message:
+        """尝试接收一个数据包, BINARY报文的正文为每个报文独立缓冲区的只读memoryview
+
+        STREAM报文在报头到达后即返回, 正文为MessageStream, 下次调用时丢弃其未读完的部分.
+
+        Raises:
+            TimeoutError: 等待超时时抛出
+            OSError: 连接异常时抛出
+            EmptyMessageError: 对端关闭连接时抛出
+            MessageHeaderError: 报头解析异常时抛出
+            MessageTooLargeError: 正文超过上限时抛出
+            MessageSchemaError: RECORD正文不符合注册的格式时抛出
+            UnicodeDecodeError: 报文内容编码异常时抛出
+
+        Returns:
+            Message: 收到的报文
+        """
+        if self.__stream is not None:
+            stream, self.__stream = self.__stream, None
+            stream.discard()
+        self.releaseRecv()
+        deadline = None if self.__timeout is None else time.monotonic() + self.__timeout
+        head = bytearray(Header.HEADER_LENGTH)
+        self.__readExactly(memoryview(head), deadline, True)
+        header = Header.fromBytes(head)
+        limits = self.__recv_limits
+        max_size = limits.maxSize(header.opcode) if limits is not None else SocketConfig.maxMessageSize
+        if header.contenttype == ContentType.STREAM:
+            if self.__metrics is not None:
+                self.__metrics.messageReceived(header.opcode, Header.HEADER_LENGTH)
+            self.__stream = MessageStream(self.__recvSome, max_size)
+            return Message.HeaderContent(header, self.__stream)
+        if header.length > max_size:
+            raise MessageTooLargeError("message of {} bytes exceeds {} (opcode {})".format(
+                header.length, max_size, header.opcode))
+        if header.length and limits is not None and limits.budget is not None:
+            self.__budget_held = limits.budget.acquire(header.length)
+        body = _BodyBuffer(header.length)
+        while not body.done():
+            with body.space() as view:  # 扩大缓冲区前需释放视图
+                self.__readExactly(view, None, False)  # 报头已到达, 正文随后即到
+                body.received += len(view)
+        if self.__metrics is not None:
+            self.__metrics.messageReceived(header.opcode, Header.HEADER_LENGTH + header.length)
+        return body.message(header)
+
+    def __readExactly(self, view: memoryview, deadline: Optional[float], first: bool):
+        received = 0
+        while received < len(view):
+            try:
+                n = self.__rx.readInto(view[received:])
+                if not n and not self.__wait(deadline if not received else None):  # 已开始接收时不再超时
+                    if first and not received:
+                        raise EmptyMessageError()
+                    raise ConnectionAbortedError("connection closed in the middle of a message")
+            except (ValueError, TypeError):  # 已关闭并解除映射
+                raise ConnectionAbortedError("connection is closed")
+            received += n
+
+    def __recvSome(self, view: memoryview) -> int:
+        # 供MessageStream读取, 对端关闭连接时返回0
+        try:
+            while True:
+                n = self.__rx.readInto(view)
+                if n:
+                    return n
+                if not self.__wait(None):
+                    return 0
+        except (ValueError, TypeError):  # 已关闭并解除映射
+            raise ConnectionAbortedError("connection is closed")
+
+    def __wait(self, deadline: Optional[float]) -> bool:
+        # 等待对端写入数据, 对端关闭连接时返回False
+        spin_until = time.perf_counter() + SocketConfig.shmSpinTime
+        while time.perf_counter() < spin_until:
+            if self.__rx.readable():
+                return True
+        while True:
+            if self.__closed:
+                return False
+            self.__rx.setWaiting(True)
+            if self.__rx.readable():  # 置位后再次检查, 避免错过门铃
+                self.__rx.setWaiting(False)
+                return True
+            timeout = SocketConfig.shmPollInterval
+            if deadline is not None:
+                timeout = min(timeout, deadline - time.monotonic())
+                if timeout <= 0:
+                    self.__rx.setWaiting(False)
+                    raise TimeoutError("timed out")
+            try:
+                readable, _, _ = select.select([self.__sock], [], [], timeout)
+                rang = self.__sock.recv(4096) if readable else None
+            except (OSError, ValueError):
+                rang = b""
+            self.__rx.setWaiting(False)
+            if rang == b"":  # 对端已关闭
+                return self.__rx.readable() > 0
+            if self.__rx.readable():
+                return True
@@ -0,0 +1,491 @@
+# -*- coding: utf-8 -*-
+"""HSocket回环基准测试
+
+服务端运行在独立进程中, 负载由多个客户端进程产生, 结果以JSON输出以便与基线比较.
+
+    python benchmark.py --quick
+    python benchmark.py --output new.json --baseline old.json
+    python benchmark.py --only message,tcp-selector
+    python benchmark.py --only tcp-threading,uds,shm  # 同机传输方式对比
+"""
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from src.hsocket.hserver import HTcpSelectorServer, HTcpThreadingServer, HUdpServer, HShmServer
+from src.hsocket.hclient import HTcpReqResClient, HUdpReqResClient
+from src.hsocket.hsocket import HTcpSocket, Message, SocketConfig, addressFamily
+from src.hsocket.shm import HShmSocket
+from src.hsocket.message import ContentType, StructSchema, MsgpackSchema, registerSchema, msgpack
+import argparse
+import json
+import multiprocessing
+import platform
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from time import perf_counter
+
+OP_ECHO = 1
+OP_DOWNLOAD = 2
+OP_UPLOAD = 3
+OP_RECORD = 4  # 4~6: 记录格式对比
+SUITES = ("message", "tcp-selector", "tcp-threading", "uds", "shm", "udp", "file")
+LOCAL_SUITES = ("tcp-threading", "uds", "shm")  # 同为每连接一个线程的服务端, 用于对比传输方式
+
+
+def make_msg(contenttype: ContentType, size: int) -> Message:
+    match contenttype:
+        case ContentType.PLAINTEXT:
+            return Message.PlainTextMsg(OP_ECHO, "x" * size)
+        case ContentType.JSONOBJRCT:
+            return Message.JsonMsg(OP_ECHO, data="x" * max(0, size - 12))
+        case _:
+            return Message.BinaryMsg(OP_ECHO, os.urandom(size))
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def summarize(name: str, params: dict, count: int, errors: int, elapsed: float, latencies: list[float]) -> dict:
+    latencies.sort()
+    return {
+        "name": name,
+        "params": params,
+        "msgs_per_sec": round(count / elapsed, 1) if elapsed > 0 else 0.0,
+        "p50_us": round(percentile(latencies, 0.50) * 1e6, 1),
+        "p99_us": round(percentile(latencies, 0.99) * 1e6, 1),
+        "errors": errors,
+    }
+
+
+def free_port(kind=socket.SOCK_STREAM) -> int:
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def raise_fd_limit() -> int:
+    try:
+        import resource
+    except ImportError:  # windows
+        return 512
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = 1 << 20
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        return hard
+    except (ValueError, OSError):
+        return soft
+
+
+# ---------------------------------------------------------------- 服务端进程
+
+def run_server(kind: str, addr, filepath: str, download_dir: str):
+    raise_fd_limit()
+    SocketConfig.downloadDirectory = download_dir
+    if kind == "udp":
+        server = HUdpServer(addr)
+        server.setOnMessageReceivedCallback(lambda msg, addr: server.sendto(msg, addr))
+        server.startserver()
+        return
+    match kind:
+        case "tcp-selector":
+            server = HTcpSelectorServer(addr)
+        case "shm":
+            server = HShmServer(addr)
+        case _:  # tcp-threading, uds
+            server = HTcpThreadingServer(addr)
+
+    def onMessageReceived(conn: HTcpSocket, msg: Message):
+        match msg.opcode():
+            case 1:  # OP_ECHO
+                conn.sendMsg(msg)
+            case 2:  # OP_DOWNLOAD
+                threading.Thread(target=server.sendfile, args=(conn, filepath, "bench_download.bin")).start()
+            case 3:  # OP_UPLOAD
+                threading.Thread(target=server.recvfile, args=(conn,)).start()
+
+    server.setOnMessageReceivedCallback(onMessageReceived)
+    server.startserver()
+
+
+class ServerProcess:
+    def __init__(self, ctx, kind: str, filepath: str = "", download_dir: str = ""):
+        self.kind = kind
+        if kind in ("uds", "shm"):
+            self.tmpdir = tempfile.mkdtemp(prefix="hsocket_bench_")
+            self.addr = os.path.join(self.tmpdir, kind + ".sock")
+        else:
+            self.tmpdir = None
+            self.addr = ("127.0.0.1", free_port(socket.SOCK_DGRAM if kind == "udp" else socket.SOCK_STREAM))
+        self.process = ctx.Process(target=run_server, args=(kind, self.addr, filepath, download_dir), daemon=True)
+
+    def __enter__(self):
+        self.process.start()
+        deadline = time.monotonic() + 10
+        while self.kind != "udp":
+            try:
+                if self.kind == "shm":  # 连接会触发握手, 只等待套接字文件出现
+                    if not os.path.exists(self.addr):
+                        raise FileNotFoundError(self.addr)
+                else:
+                    with socket.socket(addressFamily(self.addr), socket.SOCK_STREAM) as s:
+                        s.settimeout(1)
+                        s.connect(self.addr)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        else:
+            time.sleep(0.3)
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.join(5)
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+# ---------------------------------------------------------------- 客户端进程
+
+def tcp_worker(kind: str, addr, conn_count: int, data: bytes, duration: float, barrier, results):
+    raise_fd_limit()
+    socks = []
+    try:
+        for i in range(conn_count):
+            if kind == "shm":
+                sock = HShmSocket.connect(addr)
+            else:
+                sock = HTcpSocket(addressFamily(addr))
+                sock.connect(addr)
+            socks.append(sock)
+    except OSError:
+        barrier.abort()
+        raise
+    barrier.wait()
+    latencies: list[float] = []
+    count = errors = 0
+    start = perf_counter()
+    deadline = start + duration
+    try:
+        while perf_counter() < deadline:
+            # 每个连接上各有一个请求在途
+            sent_at = []
+            for sock in socks:
+                sent_at.append(perf_counter())
+                sock.sendBytes(data)
+            for sock, t0 in zip(socks, sent_at):
+                sock.recvMsg()
+                latencies.append(perf_counter() - t0)
+            count += len(socks)
+    except (OSError, ValueError):
+        errors += 1
+    elapsed = perf_counter() - start
+    for sock in socks:
+        sock.close()
+    results.put((count, errors, elapsed, latencies))
+
+
+def udp_worker(port: int, window: int, msg: Message, duration: float, barrier, results):
+    client = HUdpReqResClient(("127.0.0.1", port))
+    client.settimeout(1.0)
+    client.set_request_ids(True)
+    client.request(msg)  # 启动接收线程
+    barrier.wait()
+    latencies: list[float] = []
+    errors = [0]
+    slots = threading.Semaphore(window)
+
+    def on_done(future, t0):
+        if future.result() is None:
+            errors[0] += 1
+        else:
+            latencies.append(perf_counter() - t0)
+        slots.release()
+
+    start = perf_counter()
+    deadline = start + duration
+    while perf_counter() < deadline:
+        slots.acquire()
+        t0 = perf_counter()
+        client.request_async(msg).add_done_callback(lambda f, t0=t0: on_done(f, t0))
+    for i in range(window):
+        slots.acquire(timeout=2.0)
+    elapsed = perf_counter() - start
+    client.close()
+    results.put((len(latencies), errors[0], elapsed, latencies))
+
+
+def run_workers(ctx, target, args_per_worker: list[tuple], timeout: float) -> tuple[int, int, float, list[float]]:
+    barrier = ctx.Barrier(len(args_per_worker) + 1, timeout=timeout)
+    results = ctx.Queue()
+    procs = [ctx.Process(target=target, args=args + (barrier, results), daemon=True) for args in args_per_worker]
+    for p in procs:
+        p.start()
+    barrier.wait()
+    count = errors = 0
+    elapsed = 0.0
+    latencies: list[float] = []
+    for p in procs:
+        c, e, t, lat = results.get(timeout=timeout)
+        count += c
+        errors += e
+        elapsed = max(elapsed, t)
+        latencies.extend(lat)
+    for p in procs:
+        p.join(5)
+    return count, errors, elapsed, latencies
+
+
+def split(total: int, parts: int) -> list[int]:
+    parts = max(1, min(parts, total))
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+
+# ---------------------------------------------------------------- 测试项
+
+def ops_per_sec(func, duration: float) -> float:
+    n = 0
+    start = perf_counter()
+    deadline = start + duration
+    while perf_counter() < deadline:
+        for i in range(100):
+            func()
+        n += 100
+    return round(n / (perf_counter() - start), 1)
+
+
+def bench_message(cfg) -> list[dict]:
+    results = []
+    for contenttype in cfg.contenttypes:
+        for size in cfg.sizes:
+            msg = make_msg(contenttype, size)
+            data = msg.toBytes()
+            for op, func in (("encode", msg.toBytes), ("decode", lambda: Message.fromBytes(data))):
+                results.append({
+                    "name": "message/{}/{}/{}B".format(op, contenttype.name.lower(), size),
+                    "params": {"op": op, "contenttype": contenttype.name, "size": size},
+                    "ops_per_sec": ops_per_sec(func, cfg.duration / 2),
+                })
+    # 小数值记录: json与RECORD(struct/msgpack)对比, 编码包含构造报文
+    record = {"id": 123456, "kind": 3, "x": 1.5, "y": -2.25, "ts": 1700000000123}
+    formats = {"json": None, "struct": StructSchema("<IHddQ", tuple(record))}
+    if msgpack is not None:
+        formats["msgpack"] = MsgpackSchema({"id": int, "kind": int, "x": float, "y": float, "ts": int})
+    for i, (fmt, schema) in enumerate(formats.items()):
+        if schema is None:
+            encode = lambda: Message.JsonMsg(OP_ECHO, record).toBytes()
+        else:
+            registerSchema(OP_RECORD + i, schema)
+            encode = lambda op=OP_RECORD + i: Message.RecordMsg(op, record).toBytes()
+        data = encode()
+        for op, func in (("encode", encode), ("decode", lambda: Message.fromBytes(data))):
+            results.append({
+                "name": "message/{}/record-{}/{}B".format(op, fmt, len(data)),
+                "params": {"op": op, "contenttype": "RECORD" if schema else "JSONOBJRCT", "format": fmt,
+                           "size": len(data)},
+                "ops_per_sec": ops_per_sec(func, cfg.duration / 2),
+            })
+    return results
+
+
+def bench_tcp(ctx, cfg, kind: str) -> list[dict]:
+    results = []
+    cases = [(contenttype, size, cfg.workers) for contenttype in cfg.contenttypes for size in cfg.sizes]
+    cases += [(ContentType.BINARY, 1024, conns) for conns in cfg.connections
+              if not (kind in LOCAL_SUITES and conns > cfg.max_threading_connections)
+              and not (kind == "shm" and conns > cfg.max_shm_connections)]
+    with ServerProcess(ctx, kind) as server:
+        for contenttype, size, conns in cases:
+            if conns + 64 > cfg.fd_limit:
+                print("skip {} connections: fd limit {}".format(conns, cfg.fd_limit))
+                continue
+            data = make_msg(contenttype, size).toBytes()
+            args = [(kind, server.addr, n, data, cfg.duration) for n in split(conns, cfg.workers)]
+            try:
+                count, errors, elapsed, latencies = run_workers(ctx, tcp_worker, args, 60 + conns / 50)
+            except (threading.BrokenBarrierError, OSError) as e:
+                print("{} {} connections failed: {}".format(kind, conns, e))
+                continue
+            params = {"server": kind, "contenttype": contenttype.name, "size": size, "connections": conns}
+            name = "{}/{}/{}B/c{}".format(kind, contenttype.name.lower(), size, conns)
+            results.append(summarize(name, params, count, errors, elapsed, latencies))
+            print_result(results[-1])
+    return results
+
+
+def bench_udp(ctx, cfg) -> list[dict]:
+    results = []
+    cases = [(contenttype, size, cfg.workers) for contenttype in cfg.contenttypes for size in cfg.sizes]
+    cases += [(ContentType.BINARY, 1024, window) for window in cfg.connections if window <= 1024]
+    with ServerProcess(ctx, "udp") as server:
+        for contenttype, size, inflight in cases:
+            msg = make_msg(contenttype, size)
+            args = [(server.addr[1], n, msg, cfg.duration) for n in split(inflight, cfg.workers)]
+            count, errors, elapsed, latencies = run_workers(ctx, udp_worker, args, 60)
+            params = {"server": "udp", "contenttype": contenttype.name, "size": size, "inflight": inflight}
+            name = "udp/{}/{}B/w{}".format(contenttype.name.lower(), size, inflight)
+            results.append(summarize(name, params, count, errors, elapsed, latencies))
+            print_result(results[-1])
+    return results
+
+
+def bench_file(ctx, cfg) -> list[dict]:
+    results = []
+    workdir = tempfile.mkdtemp(prefix="hsocket_bench_")
+    try:
+        for size_mb in cfg.file_sizes:
+            path = os.path.join(workdir, "bench_{}MB.bin".format(size_mb))
+            with open(path, "wb") as f:
+                for i in range(size_mb):
+                    f.write(os.urandom(1 << 20))
+            server_dir = os.path.join(workdir, "server_download")
+            with ServerProcess(ctx, "tcp-selector", path, server_dir) as server:
+                SocketConfig.downloadDirectory = os.path.join(workdir, "client_download")
+                for direction in ("download", "upload"):
+                    client = HTcpReqResClient()
+                    client.connect(server.addr)
+                    start = perf_counter()
+                    if direction == "download":
+                        client.sendmsg(Message.HeaderOnlyMsg(OP_DOWNLOAD))
+                        ok = bool(client.recvfile())
+                    else:
+                        client.sendmsg(Message.HeaderOnlyMsg(OP_UPLOAD))
+                        client.sendfile(path, "bench_upload.bin")
+                        ok = True
+                    elapsed = perf_counter() - start
+                    client.close()
+                    results.append({
+                        "name": "file/{}/{}MB".format(direction, size_mb),
+                        "params": {"direction": direction, "size_mb": size_mb},
+                        "mb_per_sec": round(size_mb / elapsed, 1) if ok else 0.0,
+                        "errors": 0 if ok else 1,
+                    })
+                    print_result(results[-1])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+# ---------------------------------------------------------------- 输出
+
+METRICS = (("msgs_per_sec", True), ("ops_per_sec", True), ("mb_per_sec", True), ("p50_us", False), ("p99_us", False))
+
+
+def print_result(result: dict):
+    values = "  ".join("{}={}".format(key, result[key]) for key, _ in METRICS if key in result)
+    print("{:<48}{}".format(result["name"], values))
+
+
+def compare_transports(results: list[dict]):
+    """并列打印同一用例在tcp回环、unix域套接字与共享内存上的结果"""
+    cases: dict[str, dict[str, dict]] = {}
+    for result in results:
+        suite, _, case = result["name"].partition("/")
+        if suite in LOCAL_SUITES:
+            cases.setdefault(case, {})[suite] = result
+    cases = {case: by_suite for case, by_suite in cases.items() if len(by_suite) > 1}
+    if not cases:
+        return
+    print("\n{:<28}".format("msgs_per_sec / p50_us") + "".join("{:>26}".format(s) for s in LOCAL_SUITES))
+    for case, by_suite in cases.items():
+        cells = []
+        for suite in LOCAL_SUITES:
+            r = by_suite.get(suite)
+            cells.append("{:>26}".format("{} / {}".format(r["msgs_per_sec"], r["p50_us"]) if r else "-"))
+        print("{:<28}".format(case) + "".join(cells))
+
+
+def compare(results: list[dict], baseline: list[dict]):
+    """打印与基线的差异, 正数表示变好"""
+    old = {r["name"]: r for r in baseline}
+    print("\n{:<48}{:<14}{:>12}{:>12}{:>9}".format("name", "metric", "baseline", "current", "change"))
+    for result in results:
+        base = old.get(result["name"])
+        if base is None:
+            continue
+        for key, higher_is_better in METRICS:
+            if key not in result or key not in base or not base[key]:
+                continue
+            change = (result[key] - base[key]) / base[key] * 100
+            if not higher_is_better:
+                change = -change
+            print("{:<48}{:<14}{:>12}{:>12}{:>+8.1f}%".format(result["name"], key, base[key], result[key], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HSocket loopback benchmark")
+    parser.add_argument("--quick", action="store_true", help="更少的用例与更短的时长")
+    parser.add_argument("--only", default=",".join(SUITES), help="逗号分隔的测试项: " + ",".join(SUITES))
+    parser.add_argument("--duration", type=float, default=None, help="每个用例的时长(秒)")
+    parser.add_argument("--workers", type=int, default=4, help="客户端进程数")
+    parser.add_argument("--connections", default=None, help="逗号分隔的连接数, 如 1,10,100,1000,10000")
+    parser.add_argument("--output", default=None, help="结果JSON文件")
+    parser.add_argument("--baseline", default=None, help="用于比较的基线JSON文件")
+    cfg = parser.parse_args()
+
+    cfg.duration = cfg.duration or (0.5 if cfg.quick else 2.0)
+    cfg.sizes = [16, 1024] if cfg.quick else [16, 1024, 16384]
+    cfg.contenttypes = [ContentType.BINARY] if cfg.quick else \
+        [ContentType.PLAINTEXT, ContentType.JSONOBJRCT, ContentType.BINARY]
+    cfg.connections = [int(c) for c in cfg.connections.split(",")] if cfg.connections else \
+        ([1, 100] if cfg.quick else [1, 10, 100, 1000, 10000])
+    cfg.file_sizes = [8] if cfg.quick else [8, 128]
+    cfg.max_threading_connections = 1000  # 每个连接需要两个线程
+    cfg.max_shm_connections = 100  # 每个连接需要两个环形缓冲区
+    cfg.fd_limit = raise_fd_limit()
+    suites = [s.strip() for s in cfg.only.split(",") if s.strip()]
+    ctx = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+
+    results: list[dict] = []
+    for suite in suites:
+        print("== {}".format(suite))
+        match suite:
+            case "message":
+                suite_results = bench_message(cfg)
+                for r in suite_results:
+                    print_result(r)
+            case "tcp-selector" | "tcp-threading" | "uds" | "shm":
+                suite_results = bench_tcp(ctx, cfg, suite)
+            case "udp":
+                suite_results = bench_udp(ctx, cfg)
+            case "file":
+                suite_results = bench_file(ctx, cfg)
+            case _:
+                parser.error("unknown suite: {}".format(suite))
+        results.extend(suite_results)
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "duration": cfg.duration,
+            "workers": cfg.workers,
+        },
+        "results": results,
+    }
+    if cfg.output:
+        with open(cfg.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report))
+    compare_transports(results)
+    if cfg.baseline:
+        with open(cfg.baseline) as f:
+            compare(results, json.load(f)["results"])
+
+
+if __name__ == '__main__':
+    main()
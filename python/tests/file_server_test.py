@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import sys
+import logging
 
 sys.path.append("..")
 from src.hsocket.hserver import HTcpSelectorServer
@@ -27,6 +28,7 @@ def onMessageReceived(conn: HTcpSocket, msg: Message):
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     server = HTcpSelectorServer(("127.0.0.1", 40000))
     server.setOnMessageReceivedCallback(onMessageReceived)
     try:
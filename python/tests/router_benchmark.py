@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import sys
+
+sys.path.append("..")
+from src.hsocket.router import Router
+from src.hsocket.hsocket import Message
+from time import perf_counter
+
+N = 1_000_000
+
+
+def onRecvOpCode(conn, msg) -> bool:
+    return msg.opcode() % 2 == 0
+
+
+def onMessageReceived(conn, msg):
+    pass
+
+
+def counter_middleware(opcode, next_handler):
+    def handler(conn, msg):
+        next_handler(conn, msg)
+    return handler
+
+
+class DictDispatcher:
+    """原有实现: 每次分发时字典查找 + 回退调用"""
+
+    def __init__(self):
+        self.callbacks = {opcode: onRecvOpCode for opcode in range(10)}
+        self.default = onMessageReceived
+
+    def _onMessageReceived(self, conn, msg):
+        opcode = msg.opcode()
+        callback = self.callbacks.get(opcode)
+        if callback is not None:
+            finished = callback(conn, msg)
+            if finished:
+                return
+        if self.default:
+            self.default(conn, msg)
+
+
+def bench_dict(msgs):
+    dispatcher = DictDispatcher()
+    start = perf_counter()
+    for msg in msgs:
+        dispatcher._onMessageReceived(None, msg)
+    return perf_counter() - start
+
+
+def bench_router(msgs, middleware_count=0):
+    router = Router()
+    for opcode in range(10):
+        router.setHandler(opcode, onRecvOpCode)
+    router.setDefaultHandler(onMessageReceived)
+    for _ in range(middleware_count):
+        router.use(counter_middleware)
+    start = perf_counter()
+    for msg in msgs:
+        router.handler(msg.opcode())(None, msg)
+    return perf_counter() - start
+
+
+if __name__ == '__main__':
+    msgs = [Message.HeaderOnlyMsg(i % 20) for i in range(N)]
+    for name, elapsed in [("dict lookup", bench_dict(msgs)),
+                          ("router", bench_router(msgs)),
+                          ("router + 3 middlewares", bench_router(msgs, 3))]:
+        print(f"{name:<24}{elapsed:8.3f}s  {N / elapsed / 1e6:6.2f} M msg/s")
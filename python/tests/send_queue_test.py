@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import socket
+import sys
+import threading
+import time
+
+sys.path.append("..")
+from src.hsocket.hsocket import SendQueue, OverflowPolicy
+
+KB = 1 << 10
+
+
+def socket_pair() -> tuple[socket.socket, socket.socket]:
+    writer, reader = socket.socketpair()
+    writer.setblocking(False)
+    reader.settimeout(5.0)
+    return writer, reader
+
+
+def read_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        assert chunk, "connection closed after {} of {} bytes".format(len(data), size)
+        data += chunk
+    return bytes(data)
+
+
+def test_block(writer: socket.socket, reader: socket.socket):
+    # 超过高水位时阻塞发送方, 回落至低水位后继续, 并调用onDrain
+    queue = SendQueue(writer, 100 * KB, 20 * KB, OverflowPolicy.BLOCK)
+    drained = threading.Event()
+    queue.onDrain = drained.set
+    assert queue.put(b"a" * 80 * KB)
+    assert not queue.put(b"b" * 40 * KB, block=False), "non-blocking put should give up when overflowing"
+    done = threading.Event()
+    threading.Thread(target=lambda: (queue.put(b"c" * 40 * KB), done.set()), daemon=True).start()
+    assert not done.wait(0.2), "put should block above the high watermark"
+    assert queue.size() == 80 * KB
+    writer.setblocking(True)
+    threading.Thread(target=queue.run, daemon=True).start()
+    data = read_exactly(reader, 120 * KB)
+    assert done.wait(2.0), "blocked put should resume after draining"
+    assert drained.wait(2.0), "onDrain should be called after falling to the low watermark"
+    assert data == b"a" * 80 * KB + b"c" * 40 * KB
+    queue.close()
+
+
+def test_drop_oldest(writer: socket.socket, reader: socket.socket):
+    # 丢弃最早的报文, 被丢弃的报文以False调用on_written
+    queue = SendQueue(writer, 100 * KB, 20 * KB, OverflowPolicy.DROP_OLDEST)
+    results: dict[int, bool] = {}
+    for i in range(5):
+        assert queue.put(bytes([i]) * 40 * KB, on_written=lambda ok, i=i: results.__setitem__(i, ok))
+    assert queue.size() <= 100 * KB
+    assert [i for i, ok in sorted(results.items()) if not ok] == [0, 1, 2], results
+    while not queue.writeSome():
+        time.sleep(0.01)
+    data = read_exactly(reader, 80 * KB)
+    assert data == b"\3" * 40 * KB + b"\4" * 40 * KB
+    assert results == {0: False, 1: False, 2: False, 3: True, 4: True}, results
+    queue.close()
+
+
+def test_drop_oldest_keeps_inflight_space(writer: socket.socket, reader: socket.socket):
+    # run正在写出的字节不算作可通过丢弃释放的空间, 队列中的报文不应因此被丢弃
+    writer.setblocking(True)
+    writer.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * KB)
+    queue = SendQueue(writer, 4096 * KB, 1024 * KB, OverflowPolicy.DROP_OLDEST)
+    dropped: list[int] = []
+    queue.put(b"a" * 2048 * KB)
+    threading.Thread(target=queue.run, daemon=True).start()
+    time.sleep(0.2)  # run已取出a并阻塞在写出上
+    for i, fill in enumerate(b"bcd"):
+        queue.put(bytes([fill]) * 1024 * KB, on_written=lambda ok, i=i: ok or dropped.append(i))
+    assert not dropped, "queued messages were dropped to make room for in-flight bytes: {}".format(dropped)
+    data = read_exactly(reader, 5120 * KB)
+    assert data == b"a" * 2048 * KB + b"b" * 1024 * KB + b"c" * 1024 * KB + b"d" * 1024 * KB
+    queue.close()
+
+
+def test_disconnect(writer: socket.socket, reader: socket.socket):
+    # 溢出时关闭队列并调用onOverflow, 之后的报文均被拒绝
+    queue = SendQueue(writer, 100 * KB, 20 * KB, OverflowPolicy.DISCONNECT)
+    overflowed = threading.Event()
+    queue.onOverflow = overflowed.set
+    results: list[bool] = []
+    assert queue.put(b"a" * 80 * KB, on_written=results.append)
+    assert not queue.put(b"b" * 40 * KB)
+    assert overflowed.is_set(), "onOverflow should be called"
+    assert queue.isClosed()
+    assert results == [False], "queued messages should be reported as not written"
+    assert not queue.put(b"c")
+
+
+if __name__ == '__main__':
+    for test in (test_block, test_drop_oldest, test_drop_oldest_keeps_inflight_space, test_disconnect):
+        writer, reader = socket_pair()
+        try:
+            test(writer, reader)
+        finally:
+            writer.close()
+            reader.close()
+        print(test.__name__, "ok")
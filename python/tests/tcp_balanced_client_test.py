@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import sys
+
+sys.path.append("..")
+from src.hsocket.hclient import HTcpBalancedClient
+from src.hsocket.balancer import LeastOutstandingBalancer
+from src.hsocket.hsocket import Message
+from traceback import print_exc
+
+if __name__ == '__main__':
+    # 分别在40000与40001端口启动服务端, 关闭其中一个后请求会转发给另一个
+    client = HTcpBalancedClient([("127.0.0.1", 40000), ("127.0.0.1", 40001)], LeastOutstandingBalancer())
+    client.settimeout(5)
+    print("start")
+    try:
+        while 1:
+            code = input(">>>")
+            if code.isdigit():
+                code = int(code)
+                response = client.request(Message.JsonMsg(code, text=f"test message<{code}> send by client"))
+                print(response)
+                print(client.endpoints())
+            else:
+                break
+    except Exception as e:
+        print(print_exc())
+    client.close()
+    input("press enter to exit")
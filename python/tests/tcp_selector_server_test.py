@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import sys
+import logging
 
 sys.path.append("..")
 from src.hsocket.hserver import HTcpSelectorServer
@@ -48,6 +49,7 @@ def onDisconnected(conn: HTcpSocket, addr):
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     server = HTcpSelectorServer(("127.0.0.1", 40000))
     server.setOnMsgRecvByOpCodeCallback(990, onRecv990)
     server.setOnMsgRecvByOpCodeCallback(991, onRecv991)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import sys
+import time
+
+sys.path.append("..")
+from src.hsocket.hsocket import HUdpSocket, Message
+
+
+def recv_all(sock: HUdpSocket, buffer: bytearray, count: int) -> list[Message]:
+    msgs = []
+    deadline = time.monotonic() + 5.0
+    while len(msgs) < count and time.monotonic() < deadline:
+        batch, errors = sock.recvMsgBatch(buffer, 64)
+        assert errors == 0, f"{errors} datagrams failed to parse"
+        msgs.extend(msg for msg, addr in batch)
+    return msgs
+
+
+def test_batch_does_not_alias_buffer(receiver: HUdpSocket, sender: HUdpSocket, buffer: bytearray):
+    # 两个数据包在同一批次中读入同一个缓冲区, 先收到的报文不能被后收到的覆盖
+    addr = receiver.getsockname()
+    sender.sendMsg(Message.BinaryMsg(1, b"a" * 100), addr)
+    sender.sendMsg(Message.BinaryMsg(2, b"b" * 100), addr)
+    time.sleep(0.1)  # 确保两个数据包都已到达, 会在一次recvMsgBatch中收到
+    msgs = recv_all(receiver, buffer, 2)
+    assert [msg.opcode() for msg in msgs] == [1, 2], msgs
+    assert msgs[0].content() == b"a" * 100, msgs[0].content()[:16]
+    assert msgs[1].content() == b"b" * 100, msgs[1].content()[:16]
+
+
+def test_batch_reassembles_fragments(receiver: HUdpSocket, sender: HUdpSocket, buffer: bytearray):
+    # 分片被缓存至收齐, 同样不能引用接收缓冲区
+    addr = receiver.getsockname()
+    payload = bytes(range(256)) * 40
+    sender.setMaxDatagramSize(1000)
+    sender.sendMsg(Message.BinaryMsg(3, payload), addr)
+    sender.sendMsg(Message.BinaryMsg(4, b"c" * 100), addr)
+    time.sleep(0.1)
+    msgs = recv_all(receiver, buffer, 2)
+    assert [msg.opcode() for msg in msgs] == [3, 4], msgs
+    assert msgs[0].content() == payload
+    assert msgs[1].content() == b"c" * 100
+
+
+if __name__ == '__main__':
+    receiver = HUdpSocket()
+    receiver.bind(("127.0.0.1", 0))
+    receiver.settimeout(1.0)
+    sender = HUdpSocket()
+    buffer = bytearray(65535)
+    try:
+        test_batch_does_not_alias_buffer(receiver, sender, buffer)
+        test_batch_reassembles_fragments(receiver, sender, buffer)
+    finally:
+        receiver.close()
+        sender.close()
+    print("ok")